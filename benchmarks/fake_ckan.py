@@ -0,0 +1,303 @@
+import csv, hashlib, io, json, random, re, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+# A local stand-in for Open Data BCN's CKAN API, for benchmarks and tests. It answers package_show
+# and package_search with payloads shaped like the real ones (see the example in notes) and serves synthetic CSVs,
+# with configurable size, encoding, latency and failure rate. With datastore=True the resources can also be
+# queried through datastore_search.
+
+SEND_CHUNK = 64 * 1024
+
+DISTRICTS = [
+    (1, "Ciutat Vella", "el Raval"),
+    (2, "Eixample", "la Sagrada Família"),
+    (3, "Sants-Montjuïc", "la Marina de Port"),
+    (4, "Les Corts", "Pedralbes"),
+    (5, "Sarrià-Sant Gervasi", "Sant Gervasi - la Bonanova"),
+    (6, "Gràcia", "Vallcarca i els Penitents"),
+    (7, "Horta-Guinardó", "la Font d'en Fargues"),
+    (8, "Nou Barris", "Ciutat Meridiana"),
+    (9, "Sant Andreu", "la Sagrera"),
+    (10, "Sant Martí", "el Poblenou"),
+]
+
+
+def synthetic_csv(year: int, rows: int, delimiter: str = ",", seed: int = 0) -> str:
+    """
+    A CSV shaped like Open Data BCN's yearly files: dates, district and neighbourhood names with
+    accents and apostrophes, integer codes and decimal values. Semicolon files use Catalan decimal
+    commas, like many of the city's older files.
+    """
+    rng = random.Random(seed * 100_003 + year)
+    header = ["Data_Referencia", "Codi_Districte", "Nom_Districte", "Nom_Barri", "Seccio_Censal", "Valor", "Percentatge"]
+    lines = [delimiter.join(header)]
+    for i in range(rows):
+        code, district, neighbourhood = DISTRICTS[i % len(DISTRICTS)]
+        share = rng.random() * 100
+        share = f"{share:.2f}".replace(".", ",") if delimiter == ";" else f"{share:.2f}"
+        lines.append(delimiter.join((
+            f"{year}-{(i % 12) + 1:02d}-01",
+            str(code),
+            district,
+            neighbourhood,
+            str(i % 250 + 1),
+            str(rng.randint(0, 5000)),
+            share,
+        )))
+    return "\n".join(lines) + "\n"
+
+
+class FakeCKAN:
+    """
+    Serves packages of synthetic resources on 127.0.0.1 from a background thread.
+
+    Args:
+        packages (dict): Package name -> number of resources (one per year, counting back from 2025).
+        tags (dict): Optional package name -> list of tags.
+        rows (int): Rows per resource.
+        encoding (str): Encoding the CSVs are served in, e.g. "utf-8", "utf-8-sig", "cp1252" or "utf-16".
+        delimiter (str): CSV delimiter.
+        latency (float): Seconds every request waits before it's answered.
+        failure_rate (float): Share of requests answered with a 503 (with Retry-After: 0).
+        seed (int): Seed for the data, so runs can be compared.
+        datastore (bool): Mark the resources as in the DataStore and answer datastore_search for them.
+        hashes (bool): Publish the MD5 of every file in its "hash" field, as CKAN does when it's configured to.
+
+    Every request is logged in .requests as (path, status, seconds, bytes sent), for latency percentiles.
+    """
+
+    def __init__(
+            self,
+            packages: Optional[dict] = None,
+            tags: Optional[dict] = None,
+            rows: int = 10_000,
+            encoding: str = "utf-8",
+            delimiter: str = ",",
+            latency: float = 0.0,
+            failure_rate: float = 0.0,
+            seed: int = 0,
+            datastore: bool = False,
+            hashes: bool = False,
+            ):
+        self.packages = packages or {"fake-package": 4}
+        self.tags = tags or {}
+        self.rows = rows
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.datastore = datastore
+        self.hashes = hashes
+        self.requests = []
+        self._tables = {}
+        self._bodies = {}
+        self._served = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/api/action"
+
+    def resource_id(self, package: str, year: int) -> str:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{package}/{year}/{self.seed}"))
+
+    def body(self, package: str, year: int) -> bytes:
+        key = (package, year)
+        with self._lock:
+            if key not in self._bodies:
+                text = synthetic_csv(year, self.rows, self.delimiter, self.seed)
+                self._bodies[key] = text.encode(self.encoding)
+            return self._bodies[key]
+
+    def package_show(self, package: str) -> Optional[dict]:
+        if package not in self.packages:
+            return None
+        base = f"http://127.0.0.1:{self._server.server_address[1]}"
+        package_id = str(uuid.uuid5(uuid.NAMESPACE_URL, package))
+        resources = []
+        for position in range(self.packages[package]):
+            year = 2025 - position
+            resource_id = self.resource_id(package, year)
+            resources.append({
+                "datastore_active": self.datastore,
+                "format": "CSV",
+                "hash": hashlib.md5(self.body(package, year)).hexdigest() if self.hashes else "",
+                "id": resource_id,
+                "last_modified": None,
+                "name": f"{year}_{package}.csv",
+                "package_id": package_id,
+                "position": position,
+                "revision_id": str(uuid.uuid5(uuid.NAMESPACE_URL, f"{resource_id}/revision")),
+                "size": str(len(self.body(package, year))),
+                "state": "active",
+                "token_required": "No",
+                "url": f"{base}/dataset/{package_id}/resource/{resource_id}/download/{package}/{year}",
+            })
+        return {
+            "help": f"{base}/api/3/action/help_show?name=package_show",
+            "success": True,
+            "result": {
+                "id": package_id,
+                "name": package,
+                "metadata_modified": "2025-10-01T00:00:00.000000",
+                "num_resources": len(resources),
+                "resources": resources,
+                "num_tags": len(self.tags.get(package, [])),
+                "tags": [{"display_name": tag, "name": tag, "state": "active"} for tag in self.tags.get(package, [])],
+            },
+        }
+
+    def package_search(self, start: int, rows: int) -> dict:
+        names = sorted(self.packages)
+        return {
+            "success": True,
+            "result": {
+                "count": len(names),
+                "results": [self.package_show(name)["result"] for name in names[start:start + rows]],
+            },
+        }
+
+    def table(self, resource_id: str) -> Optional[tuple[list, list]]:
+        """
+        The header and rows of a resource, as the DataStore would hold them.
+        """
+        with self._lock:
+            if resource_id in self._tables:
+                return self._tables[resource_id]
+        for package, count in self.packages.items():
+            for position in range(count):
+                year = 2025 - position
+                if self.resource_id(package, year) == resource_id:
+                    text = synthetic_csv(year, self.rows, self.delimiter, self.seed)
+                    rows = list(csv.reader(io.StringIO(text), delimiter=self.delimiter))
+                    with self._lock:
+                        self._tables[resource_id] = (rows[0], rows[1:])
+                        return self._tables[resource_id]
+        return None
+
+    def datastore_search(self, query: dict) -> tuple[int, dict]:
+        """
+        Answers a datastore_search with records_format=csv: fields, filters, offset and limit are honoured.
+        """
+        table = self.table(query.get("resource_id", [""])[0]) if self.datastore else None
+        if table is None:
+            return 404, {"success": False, "error": {"message": "Not found: Resource was not found."}}
+        header, rows = table
+        fields = query["fields"][0].split(",") if "fields" in query else header
+        filters = json.loads(query["filters"][0]) if "filters" in query else {}
+        unknown = [name for name in list(fields) + list(filters) if name not in header]
+        if unknown:
+            return 409, {"success": False, "error": {"fields": [f"field \"{name}\" not in table" for name in unknown]}}
+        for name, wanted in filters.items():
+            wanted = {str(value) for value in (wanted if isinstance(wanted, list) else [wanted])}
+            rows = [row for row in rows if row[header.index(name)] in wanted]
+        offset, limit = int(query.get("offset", ["0"])[0]), int(query.get("limit", ["100"])[0])
+        records = io.StringIO()
+        writer = csv.writer(records)
+        for row in rows[offset:offset + limit]:
+            writer.writerow([row[header.index(name)] for name in fields])
+        listed = fields if "fields" in query else ["_id"] + header
+        return 200, {
+            "success": True,
+            "result": {
+                "resource_id": query["resource_id"][0],
+                "fields": [{"id": name, "type": "int" if name == "_id" else "text"} for name in listed],
+                "records_format": "csv",
+                "records": records.getvalue(),
+                "total": len(rows),
+            },
+        }
+
+    def should_fail(self) -> bool:
+        """
+        Fails exactly failure_rate of the requests, spread evenly, so every run fails the same ones.
+        """
+        if not self.failure_rate:
+            return False
+        with self._lock:
+            self._served += 1
+            return int(self._served * self.failure_rate) != int((self._served - 1) * self.failure_rate)
+
+    def log(self, path: str, status: int, seconds: float, sent: int):
+        with self._lock:
+            self.requests.append((path, status, seconds, sent))
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, status: int, body: bytes, headers: dict):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                view = memoryview(body)
+                for start in range(0, len(body), SEND_CHUNK):
+                    self.wfile.write(view[start:start + SEND_CHUNK])
+                return len(body)
+
+            def do_GET(self):
+                started = time.perf_counter()
+                if fake.latency:
+                    time.sleep(fake.latency)
+                url = urlparse(self.path)
+                if fake.should_fail():
+                    status, sent = 503, self.send_body(503, b"Service Unavailable", {"Retry-After": "0"})
+                elif url.path.endswith("/package_show"):
+                    payload = fake.package_show(parse_qs(url.query).get("id", [""])[0])
+                    status = 200 if payload else 404
+                    body = json.dumps(payload or {"success": False, "error": {"message": "Not found"}}).encode()
+                    sent = self.send_body(status, body, {"Content-Type": "application/json"})
+                elif url.path.endswith("/package_search"):
+                    query = parse_qs(url.query)
+                    payload = fake.package_search(int(query.get("start", ["0"])[0]), int(query.get("rows", ["10"])[0]))
+                    status, sent = 200, self.send_body(200, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+                elif url.path.endswith("/datastore_search"):
+                    status, payload = fake.datastore_search(parse_qs(url.query))
+                    sent = self.send_body(status, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+                elif match := re.search(r"/download/([^/]+)/(\d+)$", url.path):
+                    package, year = match.group(1), int(match.group(2))
+                    if package not in fake.packages:
+                        status, sent = 404, self.send_body(404, b"Not found", {})
+                    else:
+                        status, sent = self.send_file(fake.body(package, year))
+                else:
+                    status, sent = 404, self.send_body(404, b"Not found", {})
+                fake.log(url.path, status, time.perf_counter() - started, sent)
+
+            def send_file(self, body: bytes) -> tuple[int, int]:
+                headers = {"Content-Type": "text/csv", "Accept-Ranges": "bytes"}
+                match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+                if match:
+                    start = int(match.group(1))
+                    if start >= len(body):
+                        return 416, self.send_body(416, b"", {"Content-Range": f"bytes */{len(body)}"})
+                    headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+                    return 206, self.send_body(206, body[start:], headers)
+                return 200, self.send_body(200, body, headers)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake_ckan", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
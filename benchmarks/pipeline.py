@@ -0,0 +1,231 @@
+import argparse, json, logging, multiprocessing, os, shutil, statistics, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+
+# Benchmarks the download, decode and load hot paths against a local stand-in for Open Data BCN
+# (see fake_ckan.py), so regressions show up without touching the city's servers.
+# Run it from the repository root: python benchmarks/pipeline.py [--scenario small flaky ...]
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fake_ckan import FakeCKAN, synthetic_csv
+
+SCENARIOS = {
+    # many small files over a slightly slow connection: request overhead and concurrency
+    "small": dict(packages=2, resources=6, rows=20_000, workers=4, latency=0.02),
+    # a few big files: raw download, decode and save throughput
+    "large": dict(packages=1, resources=2, rows=400_000, workers=2),
+    # legacy encodings and Catalan number formats: the decode fallback paths
+    "cp1252": dict(packages=1, resources=4, rows=50_000, workers=4, encoding="cp1252", delimiter=";"),
+    "utf16": dict(packages=1, resources=2, rows=50_000, workers=2, encoding="utf-16"),
+    # one request in five answered with a 503: the retry queue
+    "flaky": dict(packages=2, resources=6, rows=20_000, workers=4, latency=0.02, failure_rate=0.2),
+    # a targeted pull of two columns and two districts through datastore_search, against "large"
+    "datastore": dict(
+        packages=1, resources=2, rows=400_000, workers=2,
+        datastore=dict(columns=["Data_Referencia", "Valor"], filters={"Nom_Districte": ["Gràcia", "Sant Martí"]}),
+        ),
+    # "large" saved gzip-compressed: the cost of compressing on the way to disk, and the space saved
+    "gzip": dict(packages=1, resources=2, rows=400_000, workers=2, compression="gzip"),
+    # decoding and validating in memory, without the network or the disk
+    "decode": dict(kind="decode", rows=400_000),
+}
+
+
+def peak_rss_mb() -> float:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    cuts = statistics.quantiles(values, n=100, method="inclusive") if len(values) > 1 else values * 99
+    return {"p50": cuts[49], "p90": cuts[89], "p99": cuts[98], "max": max(values)}
+
+
+def run_pipeline_scenario(config: dict, api_url: str, load_db: bool) -> dict:
+    """
+    Runs main_pipeline (and copy_package_to_db with load_db) for every package of a scenario.
+    This runs in a fresh process, so the peak memory is the pipeline's own.
+    """
+    # read when data_functions is imported, which hasn't happened yet in this process
+    os.environ["BCN_ETL_CKAN_URL"] = api_url
+    from concurrency import HostLimiter
+    from http_client import get_session
+    from metrics import Metrics
+    from pipeline_functions import main_pipeline
+    from datastore import DatastoreQuery
+    from storage import is_stored_csv
+
+    logger = logging.getLogger("benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    metrics = Metrics()
+    storage_root = tempfile.mkdtemp(prefix="bcn_etl_benchmark_")
+    packages = [f"benchmark-{i}" for i in range(config["packages"])]
+    try:
+        session = get_session(logger, pool_size=config["workers"] + 1)
+        started = time.perf_counter()
+        reports = [
+            main_pipeline(
+                logger,
+                package,
+                storage_root=storage_root,
+                workers=config["workers"],
+                limiter=HostLimiter(max_per_host=config["workers"]),
+                session=session,
+                metrics=metrics,
+                datastore_query=DatastoreQuery(**config["datastore"]) if config.get("datastore") else None,
+                compression=config.get("compression", "none"),
+                )
+            for package in packages
+        ]
+        seconds = time.perf_counter() - started
+
+        if load_db:
+            from db_load import copy_package_to_db
+            from run_pipeline import get_db_config
+            db_config = get_db_config()
+            for package in packages:
+                copy_package_to_db(storage_root, package, db_config, metrics=metrics)
+
+        saved = sum(
+            os.path.getsize(os.path.join(storage_root, package, name))
+            for package in packages
+            for name in os.listdir(os.path.join(storage_root, package))
+            if is_stored_csv(name)
+        )
+        return {
+            "seconds": seconds,
+            "saved_bytes": saved,
+            "resources": sum(len(report.resources_success) for report in reports),
+            "resources_failed": sum(len(report.resources_fail) for report in reports),
+            "errors": sum(report.num_errors for report in reports),
+            "retries": sum(report.retries for report in reports),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": metrics.snapshot()["stages"],
+        }
+    finally:
+        shutil.rmtree(storage_root, ignore_errors=True)
+
+
+def run_decode_scenario(config: dict) -> dict:
+    """
+    Decodes and validates a synthetic CSV held in memory, one chunk at a time like a download.
+    """
+    from data_functions import decode_csv_chunks, CHUNK_SIZE
+
+    logger = logging.getLogger("benchmark")
+    logger.propagate = False
+    body = synthetic_csv(2025, config["rows"]).encode(config.get("encoding", "utf-8"))
+    chunks = [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+    started = time.perf_counter()
+    rows = sum(text.count("\n") for text in decode_csv_chunks(logger, iter(chunks), "benchmark.csv"))
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "bytes": len(body), "rows": rows, "peak_rss_mb": peak_rss_mb()}
+
+
+def run_scenario(name: str, config: dict, load_db: bool = False) -> dict:
+    # spawn, so every scenario starts from a clean interpreter (imports, memory, environment)
+    context = multiprocessing.get_context("spawn")
+    if config.get("kind") == "decode":
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_decode_scenario, config).result()
+        result["mb_per_second"] = result["bytes"] / result["seconds"] / 1e6
+        result["rows_per_second"] = result["rows"] / result["seconds"]
+        return result
+
+    packages = {f"benchmark-{i}": config["resources"] for i in range(config["packages"])}
+    fake = FakeCKAN(
+        packages=packages,
+        rows=config["rows"],
+        encoding=config.get("encoding", "utf-8"),
+        delimiter=config.get("delimiter", ","),
+        latency=config.get("latency", 0.0),
+        failure_rate=config.get("failure_rate", 0.0),
+        datastore="datastore" in config,
+        )
+    with fake:
+        # generate the files before the clock starts
+        for package in packages:
+            fake.package_show(package)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_pipeline_scenario, config, fake.api_url, load_db).result()
+
+    downloads = [entry for entry in fake.requests if "/download/" in entry[0] or entry[0].endswith("/datastore_search")]
+    served = sum(entry[3] for entry in downloads if entry[1] in (200, 206))
+    result["served_bytes"] = served
+    result["mb_per_second"] = served / result["seconds"] / 1e6
+    stages = result["stages"]
+    rows = stages["decode"]["rows"] if "decode" in stages else stages.get("download", {}).get("rows", 0)
+    result["rows_per_second"] = rows / result["seconds"]
+    result["requests"] = len(fake.requests)
+    result["failures_served"] = sum(1 for entry in fake.requests if entry[1] == 503)
+    result["latency"] = percentiles([entry[2] for entry in downloads if entry[1] in (200, 206)])
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Returns a line for every scenario whose throughput dropped more than tolerance below the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name, {}).get("mb_per_second")
+        if before and result["mb_per_second"] < before * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['mb_per_second']:.2f} MB/s, down from {before:.2f} MB/s "
+                f"({(1 - result['mb_per_second'] / before) * 100:.0f}% slower)"
+            )
+    return regressions
+
+
+def print_result(name: str, result: dict):
+    line = (
+        f"{name:<8} {result['seconds']:7.2f}s  {result['mb_per_second']:7.2f} MB/s  "
+        f"{result['rows_per_second']:>10,.0f} rows/s  peak {result['peak_rss_mb']:6.1f} MB"
+    )
+    if "latency" in result and result["latency"]:
+        latency = result["latency"]
+        line += f"  latency p50 {latency['p50'] * 1000:.0f} ms p90 {latency['p90'] * 1000:.0f} ms p99 {latency['p99'] * 1000:.0f} ms"
+    if result.get("retries") or result.get("resources_failed"):
+        line += f"  {result['retries']} retries, {result['resources_failed']} failed"
+    print(line)
+    for stage, stats in result.get("stages", {}).items():
+        print(f"    {stage:<9} {stats['seconds']:7.2f}s  {stats['bytes_per_second'] / 1e6:7.2f} MB/s  {stats['rows_per_second']:>10,.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the bcn_etl pipeline against a local fake Open Data BCN")
+    parser.add_argument("--scenario", nargs="+", choices=sorted(SCENARIOS), help="Scenarios to run (default: all)")
+    parser.add_argument("--rows", type=int, help="Override the rows per file of every scenario")
+    parser.add_argument("--db", action="store_true", help="Also load the files with copy_package_to_db, using the database in .env")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with results saved earlier with --output, and exit with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="With --baseline, how much slower counts as a regression (default: 0.2, 20%%)")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        config = dict(SCENARIOS[name])
+        if args.rows:
+            config["rows"] = args.rows
+        results[name] = run_scenario(name, config, load_db=args.db)
+        print_result(name, results[name])
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import argparse, os, statistics, subprocess, sys, time
+
+# Times how long the CLI takes to start, in fresh interpreters so nothing is already imported.
+# Run it from the repository root: python benchmarks/startup.py
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules a plain download run (-p) shouldn't need to import.
+HEAVY_MODULES = ("pandas", "pyarrow", "psycopg2", "sqlalchemy", "dotenv")
+
+CASES = {
+    "python (baseline)": ["-c", "pass"],
+    "import run_pipeline": ["-c", "import run_pipeline"],
+    "run_pipeline.py --help": ["run_pipeline.py", "--help"],
+}
+
+
+def time_command(args: list[str], runs: int) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=REPO_ROOT, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def heavy_imports() -> list[str]:
+    """
+    Returns the heavy modules that importing run_pipeline pulls in.
+    """
+    check = f"import sys, run_pipeline; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    output = subprocess.run([sys.executable, "-c", check], cwd=REPO_ROOT, check=True, capture_output=True, text=True)
+    return [name for name in output.stdout.strip().split(",") if name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the bcn_etl command line")
+    parser.add_argument("--runs", type=int, default=10, help="Runs per case (default: 10)")
+    args = parser.parse_args()
+
+    for name, command in CASES.items():
+        timings = time_command(command, args.runs)
+        print(f"{name:<28} median {statistics.median(timings) * 1000:7.1f} ms   min {min(timings) * 1000:7.1f} ms")
+    heavy = heavy_imports()
+    print(f"Heavy modules imported at startup: {', '.join(heavy) if heavy else 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import json, logging, os, tempfile, threading
+from typing import Optional
+
+# Where the blobs live, under the storage root.
+BLOB_DIR = ".blobs"
+# Maps the hashes CKAN publishes for resources to the blobs they were saved as.
+UPSTREAM_INDEX = "upstream_hashes.json"
+
+
+class BlobStore:
+    """
+    A content-addressed store for the saved CSV files, so identical content is kept on disk once.
+
+    Every file is stored as <root>/<first two characters of its SHA-256>/<SHA-256>, and the file in
+    the package directory is a hard link to it. A file published under several packages, republished
+    under a new name or unchanged between snapshots takes up the space of one copy. The number of
+    links is the reference count: a blob only the store links to is no longer used (see prune).
+
+    When CKAN publishes a hash for a resource, the blob it was saved as is remembered, so a resource
+    with a hash seen before can be linked without downloading it (see link_upstream).
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.index_path = os.path.join(root, UPSTREAM_INDEX)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.upstream = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.upstream = {}
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def commit(
+            self,
+            logger: logging.Logger,
+            tmp_path: str,
+            digest: str,
+            final_path: str,
+            upstream_hash: Optional[str] = None,
+            ) -> bool:
+        """
+        Puts a finished temporary file in its final place through the store.
+
+        New content becomes a blob. Content the store already has is dropped, and the final path is
+        linked to the existing blob instead. Either way the final path is replaced in one step.
+
+        Args:
+            logger (logging.Logger): A logging instance for recording events.
+            tmp_path (str): The written file, in the same directory as final_path.
+            digest (str): The SHA-256 of the file, computed while it was written.
+            final_path (str): Where the file goes in its package directory.
+            upstream_hash (str): The hash CKAN published for the resource, if any, to remember.
+
+        Returns:
+            True if the content was already in the store. If links aren't supported where the files
+            are saved, the file is just moved into place and False is returned.
+        """
+        blob = self.blob_path(digest)
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                # new content: the temporary file becomes the blob as well
+                os.link(tmp_path, blob)
+                duplicate = False
+            except FileExistsError:
+                # swap the new copy for a link to the stored one, keeping it if linking fails
+                os.link(blob, f"{tmp_path}.link")
+                os.replace(f"{tmp_path}.link", tmp_path)
+                duplicate = True
+        except OSError as e:
+            logger.warning(f"Couldn't link {final_path} into the blob store, saving it as a plain file: {e}")
+            os.replace(tmp_path, final_path)
+            return False
+
+        os.replace(tmp_path, final_path)
+        # a link shares the blob's old timestamp, which would make files derived from the one it
+        # replaces (e.g. columnar copies) look up to date
+        os.utime(final_path)
+        if upstream_hash:
+            self.remember(upstream_hash, digest)
+        return duplicate
+
+    def _save_index(self):
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.root, suffix=".tmp", delete=False) as f:
+            json.dump(self.upstream, f, indent=1, sort_keys=True)
+        os.replace(f.name, self.index_path)
+
+    def remember(self, upstream_hash: str, digest: str):
+        with self._lock:
+            if self.upstream.get(upstream_hash) != digest:
+                self.upstream[upstream_hash] = digest
+                self._save_index()
+
+    def link_upstream(self, upstream_hash: Optional[str], final_path: str) -> bool:
+        """
+        Links final_path to the blob saved for a CKAN hash, if there is one, so the resource doesn't
+        have to be downloaded.
+
+        Returns:
+            True if the file was linked.
+        """
+        with self._lock:
+            digest = self.upstream.get(upstream_hash) if upstream_hash else None
+        if not digest or not os.path.exists(self.blob_path(digest)):
+            return False
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        link_path = f"{final_path}.{os.getpid()}.{threading.get_ident()}.link"
+        try:
+            os.link(self.blob_path(digest), link_path)
+            os.replace(link_path, final_path)
+        except OSError:
+            if os.path.exists(link_path):
+                os.remove(link_path)
+            return False
+        os.utime(final_path)
+        return True
+
+    def prune(self) -> tuple[int, int]:
+        """
+        Deletes the blobs no package file links to any more, e.g. versions that were replaced
+        or snapshots that were deleted. Run it when nothing is being saved.
+
+        Returns:
+            The number of blobs deleted and the bytes they took up.
+        """
+        removed, freed = 0, 0
+        for directory in os.listdir(self.root):
+            path = os.path.join(self.root, directory)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                blob = os.path.join(path, name)
+                stat = os.stat(blob)
+                if stat.st_nlink == 1:
+                    os.remove(blob)
+                    removed += 1
+                    freed += stat.st_size
+        if removed:
+            with self._lock:
+                self.upstream = {key: digest for key, digest in self.upstream.items() if os.path.exists(self.blob_path(digest))}
+                self._save_index()
+        return removed, freed
@@ -0,0 +1,164 @@
+import csv, logging, os, tempfile, time, requests
+from contextlib import nullcontext
+from typing import Optional
+from concurrency import HostLimiter
+from data_functions import request_catalog_page, PACKAGE_SEARCH_URL
+from metadata_cache import MetadataCache
+from metrics import Metrics
+from retry_scheduler import RETRY_STATUSES, RetryLater, retry_after_seconds, run_with_retries
+
+# Packages per package_search page. CKAN refuses more than 1000 unless ckan.search.rows_max is raised.
+PAGE_SIZE = 1000
+
+
+def fetch_catalog_page(
+        logger: logging.Logger,
+        start: int,
+        rows: int = PAGE_SIZE,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        metrics: Optional[Metrics] = None,
+        ) -> dict:
+    """
+    Gets one page of the catalog. It's tried once: when the server is struggling the page goes
+    back to the retry queue (see sync_catalog), which waits as long as the server asked.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        start (int): Offset of the first package on the page.
+        rows (int): Number of packages on the page.
+        limiter (HostLimiter): Optional per-host limiter.
+        session (requests.Session): Optional pooled session.
+        metrics (Metrics): Optional metrics the requests are timed in, as the "catalog" stage.
+
+    Returns:
+        The package_search result ({"count": ..., "results": [...]}).
+
+    Raises:
+        RetryLater if the page couldn't be retrieved, so it can wait in the retry queue.
+        ValueError if the server refused the request or its answer isn't a package_search result.
+    """
+    with metrics.stage("catalog") if metrics else nullcontext() as timer:
+        with limiter.slot(PACKAGE_SEARCH_URL) if limiter else nullcontext():
+            response = request_catalog_page(logger, start, rows, session=session)
+        if timer and response is not None:
+            timer.bytes = len(response.content)
+
+    status = response.status_code if response is not None else None
+    if limiter:
+        limiter.record(
+            PACKAGE_SEARCH_URL,
+            status,
+            response.elapsed.total_seconds() if response is not None else None,
+            retry_after_seconds(response),
+            )
+    if status == 200:
+        try:
+            return response.json()['result']
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"the catalog page starting at {start} isn't a valid package_search answer: {e}")
+    if status is not None and status not in RETRY_STATUSES:
+        raise ValueError(f"couldn't retrieve the catalog page starting at {start}. Response code: {status}")
+
+    logger.warning(f"Problem with the catalog page starting at {start}: {status or 'No response.'}")
+    raise RetryLater(f"the page couldn't be retrieved ({status or 'no response'})", retry_after_seconds(response))
+
+
+def write_catalog(catalog: dict[str, dict], catalog_path: str):
+    """
+    Writes the tag catalog CSV (name, tags_list) that tag searches read, replacing the old one in one step.
+    """
+    directory = os.path.dirname(os.path.abspath(catalog_path))
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", dir=directory, suffix=".tmp", delete=False) as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "tags_list"])
+        for name in sorted(catalog):
+            # CKAN doesn't allow commas in tags, so they can be joined with them safely
+            writer.writerow([name, ",".join(tag['name'] for tag in catalog[name].get('tags') or [])])
+    os.replace(f.name, catalog_path)
+
+
+def sync_catalog(
+        logger: logging.Logger,
+        catalog_path: str = "catalog_tags.csv",
+        metadata_cache: Optional[MetadataCache] = None,
+        page_size: int = PAGE_SIZE,
+        workers: int = 4,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        metrics: Optional[Metrics] = None,
+        ) -> Optional[dict[str, dict]]:
+    """
+    Pulls the whole Open Data BCN catalog, with every package's tags and resources, in pages of
+    package_search results instead of one package_show per package.
+
+    The first page says how many packages there are; the rest of the pages are then requested at
+    the same time, and a page the server is struggling with is tried again later without holding
+    up the others (see retry_scheduler.run_with_retries). The tag catalog CSV is regenerated from the result, and every package is put in
+    the metadata cache as if package_show had been called for it, so the packages that get
+    downloaded next don't need a request of their own for their resource list.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        catalog_path (str): The tag catalog CSV to regenerate.
+        metadata_cache (MetadataCache): Optional on-disk cache of package_show payloads to fill.
+        page_size (int): Packages per page.
+        workers (int): Number of pages requested at the same time.
+        limiter (HostLimiter): Optional per-host limiter.
+        session (requests.Session): Optional pooled session.
+        metrics (Metrics): Optional metrics.
+
+    Returns:
+        A dictionary of package name -> package metadata (the "result" of a package_show), or None
+        if any page couldn't be retrieved. The catalog CSV and the cache are left alone in that case,
+        so a failed sync doesn't drop packages from tag searches.
+    """
+    logger.info("Syncing the catalog from Open Data BCN...")
+    start_time = time.time()
+    results = {}
+    failed = []
+
+    def fetch(start: int):
+        results[start] = fetch_catalog_page(logger, start, page_size, limiter=limiter, session=session, metrics=metrics)
+
+    # pages the server is struggling with wait in the retry queue while the other pages are fetched
+    fetch_pages = lambda starts: run_with_retries(
+        logger,
+        fetch,
+        starts,
+        workers=workers,
+        name=lambda start: f"the catalog page starting at {start}",
+        on_give_up=lambda start, error: failed.append(start),
+        on_error=lambda start, error: failed.append(start),
+        thread_name_prefix="catalog",
+        )
+
+    fetch_pages([0])
+    if failed:
+        logger.error("Couldn't sync the catalog, keeping the one on disk.")
+        return None
+    first = results[0]
+    fetch_pages(range(page_size, first['count'], page_size))
+    if failed:
+        logger.error("Couldn't get every page of the catalog, keeping the one on disk.")
+        return None
+    pages = [results[start] for start in sorted(results)]
+
+    catalog = {package['name']: package for page in pages for package in page['results']}
+    if len(catalog) < first['count']:
+        # packages published or withdrawn mid-sync shift the pages; the next sync catches them
+        logger.warning(f"The catalog lists {first['count']} packages but {len(catalog)} came back.")
+
+    write_catalog(catalog, catalog_path)
+    if metadata_cache:
+        metadata_cache.put_many({
+            f"package_show:{name}": {"success": True, "result": package}
+            for name, package in catalog.items()
+        })
+    if metrics:
+        metrics.increment("catalog_pages", len(pages))
+    logger.info(
+        f"Synced {len(catalog)} packages and {sum(len(p.get('resources') or []) for p in catalog.values())} "
+        f"resources in {len(pages)} request(s), {time.time() - start_time:.1f} seconds."
+        )
+    return catalog
@@ -0,0 +1,531 @@
+import json, logging, os, re, tempfile
+from typing import Optional
+from storage import find_stored, is_stored_csv, logical_name
+from schema_inference import NULL_TOKENS, BOOL_TRUE, ColumnInfo, TableSchema, column_key, infer_file, infer_whole_file, dmy_to_iso
+
+# pyarrow is optional: it's only needed for --output_format parquet/feather.
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    from pyarrow import fs
+except ImportError:
+    pa = None
+
+# Columnar files go under <storage_root>/<format>/package=<package>/year=<year>/, so a whole
+# package (or the whole catalog) reads back as one hive-partitioned dataset.
+FORMATS = {"parquet": ".parquet", "feather": ".arrow"}
+NO_YEAR = "__HIVE_DEFAULT_PARTITION__"
+YEAR_PATTERN = re.compile(r"^(\d{4})[_-]")
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Consolidated datasets go under <storage_root>/datasets/<format>/<package>/, one file per year.
+DATASET_DIR = "datasets"
+UNDATED = "undated"
+# Columns added to every row of a dataset, underscored so they can't clash with the files' own columns.
+# read_package returns its year under the same name, although its directories say year=.
+YEAR_FIELD = "_year"
+PARTITION_KEY = "year"
+RESOURCE_FIELD = "_resource"
+# Files pyarrow's dataset discovery skips, as their names start with an underscore.
+MANIFEST_FILE = "_sources.json"
+METADATA_FILE = "_metadata"
+
+
+def columnar_available(logger: logging.Logger) -> bool:
+    """
+    Checks that pyarrow is installed, logging how to get it if it isn't.
+    """
+    if pa is None:
+        logger.error("Parquet and Feather output need the 'pyarrow' package (uv pip install pyarrow).")
+        return False
+    return True
+
+
+def resource_year(resource_name: str) -> Optional[str]:
+    """
+    Returns the year a resource covers, from the year prefix Open Data BCN puts on file names (e.g. '2025_pad_...csv').
+    """
+    match = YEAR_PATTERN.match(resource_name)
+    return match.group(1) if match else None
+
+
+def columnar_path(storage_root: str, resource: dict, output_format: str) -> str:
+    stem = os.path.splitext(resource['name'])[0]
+    return os.path.join(
+        storage_root,
+        output_format,
+        f"package={resource['package_name']}",
+        f"year={resource_year(resource['name']) or NO_YEAR}",
+        stem + FORMATS[output_format],
+        )
+
+
+def columnar_is_current(storage_root: str, resource: dict, output_format: str) -> bool:
+    """
+    Checks whether a resource's columnar file exists and is at least as new as its CSV.
+    """
+    path = columnar_path(storage_root, resource, output_format)
+    csv_path = find_stored(os.path.join(storage_root, resource['package_name']), resource['name'])
+    return os.path.exists(path) and (
+        csv_path is None or os.path.getmtime(path) >= os.path.getmtime(csv_path)
+        )
+
+
+def arrow_type(pg_type: Optional[str]):
+    return {
+        "BIGINT": pa.int64(),
+        "DOUBLE PRECISION": pa.float64(),
+        "DATE": pa.date32(),
+        "TIMESTAMP": pa.timestamp("us"),
+        "BOOLEAN": pa.bool_(),
+        None: pa.null(),
+    }.get(pg_type, pa.string())
+
+
+def _convert_column(values, column: ColumnInfo, target):
+    """
+    Converts a column of raw strings to its inferred type, reading the same local formats as
+    schema_inference.row_coercer does for the database.
+    """
+    if target == pa.string():
+        return values
+    if target == pa.null():
+        return pa.nulls(len(values))
+    stripped = pc.utf8_trim_whitespace(values)
+    lowered = pc.utf8_lower(stripped)
+    is_null = pc.is_in(lowered, value_set=pa.array(sorted(NULL_TOKENS)))
+    stripped = pc.if_else(is_null, pa.scalar(None, pa.string()), stripped)
+    if column.fmt == "bool":
+        return pc.if_else(is_null, pa.scalar(None, pa.bool_()), pc.is_in(lowered, value_set=pa.array(sorted(BOOL_TRUE))))
+    if column.fmt == "decimal_comma":
+        stripped = pc.replace_substring(pc.replace_substring(stripped, ".", ""), ",", ".")
+    elif column.fmt == "dmy":
+        stripped = pa.array([None if v is None else dmy_to_iso(v) for v in stripped.to_pylist()], pa.string())
+    return pc.cast(stripped, target)
+
+
+def write_columnar(
+        logger: logging.Logger,
+        resource: dict,
+        storage_root: str,
+        output_format: str = "parquet",
+        ) -> bool:
+    """
+    Converts a saved CSV resource into a typed Parquet or Feather file.
+
+    Column types come from the same sample-based inference as the database load (see
+    schema_inference.infer_file), or from the whole file when a later value doesn't fit them, and
+    column names are normalized (see column_key) so that years whose headers drifted still line
+    up when the package is read back as one dataset.
+    The CSV is read and written a block at a time, so the file is never held in memory, and a
+    compressed CSV is decompressed as it's read.
+    Parquet files are zstd-compressed; Feather files are left uncompressed so they can be
+    memory-mapped without copying.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource (dict): A dictionary containing information about the resource.
+        storage_root (str): The root directory where the CSV was saved and the columnar file goes.
+        output_format (str): "parquet" or "feather".
+
+    Returns:
+        A boolean operator indicating if the operation was successful or not.
+    """
+    package_dir = os.path.join(storage_root, resource['package_name'])
+    csv_path = find_stored(package_dir, resource['name']) or os.path.join(package_dir, resource['name'])
+    final_path = columnar_path(storage_root, resource, output_format)
+    try:
+        columns = infer_file(csv_path)
+        try:
+            _write_file(csv_path, final_path, output_format, columns)
+        except pa.ArrowInvalid as e:
+            # Arrow rejected a value: convert again with the whole file's types
+            scanned = infer_whole_file(csv_path)
+            if scanned == columns:
+                raise
+            logger.warning(f"{resource['name']} has values its first rows didn't show ({e}), reading the whole file for its column types.")
+            _write_file(csv_path, final_path, output_format, scanned)
+        logger.info(f"Successfully saved {output_format} file to {final_path}.")
+        return True
+
+    except pa.ArrowInvalid as e:
+        logger.error(f"{resource['name']} has values that don't fit the column types inferred from it: {e}")
+    except Exception as e:
+        logger.exception(f"There was a problem writing {resource['name']} as {output_format}: {e}")
+    return False
+
+
+def _write_file(csv_path: str, final_path: str, output_format: str, columns: list[ColumnInfo]):
+    names = []
+    for column in columns:
+        name = column_key(column.name) or "column"
+        while name in names:
+            name += "_"
+        names.append(name)
+    schema = pa.schema([(name, arrow_type(column.pg_type)) for name, column in zip(names, columns)])
+
+    reader = pa_csv.open_csv(
+        csv_path,
+        read_options=pa_csv.ReadOptions(column_names=names, skip_rows=1, block_size=READ_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in names},
+            strings_can_be_null=False,
+            ),
+        )
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(final_path), prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+        if output_format == "parquet":
+            writer = pq.ParquetWriter(tmp_path, schema, compression="zstd")
+        else:
+            writer = pa.ipc.new_file(tmp_path, schema)
+        with writer:
+            for batch in reader:
+                arrays = [
+                    _convert_column(batch.column(i), column, schema.field(i).type)
+                    for i, column in enumerate(columns)
+                    ]
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+        os.replace(tmp_path, final_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def unify_schemas(schemas: list):
+    """
+    Merges the schemas of a package's files, widening types the way the database load does
+    (integers to decimals, dates to timestamps) and falling back to strings for columns whose
+    types can't be reconciled.
+    """
+    try:
+        return pa.unify_schemas(schemas, promote_options="permissive")
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        pass
+    fields = {}
+    for schema in schemas:
+        for field in schema:
+            fields.setdefault(field.name, []).append(pa.schema([field]))
+    unified = []
+    for name, field_schemas in fields.items():
+        try:
+            unified.append(pa.unify_schemas(field_schemas, promote_options="permissive").field(0))
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            unified.append(pa.field(name, pa.string()))
+    return pa.schema(unified)
+
+
+def read_package(
+        storage_root: str,
+        package: str,
+        output_format: str = "parquet",
+        years: Optional[list[int]] = None,
+        columns: Optional[list[str]] = None,
+        memory_map: bool = True,
+        ):
+    """
+    Reads every year of a package back as one pyarrow Table, in a single scan of the per-resource
+    files written by --output_format (<format>/package=<package>/year=<year>/).
+
+    For analysis, prefer the consolidated dataset built by --dataset and read with read_dataset:
+    its years were written with one schema, so nothing is merged at read time, and every row
+    says which resource it came from. This reader is for packages converted without --dataset.
+
+    Files are memory-mapped by default, and only the requested years (partition pruning) and
+    columns are read. Column types are unified across years, so a column that widened from
+    integers to decimals comes back as decimals for every year. Call .to_pandas() on the result
+    for a DataFrame.
+
+    Args:
+        storage_root (str): The root directory the files were saved under.
+        package (str): The package to read.
+        output_format (str): "parquet" or "feather".
+        years (list[int]): Optional years to read. Reads every year if None.
+        columns (list[str]): Optional (normalized) column names to read. Reads every column if None.
+        memory_map (bool): Memory-map the files instead of reading them into memory.
+
+    Returns:
+        A pyarrow.Table, with the year taken from the partitioning in a '_year' column, as in read_dataset.
+    """
+    package_dir = os.path.join(storage_root, output_format, f"package={package}")
+    options = dict(
+        format="parquet" if output_format == "parquet" else "ipc",
+        partitioning=ds.partitioning(pa.schema([(PARTITION_KEY, pa.int32())]), flavor="hive"),
+        filesystem=fs.LocalFileSystem(use_mmap=memory_map),
+        )
+    dataset = ds.dataset(package_dir, **options)
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+    if schemas:
+        dataset = ds.dataset(package_dir, schema=unify_schemas(schemas + [dataset.partitioning.schema]), **options)
+    year_filter = ds.field(PARTITION_KEY).isin(years) if years else None
+    if columns is not None:
+        columns = [PARTITION_KEY if name == YEAR_FIELD else name for name in columns]
+    table = dataset.to_table(columns=columns, filter=year_filter)
+    return table.rename_columns([YEAR_FIELD if name == PARTITION_KEY else name for name in table.column_names])
+
+
+def dataset_dir(storage_root: str, package: str, output_format: str = "parquet") -> str:
+    return os.path.join(storage_root, DATASET_DIR, output_format, package)
+
+
+def _partition_file(year: Optional[str], output_format: str) -> str:
+    return (year or UNDATED) + FORMATS[output_format]
+
+
+def _package_sources(storage_root: str, package: str) -> dict[str, str]:
+    """
+    The CSV files saved for a package, by resource name, however they're stored.
+    """
+    package_dir = os.path.join(storage_root, package)
+    if not os.path.isdir(package_dir):
+        return {}
+    return {
+        logical_name(entry.name): entry.path
+        for entry in sorted(os.scandir(package_dir), key=lambda entry: entry.name)
+        if entry.is_file() and is_stored_csv(entry.name)
+    }
+
+
+def _load_manifest(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_manifest(path: str, manifest: dict):
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        json.dump(manifest, f, indent=1, sort_keys=True, ensure_ascii=False)
+    os.replace(f.name, path)
+
+
+def _write_partition(
+        path: str,
+        output_format: str,
+        schema,
+        table_schema: TableSchema,
+        year: Optional[str],
+        sources: list[tuple[str, str, list[ColumnInfo]]],
+        ) -> int:
+    """
+    Writes one year of a package dataset from its CSVs, converting every file's columns to the
+    package schema. Columns a file doesn't have are left null. Returns the number of rows written.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    os.close(fd)
+    rows = 0
+    try:
+        if output_format == "parquet":
+            writer = pq.ParquetWriter(tmp_path, schema, compression="zstd")
+        else:
+            writer = pa.ipc.new_file(tmp_path, schema)
+        with writer:
+            for name, csv_path, columns in sources:
+                keys = table_schema.keys_for([column.name for column in columns])
+                reader = pa_csv.open_csv(
+                    csv_path,
+                    read_options=pa_csv.ReadOptions(column_names=keys, skip_rows=1, block_size=READ_BLOCK_SIZE),
+                    convert_options=pa_csv.ConvertOptions(
+                        column_types={key: pa.string() for key in keys},
+                        strings_can_be_null=False,
+                        ),
+                    )
+                for batch in reader:
+                    converted = {
+                        key: _convert_column(batch.column(i), column, schema.field(key).type)
+                        for i, (key, column) in enumerate(zip(keys, columns))
+                        }
+                    arrays = [
+                        converted[field.name] if field.name in converted else pa.nulls(batch.num_rows, field.type)
+                        for field in schema
+                        if field.name not in (YEAR_FIELD, RESOURCE_FIELD)
+                        ]
+                    arrays.append(pa.array([int(year) if year else None] * batch.num_rows, pa.int32()))
+                    arrays.append(pa.array([name] * batch.num_rows, pa.string()))
+                    writer.write_batch(pa.record_batch(arrays, schema=schema))
+                    rows += batch.num_rows
+        os.replace(tmp_path, path)
+        return rows
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_metadata(directory: str, partitions: list[str]):
+    """
+    Gathers the footers of a Parquet dataset's files into a _metadata file, so a reader gets
+    every row group's statistics from one file and can skip whole files without opening them.
+    """
+    path = os.path.join(directory, METADATA_FILE)
+    if not partitions:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    collector = []
+    for file_name in partitions:
+        metadata = pq.read_metadata(os.path.join(directory, file_name))
+        metadata.set_file_path(file_name)
+        collector.append(metadata)
+    tmp_path = f"{path}.tmp"
+    pq.write_metadata(collector[0].schema.to_arrow_schema(), tmp_path, metadata_collector=collector)
+    os.replace(tmp_path, path)
+
+
+def build_package_dataset(
+        logger: logging.Logger,
+        storage_root: str,
+        package: str,
+        output_format: str = "parquet",
+        aliases: Optional[dict[str, str]] = None,
+        ) -> bool:
+    """
+    Consolidates every yearly CSV of a package into one typed dataset, with one file per year.
+
+    The files are merged under one schema, built the same way as the database table (see
+    schema_inference.TableSchema): headers that drifted between years line up on their normalized
+    names (or on aliases), and types are widened until every year fits. Every row gets the
+    resource it came from (_resource) and its year (_year). With Parquet, a _metadata file
+    collects the statistics of every row group, so filters on _year or any other column skip
+    files without opening them.
+
+    A manifest records the CSVs each year was built from. Only years whose CSVs were added,
+    changed or removed are rewritten, unless the package schema changed, which rewrites them all
+    so every file keeps the same schema.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        storage_root (str): The root directory the CSVs were saved under. The dataset goes in
+            <storage_root>/datasets/<format>/<package>/.
+        package (str): The package to consolidate.
+        output_format (str): "parquet" or "feather".
+        aliases (dict): Optional explicit column renames for this package, as {old column name: new column name}.
+
+    Returns:
+        A boolean operator indicating if the dataset is complete and up to date.
+    """
+    sources = _package_sources(storage_root, package)
+    if not sources:
+        logger.warning(f"No CSV files found for {package}, so there's no dataset to build.")
+        return False
+
+    directory = dataset_dir(storage_root, package, output_format)
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    manifest = _load_manifest(manifest_path)
+
+    partitions = {}
+    for name, path in sources.items():
+        stat = os.stat(path)
+        partitions.setdefault(resource_year(name) or UNDATED, {})[name] = [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+    aliases = dict(aliases or {})
+    if (
+            manifest.get("partitions") == partitions
+            and manifest.get("aliases") == aliases
+            and all(os.path.exists(os.path.join(directory, _partition_file(year, output_format))) for year in partitions)
+            ):
+        logger.info(f"The {package} dataset is up to date.")
+        return True
+
+    file_columns = {name: infer_file(path) for name, path in sources.items()}
+    # round two rebuilds with the whole-file types of the years Arrow rejected
+    for scanning in (False, True):
+        table_schema = TableSchema(aliases=aliases)
+        for columns in file_columns.values():
+            table_schema.merge(columns)
+        fields = [[key, pg_type or "TEXT"] for key, (_, pg_type) in table_schema.columns.items()]
+        schema = pa.schema(
+            [(key, arrow_type(pg_type)) for key, pg_type in fields]
+            + [(YEAR_FIELD, pa.int32()), (RESOURCE_FIELD, pa.string())]
+            )
+        rebuild_all = manifest.get("fields") != fields or manifest.get("aliases") != aliases
+        if rebuild_all and manifest:
+            logger.info(f"The {package} schema changed, rewriting every year of its dataset.")
+
+        built = {}
+        failed, unfit = [], []
+        for year, signatures in sorted(partitions.items()):
+            path = os.path.join(directory, _partition_file(year, output_format))
+            if not rebuild_all and manifest.get("partitions", {}).get(year) == signatures and os.path.exists(path):
+                built[year] = signatures
+                continue
+            try:
+                rows = _write_partition(
+                    path,
+                    output_format,
+                    schema,
+                    table_schema,
+                    None if year == UNDATED else year,
+                    [(name, sources[name], file_columns[name]) for name in signatures],
+                    )
+                built[year] = signatures
+                logger.info(f"Rebuilt the {year} part of the {package} dataset: {rows} rows from {len(signatures)} file(s).")
+            except pa.ArrowInvalid as e:
+                if scanning:
+                    logger.error(f"{year} of {package} has values that don't fit the column types inferred from its files: {e}")
+                    failed.append(year)
+                else:
+                    logger.warning(f"{year} of {package} has values its first rows didn't show ({e}), reading its whole files for their column types.")
+                    unfit.append(year)
+            except Exception as e:
+                logger.exception(f"There was a problem building the {year} part of the {package} dataset: {e}")
+                failed.append(year)
+        if not unfit:
+            break
+        for year in unfit:
+            for name in partitions[year]:
+                file_columns[name] = infer_whole_file(sources[name])
+        # what's on disk now, for the second round to compare against
+        manifest = {"fields": fields, "aliases": aliases, "partitions": built}
+
+    # years that failed or whose files are gone would leave the dataset with an older schema or stale rows
+    for file_name in os.listdir(directory):
+        stem, extension = os.path.splitext(file_name)
+        if extension == FORMATS[output_format] and stem not in built:
+            os.remove(os.path.join(directory, file_name))
+    if output_format == "parquet":
+        _write_metadata(directory, [_partition_file(year, output_format) for year in sorted(built)])
+    _save_manifest(manifest_path, {"fields": fields, "aliases": aliases, "partitions": built})
+
+    if failed:
+        logger.error(f"The {package} dataset is missing {failed}, they'll be built again on the next run.")
+        return False
+    logger.info(f"The {package} dataset is up to date in {directory}.")
+    return True
+
+
+def read_dataset(
+        storage_root: str,
+        package: str,
+        output_format: str = "parquet",
+        years: Optional[list[int]] = None,
+        columns: Optional[list[str]] = None,
+        memory_map: bool = True,
+        ):
+    """
+    Reads a package dataset built by build_package_dataset as one pyarrow Table. This is the
+    layout to analyse a package with: the schema is already unified, so nothing is merged at read
+    time, and only the requested years and columns are read. Call .to_pandas() on the result for
+    a DataFrame.
+
+    Args:
+        storage_root (str): The root directory the dataset was built under.
+        package (str): The package to read.
+        output_format (str): "parquet" or "feather".
+        years (list[int]): Optional years to read. Reads every year if None.
+        columns (list[str]): Optional column names to read. Reads every column if None.
+        memory_map (bool): Memory-map the files instead of reading them into memory.
+    """
+    directory = dataset_dir(storage_root, package, output_format)
+    filesystem = fs.LocalFileSystem(use_mmap=memory_map)
+    metadata_path = os.path.join(directory, METADATA_FILE)
+    if output_format == "parquet" and os.path.exists(metadata_path):
+        dataset = ds.parquet_dataset(metadata_path, filesystem=filesystem)
+    else:
+        dataset = ds.dataset(directory, format="parquet" if output_format == "parquet" else "ipc", filesystem=filesystem)
+    year_filter = ds.field(YEAR_FIELD).isin(years) if years else None
+    return dataset.to_table(columns=columns, filter=year_filter)
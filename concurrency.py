@@ -0,0 +1,139 @@
+import threading
+from contextlib import contextmanager
+from typing import Optional
+from urllib.parse import urlparse
+from retry_scheduler import HostHealth
+
+
+class HostLimiter:
+    """
+    Caps the number of simultaneous requests made to any one host.
+
+    Open Data BCN starts refusing connections if it gets hammered, so every download
+    acquires a slot for the host in its URL before the request goes out.
+
+    Each host also gets a HostHealth, which spaces requests out when the server starts
+    answering 429/5xx or slowly, and refuses requests outright (CircuitOpen) during an outage.
+    Callers report how each request went with record().
+    """
+
+    def __init__(self, max_per_host: int = 4, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.max_per_host = max_per_host
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._semaphores = {}
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+    def health(self, url: str) -> HostHealth:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._health:
+                self._health[host] = HostHealth(failure_threshold=self.failure_threshold, cooldown=self.cooldown)
+            return self._health[host]
+
+    @contextmanager
+    def slot(self, url: str):
+        """
+        Blocks until a request slot for the URL's host is free, and releases it on exit.
+        Raises CircuitOpen if the host's circuit breaker is open.
+        """
+        self.health(url).before_request()
+        semaphore = self._get_semaphore(urlparse(url).netloc)
+        with semaphore:
+            yield
+
+    def record(self, url: str, status: Optional[int], elapsed: Optional[float] = None, retry_after: Optional[float] = None):
+        """
+        Reports the outcome of a request to the URL's host (see HostHealth.record).
+        """
+        self.health(url).record(status, elapsed, retry_after)
+
+
+class DownloadBudget:
+    """
+    A global cap on in-flight downloads that is shared fairly between packages.
+
+    Each package running at the same time registers itself, and while other packages are
+    waiting for a slot no package can hold more than its fair share of the budget.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self._in_use = 0
+        self._held = {}
+        self._waiting = {}
+        self._condition = threading.Condition()
+
+    def register(self, owner: str):
+        with self._condition:
+            self._held.setdefault(owner, 0)
+            self._waiting.setdefault(owner, 0)
+
+    def unregister(self, owner: str):
+        with self._condition:
+            self._held.pop(owner, None)
+            self._waiting.pop(owner, None)
+            self._condition.notify_all()
+
+    def _fair_share(self) -> int:
+        active = max(1, len(self._held))
+        return max(1, self.total // active)
+
+    def _can_acquire(self, owner: str) -> bool:
+        if self._in_use >= self.total:
+            return False
+        others_waiting = any(n for o, n in self._waiting.items() if o != owner)
+        return not others_waiting or self._held.get(owner, 0) < self._fair_share()
+
+    @contextmanager
+    def slot(self, owner: str):
+        """
+        Blocks until the owner can take a slot from the budget, and gives it back on exit.
+        """
+        with self._condition:
+            self._held.setdefault(owner, 0)
+            self._waiting[owner] = self._waiting.get(owner, 0) + 1
+            self._condition.wait_for(lambda: self._can_acquire(owner))
+            self._waiting[owner] -= 1
+            self._held[owner] += 1
+            self._in_use += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_use -= 1
+                if owner in self._held:
+                    self._held[owner] -= 1
+                self._condition.notify_all()
+
+
+class PackageLimiter:
+    """
+    The limiter handed to a single package's pipeline when several packages run at once.
+    A request takes a slot from the shared download budget first, then a slot for its host.
+    """
+
+    def __init__(self, package: str, budget: DownloadBudget, host_limiter: HostLimiter = None):
+        self.package = package
+        self.budget = budget
+        self.host_limiter = host_limiter
+
+    @contextmanager
+    def slot(self, url: str):
+        with self.budget.slot(self.package):
+            if self.host_limiter:
+                with self.host_limiter.slot(url):
+                    yield
+            else:
+                yield
+
+    def record(self, url: str, status: Optional[int], elapsed: Optional[float] = None, retry_after: Optional[float] = None):
+        if self.host_limiter:
+            self.host_limiter.record(url, status, elapsed, retry_after)
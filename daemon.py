@@ -0,0 +1,218 @@
+import logging, threading, time, requests
+from typing import Callable, Optional, TYPE_CHECKING
+from concurrency import HostLimiter
+from job_queue import JobQueue, DONE
+from metadata_cache import MetadataCache
+from pipeline_functions import fetch_package_metadata
+from reporting import Report, compile_reports
+from retry_scheduler import backoff_delay
+
+# db_load pulls in psycopg2, so it's only imported for type checking here.
+if TYPE_CHECKING:
+    from db_load import ParallelLoader
+
+
+def poll_packages(
+        logger: logging.Logger,
+        queue: JobQueue,
+        package_list: list[str],
+        metadata_cache: Optional[MetadataCache] = None,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        catalog: Optional[dict[str, dict]] = None,
+        ) -> int:
+    """
+    Checks Open Data BCN for packages that changed since they were last synced.
+
+    Packages new to the queue are added as pending. For packages that are done, a fresh
+    package_show is compared with the metadata_modified stamp they were synced against, and the
+    ones that changed go back to pending. The fresh payload is put in the metadata cache, so the
+    run that follows doesn't have to ask for it again. Packages found in a freshly synced catalog
+    (see catalog_sync.sync_catalog) are compared against it instead, without a request of their own.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        queue (JobQueue): The job queue.
+        package_list (list[str]): Names of the packages to keep in sync.
+        metadata_cache (MetadataCache): Optional on-disk cache of package_show payloads.
+        limiter (HostLimiter): Optional per-host limiter.
+        session (requests.Session): Optional pooled session.
+        catalog (dict): Optional package name -> package metadata from a catalog sync.
+
+    Returns:
+        The number of packages that were added or changed.
+    """
+    changed = 0
+    for package in package_list:
+        if queue.add(package):
+            changed += 1
+            continue
+        job = queue.job(package)
+        if job["state"] != DONE:
+            continue
+        if catalog and package in catalog:
+            data = {"success": True, "result": catalog[package]}
+        else:
+            data = fetch_package_metadata(
+                logger,
+                package,
+                Report(package, time.time()),
+                package_retries=1,
+                limiter=limiter,
+                session=session,
+                )
+        if data is None:
+            # it's checked again at the next poll
+            continue
+        revision = (data.get('result') or {}).get('metadata_modified')
+        if revision is not None and revision == job["revision"]:
+            continue
+        logger.info(f"The {package} package changed upstream, queueing it.")
+        if metadata_cache:
+            metadata_cache.put(f"package_show:{package}", data)
+        queue.mark_changed(package)
+        changed += 1
+    return changed
+
+
+def run_queued(
+        logger: logging.Logger,
+        queue: JobQueue,
+        run: Callable[[list[str]], list[Report]],
+        retry_delay: float = 60.0,
+        max_retry_delay: float = 3600.0,
+        loader: Optional["ParallelLoader"] = None,
+        ) -> list[Report]:
+    """
+    Claims every job that is ready, runs it and stores how it went.
+
+    A package is done when its resource list was retrieved, none of its resources failed and,
+    with a database loader, it was loaded. Otherwise, or if the run raises, it's marked as failed and tried again after an exponential backoff. Resources
+    that were already downloaded aren't downloaded again on the retry (see sync_state.SyncState).
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        queue (JobQueue): The job queue.
+        run (Callable): Runs a list of packages and returns their reports, e.g. scheduler.run_packages.
+        retry_delay (float): Seconds before the first retry of a failed package, doubled for every retry after that.
+        max_retry_delay (float): Longest wait before retrying a failed package.
+        loader (db_load.ParallelLoader): Optional database loader the run submits packages to.
+            Their loads are waited for before the jobs are marked done.
+
+    Returns:
+        The reports of the packages that were run.
+    """
+    packages = queue.claim()
+    if not packages:
+        return []
+    logger.info(f"Running {len(packages)} queued package(s): {packages}")
+    try:
+        reports = run(packages)
+        loaded = loader.collect(packages) if loader else {}
+    except Exception as e:
+        logger.exception(f"Running {packages} failed: {e}")
+        # the claimed jobs go back in the queue, to be retried like any other failure
+        for package in packages:
+            queue.fail(package, f"unexpected error: {e}", backoff_delay(queue.job(package)["attempts"], retry_delay, max_retry_delay))
+        return []
+    by_package = {report.package_name: report for report in reports}
+
+    for package in packages:
+        report = by_package.get(package)
+        if report is None:
+            error = "the package didn't finish"
+        else:
+            queue.record_resources(
+                package,
+                report.resources_success,
+                [resource['name'] for resource in report.resources_fail],
+                )
+            if report.package_success and not report.resources_fail and loaded.get(package) is not False:
+                queue.finish(package, report.revision)
+                continue
+            if not report.package_success:
+                error = f"couldn't get the resource list (response code {report.package_response_code})"
+            elif report.resources_fail:
+                error = f"{len(report.resources_fail)} resource(s) failed"
+            else:
+                error = "the database load failed"
+        delay = backoff_delay(queue.job(package)["attempts"], retry_delay, max_retry_delay)
+        logger.warning(f"{package}: {error}. Trying again in {delay / 60:.0f} minute(s).")
+        queue.fail(package, error, delay)
+
+    return reports
+
+
+def run_daemon(
+        logger: logging.Logger,
+        queue: JobQueue,
+        get_package_list: Callable[[], list[str]],
+        run: Callable[[list[str]], list[Report]],
+        poll: Callable[[list[str]], int],
+        poll_interval: float = 3600.0,
+        retry_delay: float = 60.0,
+        max_retry_delay: float = 3600.0,
+        stop: Optional[threading.Event] = None,
+        after_cycle: Optional[Callable[[], None]] = None,
+        loader: Optional["ParallelLoader"] = None,
+        ):
+    """
+    Keeps a set of packages in sync until stop is set.
+
+    Everything the process keeps warm (the HTTP session, the metadata cache, database
+    connections) lives in the run and poll callables, so it's reused from one cycle to the next
+    instead of being rebuilt every time. The job queue is on disk: jobs a previous process left
+    in flight are picked up again on startup, and packages that were done stay done until they
+    change upstream. A cycle that raises is logged and tried again after retry_delay, with the
+    jobs it had claimed put back in the queue.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        queue (JobQueue): The job queue.
+        get_package_list (Callable): Returns the packages to keep in sync. It's called at every
+            poll, so packages that get a matching tag later on are picked up too.
+        run (Callable): Runs a list of packages and returns their reports, e.g. scheduler.run_packages.
+        poll (Callable): Checks a list of packages for upstream changes, e.g. poll_packages.
+        poll_interval (float): Seconds between polls.
+        retry_delay (float): Seconds before the first retry of a failed package.
+        max_retry_delay (float): Longest wait before retrying a failed package.
+        stop (threading.Event): Set it to stop the daemon once the running packages have finished.
+        after_cycle (Callable): Optional function called after every poll-and-run cycle, e.g. to export metrics.
+        loader (db_load.ParallelLoader): Optional database loader the run submits packages to (see run_queued).
+    """
+    stop = stop or threading.Event()
+    recovered = queue.recover()
+    if recovered:
+        logger.info(f"Picking up {recovered} package(s) left unfinished by the last run.")
+
+    next_poll = 0.0
+    while not stop.is_set():
+        try:
+            if time.time() >= next_poll:
+                changed = poll(get_package_list())
+                logger.info(f"Checked for changes: {changed} package(s) to sync.")
+                next_poll = time.time() + poll_interval
+
+            reports = run_queued(logger, queue, run, retry_delay, max_retry_delay, loader=loader)
+            if reports:
+                summary = compile_reports(reports)
+                logger.info(
+                    f"Synced {len(summary['resources_success'])} resource(s), {len(summary['resources_fail'])} failed, "
+                    f"{summary['skipped']} unchanged. Queue: {queue.counts()}"
+                    )
+            if after_cycle:
+                after_cycle()
+            wake_at = min(next_poll, queue.next_due() or next_poll)
+        except Exception as e:
+            # a failed cycle (a full disk, a database that went away) mustn't stop the daemon
+            logger.exception(f"The sync cycle failed, trying again in {retry_delay / 60:.0f} minute(s): {e}")
+            try:
+                recovered = queue.recover()
+                if recovered:
+                    logger.info(f"Put {recovered} claimed package(s) back in the queue.")
+            except Exception as e:
+                logger.error(f"Couldn't put the claimed packages back in the queue, they're picked up at the next start: {e}")
+            wake_at = time.time() + retry_delay
+        stop.wait(max(0.0, wake_at - time.time()))
+
+    logger.info("Daemon stopped.")
@@ -1,12 +1,35 @@
 from io import StringIO
-from typing import Optional
-import logging, requests, os, csv
-import pandas as pd
+from itertools import chain
+from typing import Optional, Iterator, TYPE_CHECKING
+import logging, requests, os, csv, codecs, re, tempfile, json, hashlib
+from retry_scheduler import RetryLater
+from blob_store import BlobStore
+from storage import stored_name, compressed_writer, remove_other_versions
 
+if TYPE_CHECKING:
+    import pandas as pd
+
+# The CKAN action API of Open Data BCN. BCN_ETL_CKAN_URL points the pipeline at another CKAN
+# instance instead, e.g. the local stand-in server the benchmarks run against.
+CKAN_API_URL = os.getenv("BCN_ETL_CKAN_URL", 'https://opendata-ajuntament.barcelona.cat/data/api/action').rstrip("/")
+PACKAGE_SHOW_URL = f"{CKAN_API_URL}/package_show"
+PACKAGE_SEARCH_URL = f"{CKAN_API_URL}/package_search"
+DATASTORE_SEARCH_URL = f"{CKAN_API_URL}/datastore_search"
+CHUNK_SIZE = 1024 * 1024
+
+# How much of the start of a file is used to guess its encoding and CSV dialect.
+SNIFF_SIZE = 64 * 1024
+# Files that aren't UTF-8 are almost always Windows Latin-1.
+FALLBACK_ENCODING = "cp1252"
+DELIMITERS = ",;\t|"
+SINGLE_QUOTED_FIELD = re.compile(r"(?:^|[,;\t|])'[^'\n]*'(?=[,;\t|]|\r?$)", re.MULTILINE)
+# Bad rows logged one by one per file; the rest are only counted.
+MAX_REPORTED_ROWS = 20
 
 def request_resource_library(
         logger: logging.Logger, 
-        package_name: str
+        package_name: str,
+        session: Optional[requests.Session] = None,
         ) -> Optional[requests.Response]:
     """
     Requests the resource library for a particular package from Open Data BCN.
@@ -14,15 +37,14 @@ def request_resource_library(
     Args: 
         logger (logging.Logger): A logging instance for recording events.
         package_name (str): Name of an Open Data BCN package containing multiple resources.
+        session (requests.Session): Optional pooled session (see http_client.get_session). Uses a one-off connection if None.
 
     Returns:
         The requests.Response object with all the info from the response
     """
 
-    url = 'https://opendata-ajuntament.barcelona.cat/data/api/action/package_show'
-    
     try:
-        response = requests.get(url, params={'id': package_name}, timeout=10)
+        response = (session or requests).get(PACKAGE_SHOW_URL, params={'id': package_name}, timeout=10)
         return response
     
     except requests.exceptions.ConnectTimeout:
@@ -35,9 +57,90 @@ def request_resource_library(
         return None
 
 
+def request_catalog_page(
+        logger: logging.Logger,
+        start: int,
+        rows: int,
+        session: Optional[requests.Session] = None,
+        ) -> Optional[requests.Response]:
+    """
+    Requests one page of the Open Data BCN catalog from package_search: up to `rows` packages,
+    with their tags and resources, starting at `start`. Pages are sorted by name, so they don't
+    overlap when they're requested at the same time.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        start (int): Offset of the first package on the page.
+        rows (int): Number of packages on the page.
+        session (requests.Session): Optional pooled session. Uses a one-off connection if None.
+
+    Returns:
+        The requests.Response object, or None if no response was received.
+    """
+    try:
+        return (session or requests).get(
+            PACKAGE_SEARCH_URL,
+            params={'q': '*:*', 'rows': rows, 'start': start, 'sort': 'name asc'},
+            timeout=60,
+            )
+    except requests.exceptions.Timeout:
+        logger.error(f"Request for the catalog page starting at {start} timed out.")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Failed to fetch the catalog page starting at {start}: {e.__class__.__name__} - {e}")
+        logger.debug("Full exception details:", exc_info=True)
+    return None
+
+
+def request_datastore_page(
+        logger: logging.Logger,
+        resource_id: str,
+        offset: int,
+        limit: int,
+        fields: Optional[list[str]] = None,
+        filters: Optional[dict] = None,
+        session: Optional[requests.Session] = None,
+        ) -> Optional[requests.Response]:
+    """
+    Requests one page of a resource's rows from CKAN's DataStore (datastore_search), as CSV text.
+    The server does the column and row selection, so only the requested data is sent.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource_id (str): The resource's id.
+        offset (int): Number of rows to skip.
+        limit (int): Number of rows on the page. 0 only returns the column list and the row count.
+        fields (list[str]): Optional columns to return, in this order. All of them if None.
+        filters (dict): Optional column -> value (or list of values) that rows must match.
+        session (requests.Session): Optional pooled session. Uses a one-off connection if None.
+
+    Returns:
+        The requests.Response object, or None if no response was received.
+    """
+    params = {
+        'resource_id': resource_id,
+        'offset': offset,
+        'limit': limit,
+        'records_format': 'csv',
+        # a stable order, so pages requested at the same time don't overlap
+        'sort': '_id',
+    }
+    if fields:
+        params['fields'] = ",".join(fields)
+    if filters:
+        params['filters'] = json.dumps(filters)
+    try:
+        return (session or requests).get(DATASTORE_SEARCH_URL, params=params, timeout=60)
+    except requests.exceptions.Timeout:
+        logger.error(f"Request for rows {offset}-{offset + limit} of resource {resource_id} timed out.")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Failed to fetch rows {offset}-{offset + limit} of resource {resource_id}: {e.__class__.__name__} - {e}")
+        logger.debug("Full exception details:", exc_info=True)
+    return None
+
+
 def process_resource_library(
         logger: logging.Logger, 
-        response: requests.Response,
+        response: requests.Response | dict,
         package: str,
         ) -> list[dict]:
     
@@ -46,12 +149,13 @@ def process_resource_library(
 
     Args:
         logger (logging.Logger): A logging instance for recording events.
-        response (requests.Response): A raw response object containing package information.
+        response (requests.Response | dict): A raw response object containing package information, 
+            or its already decoded JSON payload (e.g. from the metadata cache).
         package (str): The name of the package being processed.
     Returns:
         A list of dictionaries.
     """
-    data = response.json()
+    data = response if isinstance(response, dict) else response.json()
 
     try:
         resources = data['result']['resources']
@@ -81,7 +185,12 @@ def token_required(logger: logging.Logger, resource: dict) -> bool:
     else:
         return False
 
-def download_resource(logger: logging.Logger, resource: dict) -> Optional[requests.Response]:
+def download_resource(
+        logger: logging.Logger, 
+        resource: dict,
+        session: Optional[requests.Session] = None,
+        headers: Optional[dict] = None,
+        ) -> Optional[requests.Response]:
 
     """
     Downloads a resource from the Open Data BCN respository as a requests.Response object.
@@ -89,9 +198,12 @@ def download_resource(logger: logging.Logger, resource: dict) -> Optional[reques
     Args:
         logger (logging.Logger): A logging instance for recording events.
         resource (dict): A dictionary with information about the resource.
+        session (requests.Session): Optional pooled session (see http_client.get_session). Uses a one-off connection if None.
+        headers (dict): Optional extra request headers, e.g. If-None-Match for a conditional request.
 
     Returns:
-        A requests.Response object where ".content" is the data for the CSV file.
+        A requests.Response object opened in streaming mode. The body hasn't been read yet, 
+        so it should be consumed with partial_download.stream_to_part (or ".content").
     """
 
 
@@ -102,7 +214,7 @@ def download_resource(logger: logging.Logger, resource: dict) -> Optional[reques
     url = resource['url']
 
     try:
-        response = requests.get(url, timeout=10)        
+        response = (session or requests).get(url, headers=headers, timeout=10, stream=True)
         return response
     except requests.exceptions.ConnectTimeout:
         logger.error(f"Connection to Open Data BCN timed out while requesting {resource['name']}.")
@@ -119,30 +231,20 @@ def convert_to_csv(
         response: requests.Response
         ) -> Optional[StringIO]:
     """
-    Converts a response.Requests object to a CSV StringIO object.
+    Converts a response.Requests object to a CSV StringIO object, decoding and validating it
+    in one pass (see decode_csv_chunks).
     """
     try:
-        try:
-            decoded = response.content.decode("utf-8")
-        except UnicodeDecodeError:
-            logger.warning("UTF-8 decoding failed, retrying with UTF-16.")
-            decoded = response.content.decode('utf-16')
-
-        csv_data = StringIO(decoded)
-        reader = csv.reader(csv_data)
+        csv_data = StringIO("".join(decode_csv_chunks(logger, response.iter_content(chunk_size=CHUNK_SIZE))))
+        if not csv_data.getvalue():
+            logger.warning("CSV appears to be empty.")
+            return None
 
-        #simple check to see if the file is actually a CSV. if not, it throws an error.
-        first_row = next(reader)
-        
         logger.info(f"Successfully converted response object to a CSV file.")
         return csv_data
 
     except csv.Error as e:
-        logger.excption(f"Response content is not valid CSV format: {e}")
-        return None
-    
-    except StopIteration:
-        logger.warning("CSV appears to be empty.")
+        logger.exception(f"Response content is not valid CSV format: {e}")
         return None
 
     except Exception as e:
@@ -194,8 +296,346 @@ def save_csv(logger: logging.Logger,
         return False
 
 
+def detect_encoding(logger: logging.Logger, first_chunk: bytes) -> str:
+    """
+    Works out the text encoding of a file from its first chunk only.
+
+    A BOM settles it. Without one, UTF-16 is recognised by its zero bytes, then UTF-8 is tried,
+    then Windows Latin-1 (cp1252), and plain Latin-1 as a last resort, since it decodes anything.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        first_chunk (bytes): The first bytes of the file.
+
+    Returns:
+        The name of a codec that can decode the file.
+    """
+    if first_chunk.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if first_chunk.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    prefix = first_chunk[:SNIFF_SIZE]
+    if prefix.count(0) > len(prefix) // 4:
+        # ASCII text in UTF-16 has a zero byte in every other position
+        return "utf-16-le" if prefix[1::2].count(0) > prefix[0::2].count(0) else "utf-16-be"
+    try:
+        # final=False so a multi-byte character cut off at the end of the chunk isn't an error
+        codecs.getincrementaldecoder("utf-8")().decode(first_chunk, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    try:
+        first_chunk.decode(FALLBACK_ENCODING)
+        logger.warning(f"The file isn't UTF-8, decoding it as {FALLBACK_ENCODING}.")
+        return FALLBACK_ENCODING
+    except UnicodeDecodeError:
+        logger.warning("The file isn't UTF-8 or cp1252, decoding it as latin-1.")
+        return "latin-1"
+
+
+def sniff_dialect(sample: str) -> type[csv.Dialect]:
+    """
+    Works out the delimiter and quote character of a CSV from its first lines.
+
+    Each candidate delimiter is tried on the sample, and the one that splits the header into the
+    most columns with every row the same width as the header wins, ties going to the comma.
+    csv.Sniffer isn't used because it's too easily fooled by commas in Catalan decimals.
+    """
+    lines = sample.splitlines(keepends=True)
+    if len(lines) > 1 and not sample.endswith(("\n", "\r")):
+        # the last line is cut off
+        lines.pop()
+    quotechar = '"'
+    # apostrophes are everywhere in Catalan names (l'Eixample), so single quotes only count
+    # when they wrap whole fields
+    if '"' not in sample and len(SINGLE_QUOTED_FIELD.findall(sample)) >= 2:
+        quotechar = "'"
+
+    best, best_score = ",", (0, 0)
+    for delimiter in DELIMITERS:
+        try:
+            rows = [row for row in csv.reader(lines, delimiter=delimiter, quotechar=quotechar) if row]
+        except csv.Error:
+            continue
+        if not rows or len(rows[0]) < 2:
+            continue
+        consistent = sum(len(row) == len(rows[0]) for row in rows) / len(rows)
+        score = (consistent, len(rows[0]))
+        if score > best_score:
+            best, best_score = delimiter, score
+
+    class Dialect(csv.excel):
+        pass
+    Dialect.delimiter = best
+    Dialect.quotechar = quotechar
+    return Dialect
+
+
+def iter_file_chunks(file_path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Reads a file from disk in chunks, so it can go through the same path as a streamed download.
+    """
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def decode_text_chunks(logger: logging.Logger, chunks: Iterator[bytes]) -> Iterator[str]:
+    """
+    Decodes raw byte chunks into text one chunk at a time, with the encoding detected from the first chunk.
+
+    If the first chunk was plain ASCII, it can't tell UTF-8 from cp1252, so the decoder switches to
+    cp1252 at the first byte that isn't UTF-8. Otherwise bytes that don't decode are replaced with
+    U+FFFD, and the rows they're in are reported by validate_csv_text.
+    """
+    first_chunk = next(chunks, b"")
+    if not first_chunk:
+        return
+
+    encoding = detect_encoding(logger, first_chunk)
+    undecided = encoding == "utf-8" and first_chunk.isascii()
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chain([first_chunk], chunks):
+        try:
+            text = decoder.decode(chunk)
+        except UnicodeDecodeError:
+            if undecided:
+                logger.warning(f"The file isn't UTF-8 after all, decoding the rest of it as {FALLBACK_ENCODING}.")
+                pending = decoder.getstate()[0]
+                decoder = codecs.getincrementaldecoder(FALLBACK_ENCODING)(errors="replace")
+                text = decoder.decode(pending + chunk)
+            else:
+                decoder.errors = "replace"
+                text = decoder.decode(chunk)
+        undecided = undecided and chunk.isascii()
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def iter_text_lines(text_chunks: Iterator[str]) -> Iterator[str]:
+    """
+    Splits text chunks into lines, keeping the line endings, for csv.reader.
+    """
+    rest = ""
+    for text in text_chunks:
+        lines = (rest + text).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if rest:
+        yield rest
+
+
+def validate_csv_text(
+        logger: logging.Logger, 
+        text_chunks: Iterator[str], 
+        name: str = "the file",
+        chunk_size: int = CHUNK_SIZE,
+        ) -> Iterator[str]:
+    """
+    Rewrites decoded CSV text as standard comma-separated CSV, checking every row as it goes by.
+
+    The delimiter and quoting are sniffed from the start of the file. Rows that don't have as
+    many fields as the header, or that can't be parsed, are left out and logged with their line
+    number, so one bad row doesn't sink the whole file (a COPY would reject all of it). A trailing
+    delimiter at the end of a row is tolerated.
+
+    Raises:
+        csv.Error if the first line isn't a CSV header.
+    """
+    first_text = next(text_chunks, None)
+    if first_text is None:
+        return
+
+    dialect = sniff_dialect(first_text[:SNIFF_SIZE])
+    if dialect.delimiter != ",":
+        logger.info(f"{name} is delimited with {dialect.delimiter!r}, rewriting it with commas.")
+    replaced = False
+
+    def watch(texts):
+        # rows are only searched for U+FFFD once a chunk has had one
+        nonlocal replaced
+        for text in texts:
+            replaced = replaced or "\ufffd" in text
+            yield text
+
+    reader = csv.reader(iter_text_lines(watch(chain([first_text], text_chunks))), dialect)
+    #simple check to see if the file is actually a CSV. if not, it throws an error.
+    header = next(reader, None)
+    if not header or header == [""]:
+        raise csv.Error("the first line is empty")
+
+    out = StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(header)
+    width = len(header)
+    bad_rows = 0
+    undecodable = 0
+
+    def report(message: str):
+        if bad_rows + undecodable <= MAX_REPORTED_ROWS:
+            logger.warning(f"{name}, line {reader.line_num}: {message}")
+
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            break
+        except csv.Error as e:
+            bad_rows += 1
+            report(f"left out, it can't be parsed ({e})")
+            continue
+        if not row:
+            continue
+        if len(row) == width + 1 and row[-1] == "":
+            row.pop()
+        if len(row) != width:
+            bad_rows += 1
+            report(f"left out, it has {len(row)} fields instead of {width}")
+            continue
+        if replaced and any("\ufffd" in field for field in row):
+            undecodable += 1
+            report("has bytes that couldn't be decoded, replaced with U+FFFD")
+        writer.writerow(row)
+        if out.tell() >= chunk_size:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+
+    if out.tell():
+        yield out.getvalue()
+    if bad_rows or undecodable:
+        logger.warning(f"{name}: {bad_rows} bad row(s) left out, {undecodable} row(s) with undecodable bytes.")
+
+
+def decode_csv_chunks(logger: logging.Logger, chunks: Iterator[bytes], name: str = "the file") -> Iterator[str]:
+    """
+    Turns raw byte chunks into validated UTF-8 CSV text chunks, one chunk at a time
+    (see decode_text_chunks and validate_csv_text).
+
+    The encoding and CSV dialect are detected from the start of the file only, so only a chunk or
+    so is held in memory at a time no matter how big the file is. Yields nothing for an empty file.
+
+    Raises:
+        csv.Error if the first line isn't a CSV header.
+    """
+    return validate_csv_text(logger, decode_text_chunks(logger, chunks), name=name)
+
+
+def write_text_chunks(
+        logger: logging.Logger,
+        resource: dict,
+        text_chunks: Iterator[str],
+        path: str = "./",
+        blob_store: Optional[BlobStore] = None,
+        upstream_hash: Optional[str] = None,
+        compression: str = "none",
+        ) -> bool:
+    """
+    Writes a CSV to disk from an iterator of already decoded text chunks.
+
+    The data is written to a temporary file in the package directory, which is renamed to the
+    final name once the whole file has been written. It can be compressed as it's written (see
+    storage.compressed_writer), in which case the name gets a .gz or .zst suffix. With a blob store,
+    the file is hashed as it's written and stored through it, so content that's already on disk
+    isn't kept twice.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource (dict): A dictionary containing information about the resource.
+        text_chunks (Iterator[str]): The file's text, e.g. from decode_csv_chunks().
+        path (str): Parameter provided by user indicating where to save file (default: root)
+        blob_store (BlobStore): Optional content-addressed store the file is saved through (see blob_store.BlobStore).
+        upstream_hash (str): With a blob store, the hash CKAN published for the file, so the next
+            resource with that hash can be linked without downloading it. Leave None for anything
+            that isn't the whole published file.
+        compression (str): "gzip" or "zstd" to store the file compressed, "none" for plain text.
+
+    Returns:
+        A boolean operator indicating if the operation was successful or not.
+    """
+    logger.info("Streaming CSV to disk...")
+
+    dir_path = os.path.join(
+        path, 
+        resource['package_name'],
+        )
+    
+    try:
+        os.makedirs(dir_path, exist_ok=True)
+    except PermissionError as e:
+        logger.error(f"Sorry, you don't have permission to create the directory {dir_path}: {e}")
+        return False
+    
+    final_path = os.path.join(dir_path, stored_name(resource['name'], compression))
+    tmp_path = None
+
+    try:
+        first_text = next(text_chunks, None)
+        if first_text is None:
+            logger.warning("CSV appears to be empty.")
+            return False
+
+        # the content is hashed before compression, behind the suffix of how it's stored, so the same
+        # text saved the same way always lands on the same blob (plain files hash as just their content)
+        digest = hashlib.sha256(stored_name("", compression).encode()) if blob_store else None
+        with tempfile.NamedTemporaryFile(
+            "wb", 
+            dir=dir_path, 
+            prefix=f".{resource['name']}.", 
+            suffix=".tmp", 
+            delete=False,
+            ) as f:
+            tmp_path = f.name
+            with compressed_writer(f, compression) as writer:
+                for text in chain((first_text,), text_chunks):
+                    data = text.encode("utf-8")
+                    writer.write(data)
+                    if digest:
+                        digest.update(data)
+
+        duplicate = False
+        if blob_store:
+            duplicate = blob_store.commit(
+                logger,
+                tmp_path,
+                digest.hexdigest(),
+                final_path,
+                upstream_hash=stored_name(upstream_hash, compression) if upstream_hash else None,
+                )
+        else:
+            os.replace(tmp_path, final_path)
+        remove_other_versions(dir_path, resource['name'], keep=final_path)
+        if duplicate:
+            logger.info(f"{resource['name']} has the same content as a file already stored, linked {final_path} to it.")
+        else:
+            logger.info(f"Succesfully saved CSV file to {final_path}.")
+        return True
+
+    except csv.Error as e:
+        logger.exception(f"Response content is not valid CSV format: {e}")
+    except UnicodeDecodeError as e:
+        logger.error(f"Could not decode {resource['name']} with the encoding detected from its first chunk: {e}")
+    except requests.RequestException as e:
+        logger.error(f"The connection failed while streaming {resource['name']}: {e.__class__.__name__} - {e}")
+    except RetryLater:
+        # the source wants to be tried again later (e.g. a DataStore page the server refused with a 503)
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    except Exception as e:
+        logger.exception(f"There was a problem saving the file: {e}")
+
+    if tmp_path and os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return False
+
+
 # Going to use this function eventually to load CSVs into Postgres.
-def to_df(logger: logging.Logger, resource: dict, csv: StringIO) -> pd.DataFrame:
+def to_df(logger: logging.Logger, resource: dict, csv: StringIO) -> "pd.DataFrame":
 
     """
     Takes an in-memory CSV object and returns a pandas dataframe.
@@ -211,6 +651,7 @@ def to_df(logger: logging.Logger, resource: dict, csv: StringIO) -> pd.DataFrame
     logger.info("-------------------------------------------")
     logger.info(f"Converting to a dataframe...")
     
+    import pandas as pd
     try:
         df = pd.read_csv(csv)
         logger.info("Successfully converted CSV to a dataframe!")
@@ -0,0 +1,167 @@
+import csv, json, logging, threading, requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+from io import StringIO
+from typing import Callable, Iterator, Optional
+from concurrency import HostLimiter
+from data_functions import request_datastore_page, DATASTORE_SEARCH_URL
+from metrics import StageTimer
+from retry_scheduler import RETRY_STATUSES, RetryLater, retry_after_seconds
+
+# Rows per datastore_search page. CKAN refuses more than 32000 unless ckan.datastore.search.rows_max is raised.
+DATASTORE_PAGE_SIZE = 10_000
+
+
+@dataclass
+class DatastoreQuery:
+    """
+    What to pull from the DataStore for every resource that's in it: which columns, and which rows
+    (column -> value, or list of values, that must match). None means all of them.
+    """
+    columns: Optional[list[str]] = None
+    filters: Optional[dict] = None
+    page_size: int = DATASTORE_PAGE_SIZE
+    workers: int = 4
+
+    def key(self) -> str:
+        """
+        Identifies the data the query selects, so a file saved with a different query is fetched again.
+        """
+        return json.dumps({"columns": self.columns, "filters": self.filters}, sort_keys=True, ensure_ascii=False)
+
+
+def fetch_datastore_page(
+        logger: logging.Logger,
+        resource: dict,
+        offset: int,
+        limit: int,
+        query: DatastoreQuery,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        on_bytes: Optional[Callable[[int], None]] = None,
+        ) -> dict:
+    """
+    Gets one page of a resource's rows. It's tried once: when the server is struggling the
+    resource goes back to the retry queue, which waits as long as the server asked.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource (dict): A dictionary with all the information on the resource.
+        offset (int): Number of rows to skip.
+        limit (int): Number of rows on the page.
+        query (DatastoreQuery): The columns and rows to select.
+        limiter (HostLimiter): Optional per-host limiter.
+        session (requests.Session): Optional pooled session.
+        on_bytes (Callable): Optional function told the size of every page received.
+
+    Returns:
+        The datastore_search result, with the rows as CSV text in "records".
+
+    Raises:
+        RetryLater if the page couldn't be retrieved, so the resource can wait in the retry queue.
+        ValueError if the DataStore refused the query (e.g. a column that doesn't exist).
+    """
+    with limiter.slot(DATASTORE_SEARCH_URL) if limiter else nullcontext():
+        response = request_datastore_page(
+            logger,
+            resource['id'],
+            offset,
+            limit,
+            fields=query.columns,
+            filters=query.filters,
+            session=session,
+            )
+    status = response.status_code if response is not None else None
+    if limiter:
+        limiter.record(
+            DATASTORE_SEARCH_URL,
+            status,
+            response.elapsed.total_seconds() if response is not None else None,
+            retry_after_seconds(response),
+            )
+    if status == 200:
+        if on_bytes:
+            on_bytes(len(response.content))
+        return response.json()['result']
+    if status is not None and status not in RETRY_STATUSES:
+        try:
+            error = response.json().get('error')
+        except ValueError:
+            error = response.text[:200]
+        raise ValueError(f"the DataStore refused the query for {resource['name']} ({status}): {error}")
+
+    logger.warning(f"Problem with rows {offset}-{offset + limit} of {resource['name']}: {status or 'No response.'}")
+    raise RetryLater(f"rows {offset}-{offset + limit} couldn't be retrieved ({status or 'no response'})", retry_after_seconds(response))
+
+
+def iter_datastore_csv(
+        logger: logging.Logger,
+        resource: dict,
+        query: DatastoreQuery,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        timer: Optional[StageTimer] = None,
+        ) -> Iterator[str]:
+    """
+    Yields a resource's selected rows from the DataStore as CSV text, one page at a time, with the
+    header in front of the first page so the dialect can be sniffed from real rows.
+
+    A first request with no rows gets the column list and the row count; the pages are then
+    requested several at a time and yielded in order. Only a few pages are held ahead of the one
+    being yielded, so memory stays flat however big the resource is.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource (dict): A dictionary with all the information on the resource.
+        query (DatastoreQuery): The columns and rows to select.
+        limiter (HostLimiter): Optional per-host limiter.
+        session (requests.Session): Optional pooled session.
+        timer (StageTimer): Optional stage timer the bytes received are added to.
+
+    Raises:
+        RetryLater or ValueError, see fetch_datastore_page.
+    """
+    lock = threading.Lock()
+
+    def received(size: int):
+        if timer:
+            with lock:
+                timer.bytes += size
+
+    head = fetch_datastore_page(logger, resource, 0, 0, query, limiter=limiter, session=session, on_bytes=received)
+    # _id is the DataStore's own row number, not a column of the file
+    columns = query.columns or [field['id'] for field in head['fields'] if field['id'] != '_id']
+    total = head.get('total', 0)
+    logger.info(f"Fetching {total} rows and {len(columns)} columns of {resource['name']} from the DataStore.")
+    page_query = DatastoreQuery(columns, query.filters, query.page_size, query.workers)
+    fetch = lambda offset: fetch_datastore_page(
+        logger, resource, offset, query.page_size, page_query, limiter=limiter, session=session, on_bytes=received
+        )
+
+    out = StringIO()
+    csv.writer(out, lineterminator="\n").writerow(columns)
+    header = out.getvalue()
+
+    offsets = iter(range(0, total, query.page_size))
+    with ThreadPoolExecutor(max_workers=max(1, query.workers), thread_name_prefix="datastore") as executor:
+        # range first, so zip stops before taking an offset it won't use
+        pending = deque(executor.submit(fetch, offset) for _, offset in zip(range(max(1, query.workers) * 2), offsets))
+        try:
+            while pending:
+                page = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(fetch, offset))
+                records = page.get('records') or ""
+                if records and not records.endswith("\n"):
+                    records += "\n"
+                if records:
+                    yield header + records
+                    header = ""
+        finally:
+            for future in pending:
+                future.cancel()
+    if header:
+        yield header
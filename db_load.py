@@ -1,10 +1,40 @@
-import os
-import pandas as pd
-from pandas import DataFrame
-from sqlalchemy import create_engine
+import os, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from typing import TYPE_CHECKING
 import psycopg2
 from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
+from sync_state import SyncState
+from storage import find_stored, is_stored_csv, logical_name, open_stored
+from schema_inference import (
+    ColumnInfo,
+    CoercingReader,
+    TableSchema,
+    infer_file,
+    infer_whole_file,
+    row_coercer,
+    )
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# How PostgreSQL names the types schema inference produces, for reading existing tables back.
+PG_TYPE_NAMES = {
+    "bigint": "BIGINT",
+    "double precision": "DOUBLE PRECISION",
+    "date": "DATE",
+    "timestamp without time zone": "TIMESTAMP",
+    "boolean": "BOOLEAN",
+    "text": "TEXT",
+}
+
+# Bookkeeping table for incremental loads, and the column tying each row to its resource.
+LOADS_TABLE = "_bcn_etl_loads"
+RESOURCE_COLUMN = "_resource_id"
+SIGNATURE_FIELDS = ("revision_id", "last_modified", "size", "hash")
 
 @dataclass
 class Database:
@@ -12,24 +42,226 @@ class Database:
     db_host: str
     db_name: str
 
+def connect(db_config: Database):
+    return psycopg2.connect(f"dbname={db_config.db_name} user={db_config.db_user} host={db_config.db_host}")
+
 def get_file_names(path: str) -> list:
-    return [entry.name for entry in os.scandir(path) if entry.is_file() and entry.name.endswith(".csv")]
+    return [entry.name for entry in os.scandir(path) if entry.is_file() and is_stored_csv(entry.name)]
 
 def csv_to_df(path: str, file_name: str):
+    import pandas as pd
     my_csv = os.path.join(path, file_name)
     return pd.read_csv(my_csv)
 
 def table_exists(db_config: Database, table_name: str) -> bool:
-    with psycopg2.connect(f"dbname={db_config.db_name} user={db_config.db_user} host={db_config.db_host}") as conn:
+    with connect(db_config) as conn:
         cur = conn.cursor()
-        cur.execute("SELECT to_regclass(%s);", (table_name,))
-        return cur.fetchone()[0] is not None
+        return cursor_table_exists(cur, table_name)
+
+def cursor_table_exists(cur, table_name: str) -> bool:
+    cur.execute("SELECT to_regclass(%s);", (sql.Identifier(table_name).as_string(cur),))
+    return cur.fetchone()[0] is not None
+
+def create_table(cur, table_name: str, schema: list[tuple[str, str]]):
+    """
+    Creates a package table from an inferred schema, plus the column recording which
+    resource each row came from.
+    """
+    columns = [
+        sql.SQL("{} {}").format(sql.Identifier(name), sql.SQL(col_type))
+        for name, col_type in schema
+    ]
+    columns.append(sql.SQL("{} TEXT NOT NULL").format(sql.Identifier(RESOURCE_COLUMN)))
+    create_sql = sql.SQL("CREATE TABLE {} ({})").format(
+        sql.Identifier(table_name),
+        sql.SQL(", ").join(columns),
+    )
+    cur.execute(create_sql)
+    cur.execute(
+        sql.SQL("CREATE INDEX ON {} ({})").format(sql.Identifier(table_name), sql.Identifier(RESOURCE_COLUMN))
+    )
+
+def table_columns(cur, table_name: str) -> list[tuple[str, str]]:
+    """
+    Reads the columns of an existing table back as (column name, type) tuples, leaving out
+    the resource column.
+    """
+    cur.execute(
+        """SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped AND attname <> %s
+        ORDER BY attnum""",
+        (sql.Identifier(table_name).as_string(cur), RESOURCE_COLUMN),
+    )
+    return [(name, PG_TYPE_NAMES.get(pg_type, pg_type.upper())) for name, pg_type in cur.fetchall()]
+
+def alter_table(cur, table_name: str, schema: TableSchema, added: list[str], widened: list[str]):
+    """
+    Brings an existing table up to a schema that was widened to fit new files: adds the columns
+    that are new and widens the ones whose values no longer fit their type.
+    """
+    table = sql.Identifier(table_name)
+    for name in added:
+        cur.execute(
+            sql.SQL("ALTER TABLE {} ADD COLUMN {} {}").format(table, sql.Identifier(name), sql.SQL(schema.type_of(name)))
+        )
+    for name in widened:
+        pg_type = sql.SQL(schema.type_of(name))
+        cur.execute(
+            sql.SQL("ALTER TABLE {} ALTER COLUMN {} TYPE {} USING {}::{}").format(
+                table, sql.Identifier(name), pg_type, sql.Identifier(name), pg_type
+            )
+        )
+
+def has_resource_column(cur, table_name: str) -> bool:
+    cur.execute(
+        "SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = %s AND NOT attisdropped",
+        (sql.Identifier(table_name).as_string(cur), RESOURCE_COLUMN),
+    )
+    return cur.fetchone() is not None
+
+def ensure_loads_table(cur):
+    """
+    Creates the bookkeeping table that records which revision of each resource is loaded in each table.
+    """
+    cur.execute(
+        sql.SQL("""CREATE TABLE IF NOT EXISTS {} (
+            table_name TEXT NOT NULL,
+            resource_id TEXT NOT NULL,
+            resource_name TEXT,
+            revision_id TEXT,
+            last_modified TEXT,
+            size TEXT,
+            hash TEXT,
+            row_count BIGINT,
+            loaded_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (table_name, resource_id)
+        )""").format(sql.Identifier(LOADS_TABLE))
+    )
+
+def loaded_resources(cur, table_name: str) -> dict[str, dict]:
+    """
+    Returns what's already loaded in a table, as resource id -> signature.
+    """
+    cur.execute(
+        sql.SQL("SELECT resource_id, revision_id, last_modified, size, hash FROM {} WHERE table_name = %s").format(
+            sql.Identifier(LOADS_TABLE)
+        ),
+        (table_name,),
+    )
+    return {
+        row[0]: dict(zip(SIGNATURE_FIELDS, row[1:]))
+        for row in cur.fetchall()
+    }
+
+def resource_signature(resource: dict) -> dict:
+    """
+    The CKAN fields that change when a resource is revised, as strings (or None) so they
+    compare equal to what's stored in the bookkeeping table.
+    """
+    return {
+        field: None if resource.get(field) is None else str(resource.get(field))
+        for field in SIGNATURE_FIELDS
+    }
+
+def file_resources(data_dir: str, file_names: list[str]) -> list[dict]:
+    """
+    Works out the identity of each CSV file in a package directory from the package's sync-state
+    manifest. Files that aren't in the manifest are identified by name, with their size and
+    modification time standing in for the revision. Compressed files go by the name of the CSV
+    they hold, so a file that's recompressed is still the same resource.
+    """
+    by_name = {entry["name"]: entry for entry in SyncState(data_dir).resources.values()}
+    resources = []
+    for file_name in file_names:
+        entry = by_name.get(logical_name(file_name))
+        if entry:
+            resources.append(dict(entry))
+        else:
+            stat = os.stat(os.path.join(data_dir, file_name))
+            resources.append({
+                "id": f"file:{logical_name(file_name)}",
+                "name": logical_name(file_name),
+                "revision_id": None,
+                "last_modified": str(stat.st_mtime),
+                "size": str(stat.st_size),
+                "hash": None,
+            })
+    return resources
+
+def replace_resource_rows(cur, table_name: str, resource: dict, header: list[str], source) -> int:
+    """
+    Loads one resource into a table, replacing any rows an earlier revision of it left there.
+
+    The data is COPYed into a temporary staging table first, and only once that has worked are the
+    old rows deleted and the new ones moved over, followed by the bookkeeping row. All of it runs in
+    the caller's transaction, so readers never see the resource half replaced.
+
+    ARGUMENTS:
+        cur: a cursor in an open transaction
+        table_name: the package's table
+        resource: the resource being loaded (id, name and signature fields)
+        header: the column names in the CSV's header, in order
+        source: a file-like object with the CSV, header included
+    RETURNS:
+        The number of rows loaded.
+    """
+    stage = sql.Identifier(f"_stage_{table_name}"[:63])
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP").format(stage, sql.Identifier(table_name)))
+    cur.execute(
+        sql.SQL("ALTER TABLE {} ALTER COLUMN {} SET DEFAULT %s").format(stage, sql.Identifier(RESOURCE_COLUMN)),
+        (resource["id"],),
+    )
+    copy_sql = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')").format(
+        stage,
+        sql.SQL(", ").join(sql.Identifier(name) for name in header),
+    )
+    cur.copy_expert(copy_sql, source, size=COPY_BUFFER_SIZE)
+
+    cur.execute(
+        sql.SQL("DELETE FROM {} WHERE {} = %s").format(sql.Identifier(table_name), sql.Identifier(RESOURCE_COLUMN)),
+        (resource["id"],),
+    )
+    cur.execute(sql.SQL("INSERT INTO {} SELECT * FROM {}").format(sql.Identifier(table_name), stage))
+    row_count = cur.rowcount
+    cur.execute(sql.SQL("DROP TABLE {}").format(stage))
+
+    signature = resource_signature(resource)
+    cur.execute(
+        sql.SQL("""INSERT INTO {} (table_name, resource_id, resource_name, revision_id, last_modified, size, hash, row_count)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (table_name, resource_id) DO UPDATE SET
+                resource_name = EXCLUDED.resource_name,
+                revision_id = EXCLUDED.revision_id,
+                last_modified = EXCLUDED.last_modified,
+                size = EXCLUDED.size,
+                hash = EXCLUDED.hash,
+                row_count = EXCLUDED.row_count,
+                loaded_at = now()""").format(sql.Identifier(LOADS_TABLE)),
+        (table_name, resource["id"], resource["name"], *signature.values(), row_count),
+    )
+    return row_count
+
+def copy_file(cur, table_name: str, file_path: str, resource: dict, columns: list[ColumnInfo], schema: TableSchema) -> int:
+    """
+    Streams one CSV file from disk into a table with COPY FROM STDIN, replacing the rows of any
+    earlier revision of the same resource (see replace_resource_rows).
+    The file's header is mapped onto the table's columns, so files whose columns are renamed or
+    in a different order still land in the right columns. Only files with values PostgreSQL can't
+    parse as they are (see row_coercer) are rewritten on the way. Compressed files are
+    decompressed as they're streamed.
+    """
+    header = [column.name for column in columns]
+    coerce_row = row_coercer(columns, schema.target_types(header))
+    with open_stored(file_path) as f:
+        source = CoercingReader(f, coerce_row) if coerce_row else f
+        return replace_resource_rows(cur, table_name, resource, schema.targets(header), source)
 
 def insert_df(
-        df: DataFrame, 
+        df: "DataFrame", 
         table_name: str,
         db_config: Database):
 
+    from sqlalchemy import create_engine
     engine = create_engine(f"postgresql+psycopg2://{db_config.db_user}@{db_config.db_host}/{db_config.db_name}")
     try:
         df.to_sql(table_name, engine, if_exists="append", index=False)
@@ -38,45 +270,199 @@ def insert_df(
         print(f"Was not able to create table with df insert: {e}")
         return False
 
-def copy_package_to_db(path: str, package_name: str, db_config: Database):
+def copy_package_to_db(path: str, package_name: str, db_config: Database, conn=None, aliases: dict = None, metrics=None) -> bool:
     """
-    Calling copy_package_to_db creates a PostgreSQL table with inferred schema and
-    copies all the CSV files in a package to that table.
+    Calling copy_package_to_db loads the CSV files of a package into a PostgreSQL table.
+
+    A sample of every file that needs loading is read first, and their inferred columns are
+    reconciled into one schema (see TableSchema): the table is created with it if it doesn't
+    exist yet, or altered to fit it if new files brought new columns or values that need a
+    wider type.
+
+    Loads are incremental: the _bcn_etl_loads table records which revision of each resource is in
+    the table, so only new resources are added and only resources that changed upstream are
+    replaced (see replace_resource_rows). Unchanged resources aren't touched.
+
+    Everything goes over one connection in one transaction, and every file is streamed from
+    disk with COPY, so no file is ever loaded into memory. A file that fails to load is rolled
+    back on its own (through a savepoint) and the rest of the package still loads.
+
+    The transaction starts by taking a PostgreSQL advisory lock on the table name, so two
+    loaders (threads or separate processes) that target the same table never race: the second
+    one waits, then only loads what the first one didn't.
 
     ARGUMENTS:
         path: the root path defined by the user where downloaded CSVs are saved.
         package_name: name of the package, which is also a directory name and used to name the PostgreSQL table
         db_config: config for connecting to the database
+        conn: optional open connection (e.g. from a pool). If None, a new connection is opened and closed.
+        aliases: optional explicit column renames for this package, as {old column name: new column name}
+        metrics: optional Metrics that every file's COPY is timed into, as the db_load stage
     RETURNS:
-        None
-    """
-    if table_exists(
-        db_config=db_config,
-        table_name=package_name
-        ):
-        print(f"Table {package_name} already exists. For now, to avoid duplication, we are only loading to fresh tables.")
-        return
-    
-    with psycopg2.connect(f"dbname={db_config.db_name} user={db_config.db_user} host={db_config.db_host}") as conn:
-        cur = conn.cursor()
-        data_dir = os.path.join(path, package_name)
-        file_names = get_file_names(data_dir)
-        sample_file = file_names.pop(0)
-        sample_df = csv_to_df(
-            path=data_dir,
-            file_name=sample_file
-            )
-        if insert_df(
-            df=sample_df, 
-            table_name=package_name,
-            db_config=db_config
+        True if the package is fully loaded, False if it was skipped or a file failed.
+    """
+    data_dir = os.path.join(path, package_name)
+    file_names = sorted(get_file_names(data_dir))
+    if not file_names:
+        print(f"No CSV files found for {package_name} in {data_dir}.")
+        return False
+
+    own_connection = conn is None
+    if own_connection:
+        conn = connect(db_config)
+    try:
+        with conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (package_name,))
+            ensure_loads_table(cur)
+            exists = cursor_table_exists(cur, package_name)
+            if exists and not has_resource_column(cur, package_name):
+                print(f"Table {package_name} was loaded before incremental loading existed and has no {RESOURCE_COLUMN} column. Drop it to reload it.")
+                return False
+
+            already_loaded = loaded_resources(cur, package_name) if exists else {}
+            resources = [
+                resource for resource in file_resources(data_dir, file_names)
+                if already_loaded.get(resource["id"]) != resource_signature(resource)
+            ]
+            unchanged = len(file_names) - len(resources)
+            file_paths = [find_stored(data_dir, resource["name"]) for resource in resources]
+            file_columns = [infer_file(file_path) for file_path in file_paths]
+
+            schema = TableSchema(table_columns(cur, package_name) if exists else (), aliases)
+            added, widened = [], []
+            for columns in file_columns:
+                new_columns, new_types = schema.merge(columns)
+                added += [name for name in new_columns if name not in added]
+                widened += [name for name in new_types if name not in widened and name not in added]
+            if not exists:
+                create_table(cur, package_name, schema.ddl())
+            elif added or widened:
+                alter_table(cur, package_name, schema, added, widened)
+                print(f"{package_name}: added column(s) {added} and widened column(s) {widened} to fit new files.")
+
+            loaded, failed = 0, 0
+            for resource, file_path, columns in zip(resources, file_paths, file_columns):
+                cur.execute("SAVEPOINT load_file")
+                before = schema.copy()
+                try:
+                    started = time.perf_counter()
+                    try:
+                        rows = copy_file(cur, package_name, file_path, resource, columns, schema)
+                    except psycopg2.DataError as e:
+                        # COPY rejected a value: widen the table to the whole file's types and copy it again
+                        cur.execute("ROLLBACK TO SAVEPOINT load_file")
+                        scanned = infer_whole_file(file_path)
+                        if scanned == columns:
+                            raise
+                        print(f"{resource['name']} has values its first rows didn't show ({e.diag.message_primary}), reading the whole file for its column types.")
+                        added, widened = schema.merge(scanned)
+                        if added or widened:
+                            alter_table(cur, package_name, schema, added, widened)
+                        rows = copy_file(cur, package_name, file_path, resource, scanned, schema)
+                    cur.execute("RELEASE SAVEPOINT load_file")
+                    if metrics:
+                        metrics.record_stage("db_load", time.perf_counter() - started, os.path.getsize(file_path), rows)
+                    loaded += 1
+                except psycopg2.Error as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT load_file")
+                    # any widening for this file was rolled back with it
+                    schema = before
+                    print(f"Could not load {resource['name']} into {package_name}: {e}")
+                    failed += 1
+        print(f"{package_name}: {loaded} resource(s) loaded or replaced, {unchanged} unchanged, {failed} failed.")
+        return failed == 0
+    finally:
+        if own_connection:
+            conn.close()
+
+class ParallelLoader:
+    """
+    Loads several packages into PostgreSQL at the same time, each over its own connection
+    from a shared pool.
+
+    submit() blocks once max_pending loads are waiting, which keeps the download side from
+    running too far ahead of the database.
+    """
+
+    def __init__(
+            self, 
+            db_config: Database, 
+            storage_root: str, 
+            max_connections: int = 4, 
+            max_pending: int = None,
+            column_aliases: dict = None,
+            metrics=None,
             ):
+        self.db_config = db_config
+        self.storage_root = storage_root
+        self.column_aliases = column_aliases or {}
+        self.metrics = metrics
+        self.pool = ThreadedConnectionPool(
+            1, 
+            max_connections, 
+            f"dbname={db_config.db_name} user={db_config.db_user} host={db_config.db_host}",
+            )
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="db_load")
+        self._pending = threading.BoundedSemaphore(max_pending or max_connections * 2)
+        self._futures = {}
+
+    def _load(self, package_name: str) -> bool:
+        conn = self.pool.getconn()
+        try:
+            return copy_package_to_db(
+                self.storage_root,
+                package_name,
+                self.db_config,
+                conn=conn,
+                aliases=self.column_aliases.get(package_name),
+                metrics=self.metrics,
+                )
+        except Exception as e:
+            print(f"Could not load {package_name} into the database: {e}")
+            return False
+        finally:
+            self.pool.putconn(conn)
+            self._pending.release()
+            if self.metrics:
+                self.metrics.adjust_gauge("db_loads_pending", -1)
+
+    def submit(self, package_name: str):
+        """
+        Queues a package for loading, waiting for room in the queue if the database is behind.
+        """
+        self._pending.acquire()
+        if self.metrics:
+            self.metrics.adjust_gauge("db_loads_pending", 1)
+        self._futures[package_name] = self.executor.submit(self._load, package_name)
+
+    def collect(self, package_names: list[str]) -> dict[str, bool]:
+        """
+        Waits for the loads of some packages to finish and forgets them, so a long-running process
+        doesn't keep every load it ever submitted.
+
+        RETURNS:
+            A dictionary of package name -> True if it was loaded, for the packages that were submitted.
+        """
+        return {
+            name: self._futures.pop(name).result()
+            for name in package_names if name in self._futures
+        }
+
+    def close(self) -> dict[str, bool]:
+        """
+        Waits for every queued load that wasn't collected to finish and closes the pool.
+
+        RETURNS:
+            A dictionary of package name -> True if it was loaded.
+        """
+        results = {name: future.result() for name, future in self._futures.items()}
+        self.executor.shutdown()
+        self.pool.closeall()
+        return results
+
+    def __enter__(self):
+        return self
 
-            for file in file_names:
-                file_path = os.path.join(path, package_name, file)
-                with open(file_path, "r") as f:
-                    copy_sql = sql.SQL("COPY {} FROM STDIN WITH CSV HEADER").format(
-                        sql.Identifier(package_name)
-                        )
-                    cur.copy_expert(copy_sql, f)
-        conn.commit()
\ No newline at end of file
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,71 @@
+import logging, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def enable_http2(logger: logging.Logger) -> bool:
+    """
+    Switches urllib3 (and so requests) over to HTTP/2 where the server supports it.
+    This relies on urllib3's experimental HTTP/2 support and the optional 'h2' package.
+
+    Returns:
+        True if HTTP/2 was enabled, False if the dependencies aren't installed.
+    """
+    try:
+        import h2  # noqa: F401
+        from urllib3.http2 import inject_into_urllib3
+    except ImportError:
+        logger.warning("HTTP/2 needs urllib3>=2.3 and the 'h2' package, falling back to HTTP/1.1.")
+        return False
+    inject_into_urllib3()
+    logger.info("HTTP/2 enabled.")
+    return True
+
+
+def get_session(
+        logger: logging.Logger,
+        pool_size: int = 10,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        http2: bool = False,
+        ) -> requests.Session:
+    """
+    Builds a requests.Session with a connection pool, so that every package listing and resource
+    download reuses open keep-alive connections instead of doing a new TCP/TLS handshake each time.
+
+    Connection errors are retried inside the transport with a short backoff. 429/5xx responses are
+    not: they go straight back to the caller, so the host's circuit breaker and request rate
+    hear about them (see concurrency.HostLimiter) and the resource can wait in the retry queue
+    (see retry_scheduler.run_with_retries) instead of holding a worker while it sleeps.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        pool_size (int): Maximum number of connections kept open per host. Should be at least the number of workers.
+        max_retries (int): Number of transport-level retries per request.
+        backoff_factor (float): Base for the exponential backoff between transport-level retries.
+        http2 (bool): Try to use HTTP/2 (optional, needs the 'h2' package).
+
+    Returns:
+        A requests.Session that can be shared between threads.
+    """
+    if http2:
+        enable_http2(logger)
+
+    retry = Retry(
+        total=max_retries,
+        status=0,
+        backoff_factor=backoff_factor,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
@@ -0,0 +1,184 @@
+import sqlite3, threading, time
+from contextlib import contextmanager
+from typing import Optional
+
+DEFAULT_QUEUE_PATH = "job_queue.sqlite"
+
+# Job states. A job is claimed (pending -> in_flight) before it runs and settled (done or failed)
+# after, so whatever is still in_flight when the process starts was interrupted by a crash or restart.
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+JOB_STATES = (PENDING, IN_FLIGHT, DONE, FAILED)
+
+
+class JobQueue:
+    """
+    A durable queue of packages to keep in sync, and the state of each of their resources,
+    stored in SQLite so that a long-running process (see daemon.py) can be stopped and restarted
+    without redoing completed work.
+
+    Every package job remembers the metadata_modified stamp of the package_show payload it was
+    last synced against, so a poll only sends a package back to pending when it changed upstream.
+    Failed jobs carry a next_run time and are picked up again once it has passed.
+    """
+
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS packages (
+                    package TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    revision TEXT,
+                    last_error TEXT,
+                    next_run REAL NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS resources (
+                    package TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (package, name)
+                )"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def recover(self) -> int:
+        """
+        Sends jobs left in_flight by a process that didn't finish back to pending.
+
+        Returns:
+            The number of jobs recovered.
+        """
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE packages SET state = ?, next_run = 0, updated_at = ? WHERE state = ?",
+                (PENDING, time.time(), IN_FLIGHT),
+            )
+            return cursor.rowcount
+
+    def add(self, package: str) -> bool:
+        """
+        Adds a package to the queue as pending, unless it's already there.
+
+        Returns:
+            True if the package is new to the queue.
+        """
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO packages (package, state, updated_at) VALUES (?, ?, ?)",
+                (package, PENDING, time.time()),
+            )
+            return cursor.rowcount == 1
+
+    def job(self, package: str) -> Optional[dict]:
+        """
+        Returns a package's job (state, attempts, revision, last_error, next_run), or None if it isn't queued.
+        """
+        with self._lock, self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM packages WHERE package = ?", (package,)).fetchone()
+        return dict(row) if row else None
+
+    def mark_changed(self, package: str):
+        """
+        Sends a done package back to pending because it changed upstream. Pending, in-flight and
+        failed jobs are left alone: they're going to run anyway.
+        """
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE packages SET state = ?, attempts = 0, next_run = 0, updated_at = ? WHERE package = ? AND state = ?",
+                (PENDING, time.time(), package, DONE),
+            )
+
+    def claim(self, limit: Optional[int] = None) -> list[str]:
+        """
+        Moves the pending jobs, and the failed jobs that are due for a retry, to in_flight.
+
+        Args:
+            limit (int): Optional maximum number of jobs to claim.
+
+        Returns:
+            The names of the claimed packages, oldest first.
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                """SELECT package FROM packages
+                WHERE state = ? OR (state = ? AND next_run <= ?)
+                ORDER BY updated_at, package LIMIT ?""",
+                (PENDING, FAILED, now, -1 if limit is None else limit),
+            ).fetchall()
+            packages = [row[0] for row in rows]
+            conn.executemany(
+                "UPDATE packages SET state = ?, updated_at = ? WHERE package = ?",
+                [(IN_FLIGHT, now, package) for package in packages],
+            )
+        return packages
+
+    def finish(self, package: str, revision: Optional[str] = None):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                """UPDATE packages SET state = ?, attempts = 0, revision = COALESCE(?, revision),
+                last_error = NULL, next_run = 0, updated_at = ? WHERE package = ?""",
+                (DONE, revision, time.time(), package),
+            )
+
+    def fail(self, package: str, error: str, retry_in: float):
+        """
+        Marks a job as failed, to be claimed again after retry_in seconds.
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                """UPDATE packages SET state = ?, attempts = attempts + 1, last_error = ?,
+                next_run = ?, updated_at = ? WHERE package = ?""",
+                (FAILED, error, now + retry_in, now, package),
+            )
+
+    def record_resources(self, package: str, done: list[str], failed: list[str]):
+        """
+        Stores the outcome of each resource that was tried in a package run.
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                """INSERT INTO resources (package, name, state, attempts, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (package, name) DO UPDATE SET state = excluded.state,
+                attempts = CASE WHEN excluded.state = ? THEN resources.attempts + 1 ELSE 0 END,
+                updated_at = excluded.updated_at""",
+                [(package, name, DONE, 0, now, FAILED) for name in done]
+                + [(package, name, FAILED, 1, now, FAILED) for name in failed],
+            )
+
+    def counts(self) -> dict:
+        """
+        Returns the number of package jobs in each state.
+        """
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT state, COUNT(*) FROM packages GROUP BY state").fetchall()
+        return dict(rows)
+
+    def next_due(self) -> Optional[float]:
+        """
+        Returns the time the next failed job is due for a retry, or None if there's none.
+        """
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT MIN(next_run) FROM packages WHERE state = ?", (FAILED,)).fetchone()
+        return row[0]
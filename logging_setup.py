@@ -7,9 +7,12 @@ def get_logger(
         ):
     logger = logging.getLogger(__name__)
     logger.setLevel(level)
+    # main() can run more than once in a process; adding the handlers again would repeat every line
+    if logger.handlers:
+        return logger
 
     file_handler = logging.FileHandler(
-        filename="etl.log",
+        filename=path,
         encoding="utf-8",
         mode="a",
     )
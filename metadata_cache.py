@@ -0,0 +1,106 @@
+import json, sqlite3, threading, time
+from contextlib import contextmanager
+from typing import Optional
+
+DEFAULT_CACHE_PATH = "metadata_cache.sqlite"
+
+
+class MetadataCache:
+    """
+    An on-disk cache of CKAN metadata (package_show payloads and the parsed tag catalog),
+    stored in SQLite so it can be shared between runs and between threads.
+
+    Entries older than the TTL are treated as missing, and the least recently used entries
+    are evicted once the cache holds more than max_entries. With refresh, entries stored before
+    the cache was opened are ignored, so each key is fetched fresh once; what the process stores
+    after that is used as usual, e.g. by the later cycles of a daemon.
+    """
+
+    def __init__(
+            self, 
+            path: str = DEFAULT_CACHE_PATH, 
+            ttl: float = 6 * 3600, 
+            max_entries: int = 5000,
+            refresh: bool = False,
+            ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+        # with refresh, the keys stored by this process, the only ones that are read back
+        self._fresh = set()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS metadata (
+                    key TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Returns the cached payload for a key, or None if it's missing, stale or a refresh was
+        requested and it hasn't been stored since.
+
+        Args:
+            key (str): The cache key, e.g. "package_show:<package name>".
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            if self.refresh and key not in self._fresh:
+                return None
+            row = conn.execute(
+                "SELECT payload, stored_at FROM metadata WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                return None
+            conn.execute("UPDATE metadata SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, payload: dict):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, payload, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(payload), now, now),
+            )
+            self._fresh.add(key)
+        self.evict()
+
+    def put_many(self, payloads: dict[str, dict]):
+        """
+        Stores many payloads in one transaction, e.g. every package of a catalog sync.
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO metadata (key, payload, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, json.dumps(payload), now, now) for key, payload in payloads.items()],
+            )
+            self._fresh.update(payloads)
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes expired entries, then the least recently used ones beyond max_entries.
+        """
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM metadata WHERE stored_at < ?", (time.time() - self.ttl,))
+            conn.execute(
+                """DELETE FROM metadata WHERE key NOT IN (
+                    SELECT key FROM metadata ORDER BY accessed_at DESC LIMIT ?
+                )""",
+                (self.max_entries,),
+            )
@@ -0,0 +1,246 @@
+import json, os, re, tempfile, threading, time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Iterator
+
+# Every Prometheus metric name starts with this.
+PREFIX = "bcn_etl"
+
+# The stages a resource goes through, in order. Other stage names are allowed, these are just
+# the ones the pipeline records and the order they're reported in.
+STAGES = ("metadata", "download", "decode", "save", "columnar", "db_load")
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    bytes: int = 0
+    rows: int = 0
+
+    def add(self, seconds: float, bytes: int = 0, rows: int = 0):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes += bytes
+        self.rows += rows
+
+    def as_dict(self) -> dict:
+        stats = asdict(self)
+        stats["bytes_per_second"] = self.bytes / self.seconds if self.seconds else 0.0
+        stats["rows_per_second"] = self.rows / self.seconds if self.seconds else 0.0
+        return stats
+
+
+class StageTimer:
+    """
+    Measures one run of a stage (see Metrics.stage). The bytes and rows it handled can be set
+    on it before the stage ends, and time spent in a nested stage can be taken out with exclude().
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.bytes = 0
+        self.rows = 0
+        self.excluded = 0.0
+
+    def exclude(self, seconds: float):
+        self.excluded += seconds
+
+    def elapsed(self) -> float:
+        return max(0.0, time.perf_counter() - self.start - self.excluded)
+
+
+class TimedIterator:
+    """
+    Wraps an iterator of text chunks and measures the time spent producing them, e.g. to tell
+    how much of writing a file went into decoding it. Rows are counted as line breaks.
+    """
+
+    def __init__(self, chunks: Iterable[str]):
+        self.chunks = iter(chunks)
+        self.seconds = 0.0
+        self.rows = 0
+
+    def __iter__(self) -> Iterator:
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            chunk = next(self.chunks)
+        finally:
+            self.seconds += time.perf_counter() - start
+        self.rows += chunk.count("\n")
+        return chunk
+
+
+def count_bytes(chunks: Iterable[bytes], timer: StageTimer) -> Iterator[bytes]:
+    """
+    Passes byte chunks through, adding their size to a stage's bytes.
+    """
+    for chunk in chunks:
+        timer.bytes += len(chunk)
+        yield chunk
+
+
+class Metrics:
+    """
+    Per-stage timings, counters and gauges for a run (or a whole daemon's lifetime), shared by
+    every thread.
+
+    Stages record how many times they ran, how long they took and how many bytes and rows they
+    handled, so the throughput of each one can be compared: a slow night shows up as a slow
+    download, decode, save or database load. Counters only go up (retries, errors, resources);
+    gauges are current levels (queue depths).
+
+    Everything can be exported as JSON (one snapshot per line) or in the Prometheus text format,
+    to a file (write) or over HTTP (serve).
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def record_stage(self, stage: str, seconds: float, bytes: int = 0, rows: int = 0):
+        with self._lock:
+            self.stages.setdefault(stage, StageStats()).add(seconds, bytes, rows)
+
+    @contextmanager
+    def stage(self, stage: str):
+        """
+        Times a block of code as one run of a stage. Yields a StageTimer for the bytes and rows.
+        The run is recorded even if the block raises.
+        """
+        timer = StageTimer()
+        try:
+            yield timer
+        finally:
+            self.record_stage(stage, timer.elapsed(), timer.bytes, timer.rows)
+
+    def increment(self, counter: str, amount: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set_gauge(self, gauge: str, value: float):
+        with self._lock:
+            self.gauges[gauge] = value
+
+    def adjust_gauge(self, gauge: str, change: float):
+        with self._lock:
+            self.gauges[gauge] = self.gauges.get(gauge, 0) + change
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            ordered = sorted(self.stages, key=lambda name: (STAGES.index(name) if name in STAGES else len(STAGES), name))
+            return {
+                "time": time.time(),
+                "uptime_seconds": time.time() - self.started,
+                "stages": {name: self.stages[name].as_dict() for name in ordered},
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": dict(sorted(self.gauges.items())),
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), sort_keys=False)
+
+    def to_prometheus(self) -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: list[tuple[str, float]]):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{PREFIX}_{name}{labels} {value if isinstance(value, int) else format(value, '.6g')}")
+
+        stages = snapshot["stages"]
+        for field, kind, help_text in (
+            ("calls", "counter", "Number of times each stage ran."),
+            ("seconds", "counter", "Total seconds spent in each stage."),
+            ("max_seconds", "gauge", "Longest single run of each stage, in seconds."),
+            ("bytes", "counter", "Bytes handled by each stage."),
+            ("rows", "counter", "Rows handled by each stage."),
+            ("bytes_per_second", "gauge", "Average bytes per second while each stage was running."),
+            ("rows_per_second", "gauge", "Average rows per second while each stage was running."),
+        ):
+            name = f"stage_{field}" + ("_total" if kind == "counter" else "")
+            metric(name, kind, help_text, [(f'{{stage="{stage}"}}', stats[field]) for stage, stats in stages.items()])
+
+        for counter, value in snapshot["counters"].items():
+            metric(f"{_metric_name(counter)}_total", "counter", f"Total {counter.replace('_', ' ')}.", [("", value)])
+        for gauge, value in snapshot["gauges"].items():
+            metric(_metric_name(gauge), "gauge", f"Current {gauge.replace('_', ' ')}.", [("", value)])
+        metric("uptime_seconds", "gauge", "Seconds since the metrics started.", [("", snapshot["uptime_seconds"])])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """
+        Writes the metrics to a file. A .prom file is replaced with the Prometheus text format (e.g. for
+        node_exporter's textfile collector); any other file gets a JSON snapshot appended as a new line.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        if path.endswith(".prom"):
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, suffix=".tmp", delete=False) as f:
+                f.write(self.to_prometheus())
+            os.replace(f.name, path)
+        else:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(self.to_json() + "\n")
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """
+        Serves the metrics over HTTP from a background thread: /metrics in the Prometheus format and
+        /metrics.json as JSON. Call shutdown() on the returned server to stop it.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.to_prometheus(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = metrics.to_json(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                payload = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+    def summary(self) -> list[str]:
+        """
+        One human-readable line per stage, for the final report.
+        """
+        lines = []
+        for stage, stats in self.snapshot()["stages"].items():
+            line = f"{stage}: {stats['calls']} run(s), {stats['seconds']:.1f}s in total, longest {stats['max_seconds']:.1f}s"
+            if stats["bytes"]:
+                line += f", {stats['bytes'] / 1e6:.1f} MB at {stats['bytes_per_second'] / 1e6:.2f} MB/s"
+            if stats["rows"]:
+                line += f", {stats['rows']} rows at {stats['rows_per_second']:.0f} rows/s"
+            lines.append(line)
+        return lines
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
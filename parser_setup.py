@@ -16,15 +16,176 @@ def get_parser():
         nargs='+',
         help="Tags to be searched for in the BCN catelog. All packages with a tag will be downloaded."
         )
+    parser.add_argument(
+        "--tag_match",
+        choices=["any", "all"],
+        default="any",
+        help="With -t, download packages with any of the tags (default) or only packages with all of them"
+    )
+    parser.add_argument(
+        "--tag_prefix",
+        action="store_true",
+        help="With -t, also match tags that start with the given tags (e.g. 'transport' matches 'transporte')"
+    )
+    parser.add_argument(
+        "--catalog",
+        default="catalog_tags.csv",
+        help="With -t, the tag catalog CSV to search (default: catalog_tags.csv)"
+    )
+    parser.add_argument(
+        "--sync_catalog",
+        action="store_true",
+        help="Refresh the tag catalog and the package details in the metadata cache from Open Data BCN's bulk listing before starting (with --daemon, at every check for changes). Done automatically with -t if the catalog file is missing"
+    )
     parser.add_argument(
         '-d',
         '--directory',
         default='.',
         help='Root directory where you want to save the CSV files',
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of resources in a package to download at the same time (default: 1, one after another)"
+    )
+    parser.add_argument(
+        "--host_limit",
+        type=int,
+        default=4,
+        help="Maximum number of simultaneous requests to the same server, to stay under Open Data BCN's rate limiting (default: 4)"
+    )
+    parser.add_argument(
+        "--max_packages",
+        type=int,
+        default=1,
+        help="Number of packages to download at the same time (default: 1)"
+    )
+    parser.add_argument(
+        "--download_budget",
+        type=int,
+        default=None,
+        help="Maximum number of downloads in flight across all packages, shared fairly between them (default: workers x max_packages)"
+    )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        default=None,
+        help="Number of keep-alive connections kept open to each server (default: enough for every download in flight)"
+    )
+    parser.add_argument(
+        "--http2",
+        action="store_true",
+        help="Use HTTP/2 when the server supports it (needs the optional 'h2' package)"
+    )
+    parser.add_argument(
+        "--metadata_cache",
+        default="metadata_cache.sqlite",
+        help="The SQLite file package details and the parsed tag catalog are cached in between runs (default: metadata_cache.sqlite)"
+    )
+    parser.add_argument(
+        "--refresh_metadata",
+        "--refresh-metadata",
+        action="store_true",
+        help="Ignore what's in the local metadata cache and ask Open Data BCN for fresh package details once (with --daemon, the later cycles use what this one fetched)"
+    )
+    parser.add_argument(
+        "--metadata_ttl",
+        type=float,
+        default=6,
+        help="Hours that cached package details are considered fresh (default: 6)"
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["csv", "parquet", "feather"],
+        default="csv",
+        help="Also save every CSV as a typed columnar file under <directory>/<format>/, partitioned by package and year. Needs the 'pyarrow' package (default: csv only)"
+    )
+    parser.add_argument(
+        "--dataset",
+        choices=["parquet", "feather"],
+        help="Also consolidate every package into one typed dataset under <directory>/datasets/<format>/<package>/, one file per year, with the source resource and year of every row. Only years whose files changed are rebuilt. Needs the 'pyarrow' package"
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Keep identical files once: the CSVs are stored by content under <directory>/.blobs/ and linked into the package directories, and files whose published hash was seen before aren't downloaded again. Blobs nothing links to any more are deleted at the end of the run"
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["none", "gzip", "zstd"],
+        default="none",
+        help="Store the CSV files compressed as they're written (.csv.gz or .csv.zst). Every reader of the files decompresses them as it goes. zstd needs the optional 'zstandard' package (default: none)"
+    )
+    parser.add_argument(
+        "--datastore",
+        action="store_true",
+        help="Pull resources that are in Open Data BCN's DataStore through its API instead of downloading the whole file, so --columns and --filters are applied by the server. Other resources are downloaded as usual"
+    )
+    parser.add_argument(
+        "--columns",
+        nargs='+',
+        help="With --datastore, only pull these columns, in this order (default: all of them)"
+    )
+    parser.add_argument(
+        "--filters",
+        help="With --datastore, only pull rows matching these values, as JSON: {\"column\": \"value\"} or {\"column\": [\"value\", ...]}"
+    )
+    parser.add_argument(
+        "--datastore_workers",
+        type=int,
+        default=4,
+        help="With --datastore, number of pages of each resource requested at the same time (default: 4)"
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running in the background, downloading packages again whenever they change upstream and retrying the ones that failed"
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=60,
+        help="With --daemon, minutes between checks for packages that changed upstream (default: 60)"
+    )
+    parser.add_argument(
+        "--job_queue",
+        default="job_queue.sqlite",
+        help="With --daemon, the SQLite file that keeps track of what has been done, so a restart carries on where it left off (default: job_queue.sqlite)"
+    )
+    parser.add_argument(
+        "--metrics_file",
+        help="Write timing and throughput metrics for each stage to this file at the end of the run (after every cycle with --daemon). A .prom file gets the Prometheus text format, anything else a JSON line per write"
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        help="Serve the metrics on this local port while the pipeline runs, at /metrics (Prometheus) and /metrics.json"
+    )
     parser.add_argument(
         "--to_db",
         action="store_true",
         help="Set this flag if you want to automatically ingest the CSV files into a database after download"
     )
+    parser.add_argument(
+        "--stream_to_db",
+        action="store_true",
+        help="Stream each download straight into the database as it arrives, instead of loading the CSV files after download"
+    )
+    parser.add_argument(
+        "--skip_csv",
+        action="store_true",
+        help="With --stream_to_db, don't keep the CSV files on disk"
+    )
+    parser.add_argument(
+        "--column_aliases",
+        help="With --to_db, --stream_to_db or --dataset, a JSON file of explicit column renames per package, as {\"package\": {\"old column\": \"new column\"}}"
+    )
+    parser.add_argument(
+        "--db_connections",
+        type=int,
+        default=4,
+        help="With --to_db, number of packages loaded into the database at the same time, each over its own connection. With --stream_to_db, number of resources streamed at the same time (default: 4)"
+    )
     return parser
\ No newline at end of file
@@ -0,0 +1,190 @@
+import json, logging, os, re
+from typing import Optional
+import requests
+from data_functions import CHUNK_SIZE
+
+PART_SUFFIX = ".part"
+CHECKPOINT_SUFFIX = ".part.json"
+
+
+def get_part_path(storage_root: str, resource: dict) -> str:
+    """
+    Returns the path of the partial-download file for a resource, next to where the final CSV will go.
+    """
+    return os.path.join(storage_root, resource['package_name'], resource['name'] + PART_SUFFIX)
+
+
+def expected_size(resource: dict) -> Optional[int]:
+    """
+    Returns the size in bytes CKAN reports for the resource, or None if it isn't filled in.
+    """
+    size = str(resource.get('size') or '').strip()
+    return int(size) if size.isdigit() else None
+
+
+def read_checkpoint(part_path: str) -> dict:
+    try:
+        with open(part_path[:-len(PART_SUFFIX)] + CHECKPOINT_SUFFIX, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_checkpoint(part_path: str, checkpoint: dict):
+    with open(part_path[:-len(PART_SUFFIX)] + CHECKPOINT_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+
+
+def discard_part(part_path: str):
+    """
+    Deletes a partial download and its checkpoint.
+    """
+    for file_path in (part_path, part_path[:-len(PART_SUFFIX)] + CHECKPOINT_SUFFIX):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def part_size(part_path: str) -> int:
+    try:
+        return os.path.getsize(part_path)
+    except FileNotFoundError:
+        return 0
+
+
+def total_size(resource: dict, part_path: str) -> Optional[int]:
+    """
+    The size the finished download should have: what the server reported when the download
+    started, or failing that the CKAN size field.
+    """
+    return read_checkpoint(part_path).get('total') or expected_size(resource)
+
+
+def part_is_complete(resource: dict, part_path: str) -> bool:
+    """
+    Checks whether a partial download from an earlier attempt or run already holds the whole file
+    of the resource's current revision.
+    """
+    if read_checkpoint(part_path).get('revision_id') != resource.get('revision_id'):
+        return False
+    total = total_size(resource, part_path)
+    return total is not None and part_size(part_path) == total and os.path.exists(part_path)
+
+
+def resume_headers(logger: logging.Logger, resource: dict, part_path: str) -> dict:
+    """
+    Builds the headers for downloading a resource, picking up from a partial download if there is one.
+
+    If-Range makes the server send the whole file instead of a range if it has changed since the
+    partial download started. A partial download of an older revision of the resource is thrown away.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource (dict): A dictionary with information about the resource.
+        part_path (str): Path of the partial-download file.
+
+    Returns:
+        A dictionary of request headers.
+    """
+    # ask for the raw bytes so that offsets in the file match the offsets on the server
+    headers = {'Accept-Encoding': 'identity'}
+    offset = part_size(part_path)
+    if not offset:
+        return headers
+
+    checkpoint = read_checkpoint(part_path)
+    if checkpoint.get('revision_id') != resource.get('revision_id'):
+        logger.info(f"Discarding a partial download of an older revision of {resource['name']}.")
+        discard_part(part_path)
+        return headers
+
+    logger.info(f"Resuming {resource['name']} from byte {offset}.")
+    headers['Range'] = f"bytes={offset}-"
+    validator = checkpoint.get('etag') or checkpoint.get('last_modified')
+    if validator:
+        headers['If-Range'] = validator
+    return headers
+
+
+def stream_to_part(
+        logger: logging.Logger,
+        resource: dict,
+        response: requests.Response,
+        part_path: str,
+        chunk_size: int = CHUNK_SIZE,
+        ) -> bool:
+    """
+    Writes the raw body of a download to the partial-download file.
+
+    A 206 Partial Content response is appended to what's already there. A 200 response means the
+    server sent the whole file, so the partial file is started over.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource (dict): A dictionary with information about the resource.
+        response (requests.Response): A response opened with stream=True.
+        part_path (str): Path of the partial-download file.
+        chunk_size (int): Number of bytes read from the network at a time.
+
+    Returns:
+        True if the whole body was received, False if the connection dropped before the end.
+        Whatever arrived is kept, so the next attempt can resume from there.
+    """
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+
+    if response.status_code == 206:
+        mode = "ab"
+        checkpoint = read_checkpoint(part_path)
+        match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", response.headers.get('Content-Range', ''))
+        if not match or int(match.group(1)) != part_size(part_path):
+            logger.warning(f"The server sent an unexpected range for {resource['name']}, starting over.")
+            response.close()
+            discard_part(part_path)
+            return False
+        if match.group(2) != '*':
+            checkpoint['total'] = int(match.group(2))
+    else:
+        mode = "wb"
+        length = response.headers.get('Content-Length')
+        checkpoint = {
+            'revision_id': resource.get('revision_id'),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'total': int(length) if length and length.isdigit() else None,
+        }
+    write_checkpoint(part_path, checkpoint)
+
+    try:
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+        return True
+    except requests.RequestException as e:
+        logger.warning(f"The connection dropped while downloading {resource['name']} after {part_size(part_path)} bytes: {e.__class__.__name__}")
+        return False
+    finally:
+        response.close()
+
+
+def verify_part(logger: logging.Logger, resource: dict, part_path: str) -> bool:
+    """
+    Checks a finished partial download against the size the server announced and the CKAN size field.
+
+    CKAN's size can lag behind the file, so when it disagrees with the download that's logged but
+    not treated as a failure. Only a file shorter than the length the server announced is incomplete.
+
+    Returns:
+        True if the file is complete.
+    """
+    received = part_size(part_path)
+    server_total = read_checkpoint(part_path).get('total')
+    ckan_size = expected_size(resource)
+
+    if server_total is not None and received != server_total:
+        logger.error(f"{resource['name']} is incomplete: got {received} of {server_total} bytes.")
+        return False
+    if ckan_size is not None and received != ckan_size:
+        if server_total is None:
+            logger.warning(f"{resource['name']} is {received} bytes, the server didn't say how long it is and CKAN lists it as {ckan_size}.")
+        else:
+            logger.warning(f"{resource['name']} is {received} bytes as the server said, but CKAN lists it as {ckan_size}.")
+    return True
@@ -1,8 +1,26 @@
 import logging, requests, time, os
-from typing import Optional
-from data_functions import download_resource, request_resource_library, token_required, process_resource_library, convert_to_csv, save_csv
+from typing import Optional, TYPE_CHECKING
+from functools import partial
+from contextlib import nullcontext
+from data_functions import download_resource, request_resource_library, token_required, process_resource_library, iter_file_chunks, decode_csv_chunks, write_text_chunks, PACKAGE_SHOW_URL, CHUNK_SIZE
 from reporting import Report
-import pandas as pd
+from metrics import Metrics, TimedIterator, count_bytes
+from concurrency import HostLimiter
+from sync_state import SyncState
+from blob_store import BlobStore
+from storage import stored_name, find_stored, remove_other_versions
+from metadata_cache import MetadataCache
+from tag_index import TagIndex
+from retry_scheduler import RETRY_STATUSES, CircuitOpen, RetryLater, backoff_delay, retry_after_seconds, run_with_retries
+from datastore import DatastoreQuery, iter_datastore_csv
+from partial_download import get_part_path, part_is_complete, part_size, resume_headers, stream_to_part, verify_part, discard_part
+
+# stream_load pulls in psycopg2, so it's only imported for type checking here.
+if TYPE_CHECKING:
+    from stream_load import StreamingLoader
+
+# Statuses that trying the same request again won't change.
+FINAL_STATUSES = (200, 206, 304, 416)
 
 def persistant_request(
         logger: logging.Logger,
@@ -11,100 +29,243 @@ def persistant_request(
         package: str = None,
         backoff_factor: int = 2,
         max_retries: int = 3,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        headers: Optional[dict] = None,
+        slot_held: bool = False,
         ) -> Optional[requests.Response]:
     
     """
     A function for making multiple tries at retrieving package info and resources.
     Works on requests for both packages and resources
 
+    The pipeline itself calls this with max_retries=1 and leaves retrying to the retry queue
+    (see retry_scheduler.run_with_retries), so no worker sleeps through a backoff. With more
+    tries it waits between them with jittered exponential backoff, which blocks the calling thread.
+
     Args:
         logger (logging.Logger): A logging instance for recording events.
         resource (dict): A dictionary with information about the resource. If getting a package, leave None.
         package (str): Name of an Open Data BCN package containing multiple resources. If getting a resource, leave None.
         backoff_factor (int): Keeps the script from hammering the servers too much.
         max_retries (int): Maximum number of times the loop retries the request
+        limiter (HostLimiter): Optional per-host limiter. A slot is held only while the request is in flight, 
+            not during backoff, and it's told how every request went so it can adapt the request rate.
+        session (requests.Session): Optional pooled session shared by every request.
+        headers (dict): Optional extra headers for a resource download, e.g. for a conditional request.
+        slot_held (bool): The caller already holds the limiter's slot for the URL (see download_slot), so
+            the request doesn't take another. The limiter is still told how the request went.
 
     Returns:
         A request.Response object if a response is received, or None if no response is received.
+        Only 429/5xx answers and missing responses are retried; anything else is returned straight
+        away for the caller to handle.
+
+    Raises:
+        CircuitOpen if the limiter's circuit breaker for the host is open.
     """
 
     attempts_remaining = max_retries
+    response = None
+    url = resource.get('url') if resource else PACKAGE_SHOW_URL
 
     while attempts_remaining > 0:
-        # This is to check if the function call is for a resource or a package.
-        if resource:
-            response = download_resource(logger, resource)
-        else:
-            response = request_resource_library(logger, package)
-            
-            
+        with limiter.slot(url) if limiter and url and not slot_held else nullcontext():
+            # This is to check if the function call is for a resource or a package.
+            if resource:
+                response = download_resource(logger, resource, session=session, headers=headers)
+            else:
+                response = request_resource_library(logger, package, session=session)
 
-        if response and response.status_code == 200:
+        status = response.status_code if response is not None else None
+        if limiter and url:
+            limiter.record(
+                url, 
+                status, 
+                response.elapsed.total_seconds() if response is not None else None,
+                retry_after_seconds(response),
+                )
+
+        if status is not None and status not in RETRY_STATUSES:
             return response
-        else:
-            if response:
-                status = response.status_code
-            else:
-                status = "No response."
-            logger.error(f"Problem with response from server: {status}.")
-            report.num_errors += 1
-            attempts_remaining -= 1
 
-            if attempts_remaining > 0:
-                wait_time = backoff_factor * (2 ** (max_retries - attempts_remaining))
-                logger.info(f"Trying again in {wait_time} seconds...")
-                time.sleep(wait_time)
+        if response is not None:
+            # hand the connection back to the pool, the body of a failed response isn't needed
+            response.close()
+        logger.warning(f"Problem with response from server: {status or 'No response.'}")
+        attempts_remaining -= 1
 
+        if attempts_remaining > 0:
+            wait_time = retry_after_seconds(response) or backoff_delay(max_retries - attempts_remaining - 1, backoff_factor)
+            logger.info(f"Trying again in {wait_time:.0f} seconds...")
+            time.sleep(wait_time)
+
+    if max_retries > 1:
         logger.warning(f"Out of attempts.")
-        return response
+    return response
     
-def main_pipeline(
-        logger: logging.Logger, 
-        package: str, 
-        storage_root: str) -> dict:
+def download_slot(limiter: Optional[HostLimiter], resource: dict):
     """
-    This is the main pipeline for the script. 
-    It takes a package name and then attempts to download all the resources in the package.
-    It then returns a report for further processing in case of failures or errors.
+    A limiter slot for downloading a resource, to hold from the request until the response has been
+    read and closed. Downloads are streamed, so a slot held only for the request would be given back
+    as soon as the headers arrive and the limits would no longer cap the transfers.
+    """
+    return limiter.slot(resource['url']) if limiter and resource.get('url') else nullcontext()
+
+def fetch_package_metadata(
+        logger: logging.Logger,
+        package: str,
+        report: Report,
+        package_retries: int = 3,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        metadata_cache: Optional[MetadataCache] = None,
+        ) -> Optional[dict]:
+    """
+    Gets the package_show payload for a package, from the metadata cache if there's a fresh copy
+    and otherwise from Open Data BCN (caching the answer).
 
     Args:
         logger (logging.Logger): A logging instance for recording events.
         package (str): The name of a BCN Open Data package.
-    
-    Returns: 
-        report (dict): Full report on the results.
+        report (Report): A Report object to be updated as the function works.
+        package_retries (int): Number of tries at getting the package's resource list.
+        limiter (HostLimiter): Optional per-host limiter.
+        session (requests.Session): Optional pooled session.
+        metadata_cache (MetadataCache): Optional on-disk cache of package_show payloads.
+
+    Returns:
+        The decoded package_show payload, or None if it couldn't be retrieved.
     """
-    start_time = time.time()
-    report = Report(package, start_time)
-    
-    package.strip()
-    logger.info("-------------------------------------------")
+    cache_key = f"package_show:{package}"
+    if metadata_cache:
+        data = metadata_cache.get(cache_key)
+        if data is not None:
+            logger.info(f"Using cached metadata for the {package} data package.")
+            if report.metrics:
+                report.metrics.increment("metadata_cache_hits")
+            return data
+
     logger.info(f"Sending GET request for list of resources in the {package} data package...")
     
-    response = persistant_request(logger, package=package, report=report)
+    try:
+        with report.stage("metadata"):
+            response = persistant_request(
+                logger, 
+                package=package, 
+                report=report, 
+                max_retries=package_retries,
+                limiter=limiter,
+                session=session,
+                )
+    except CircuitOpen as e:
+        logger.error(f"Not asking for the {package} package's resource list, {e}.")
+        report.add_error()
+        return None
     
     if response is None:
         logger.error(f"Failed to access the {package} package's resource list, skipping to the next package...")
-        report.num_errors += 1
-        return report
+        report.add_error()
+        return None
     elif not response.status_code == 200:
         logger.error(f"Couldn't retrieve {package} package resources.")
         logger.error(f"Response code: {response.status_code}")
-        report.num_errors += 1
+        report.add_error()
         logger.info(f'Seconds to response: {response.elapsed.total_seconds():.2f}')
         report.process_package_response(response)
-        return report
+        return None
     else:
         logger.info(f'Response code: {response.status_code}')
         logger.info(f'Seconds to response: {response.elapsed.total_seconds():.2f}')
         report.process_package_response(response)
 
-    resource_list = process_resource_library(logger, response, package)
+    try:
+        data = response.json()
+    except ValueError as e:
+        logger.error(f"The resource list for {package} isn't valid JSON: {e}")
+        report.add_error()
+        return None
+
+    if metadata_cache and data.get('success', True):
+        metadata_cache.put(cache_key, data)
+    return data
+
+def main_pipeline(
+        logger: logging.Logger, 
+        package: str, 
+        storage_root: str,
+        workers: int = 1,
+        limiter: Optional[HostLimiter] = None,
+        package_retries: int = 3,
+        session: Optional[requests.Session] = None,
+        metadata_cache: Optional[MetadataCache] = None,
+        stream_loader: Optional["StreamingLoader"] = None,
+        save_csv_files: bool = True,
+        output_format: str = "csv",
+        resource_attempts: int = 4,
+        metrics: Optional[Metrics] = None,
+        datastore_query: Optional[DatastoreQuery] = None,
+        blob_store: Optional[BlobStore] = None,
+        compression: str = "none",
+        ) -> dict:
+    """
+    This is the main pipeline for the script. 
+    It takes a package name and then attempts to download all the resources in the package.
+    It then returns a report for further processing in case of failures or errors.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        package (str): The name of a BCN Open Data package.
+        storage_root (str): the root directory where the downloaded CSV files will be saved.
+        workers (int): Number of resources to download at the same time. 1 downloads them one after another.
+        limiter (HostLimiter): Optional per-host limiter shared by all the workers.
+        package_retries (int): Number of tries at getting the package's resource list.
+        session (requests.Session): Optional pooled session, so connections are reused across requests.
+        metadata_cache (MetadataCache): Optional on-disk cache of package_show payloads.
+        stream_loader (StreamingLoader): Optional loader that streams each download straight into the 
+            package's table as it arrives (see stream_resource_to_db).
+        save_csv_files (bool): When streaming into the database, also keep the CSV files on disk.
+        output_format (str): "parquet" or "feather" to also convert every saved CSV to a columnar file
+            (see columnar.write_columnar). CSVs that are already up to date are converted without downloading them again.
+        resource_attempts (int): Number of times a resource is tried when the server is struggling. Between tries
+            it waits in a retry queue while the other resources carry on (see retry_scheduler.run_with_retries).
+        metrics (Metrics): Optional metrics that the stage timings, counts and queue depths are added to.
+        datastore_query (DatastoreQuery): Optionally pull the resources that are in CKAN's DataStore through
+            datastore_search, with only the columns and rows the query selects (see get_datastore_resource).
+            Resources that aren't in the DataStore are downloaded in full. Not used when streaming into the database.
+        blob_store (BlobStore): Optional content-addressed store the CSV files are saved through, so identical
+            files are kept once and files with a known hash aren't downloaded again (see blob_store.BlobStore).
+        compression (str): "gzip" or "zstd" to store the CSV files compressed as they're written. Files
+            already saved with another setting are read as they are and aren't downloaded again for it.
+    
+    Returns: 
+        report (dict): Full report on the results.
+    """
+    start_time = time.time()
+    report = Report(package, start_time, metrics)
+    
+    package.strip()
+    logger.info("-------------------------------------------")
+
+    data = fetch_package_metadata(
+        logger,
+        package,
+        report,
+        package_retries=package_retries,
+        limiter=limiter,
+        session=session,
+        metadata_cache=metadata_cache,
+        )
+    if data is None:
+        return report.finish()
+    report.revision = (data.get('result') or {}).get('metadata_modified')
+
+    resource_list = process_resource_library(logger, data, package)
 
     if not resource_list:
         logger.error(f"Failed to process this package's resource list, skipping to the next package...")
-        report.num_errors += 1
-        return report
+        report.add_error()
+        return report.finish()
 
     logger.info(f'Successfully collected details on resources belonging to the {package} data package.')
     report.package_success = True
@@ -113,92 +274,495 @@ def main_pipeline(
     logger.info(f"This package contains a total of {len(resource_list)} resources.")
     logger.info("////////////////////////////////////////////////////////")
 
-    # this is to check if the file has already been downloaded
-    save_path = os.path.join(storage_root, package)
-    try: 
-        existing_downloads = os.listdir(save_path)
-    except FileNotFoundError:
-        existing_downloads = []
+    streaming = stream_loader is not None and stream_loader.prepare_package(package)
+    if stream_loader and not streaming and not save_csv_files:
+        logger.error(f"The {package} package can't be streamed into the database and CSV files aren't being kept, skipping it.")
+        report.add_error()
+        return report.finish()
+
+    def from_datastore(resource: dict) -> bool:
+        return datastore_query is not None and not streaming and bool(resource.get('datastore_active'))
+
+    # this is to check if the resource is new or has changed upstream since it was last downloaded
+    sync_state = SyncState(os.path.join(storage_root, package))
+    to_download = []
+    to_convert = []
     for resource in resource_list:
-        if resource['name'] not in existing_downloads:
-            get_resource(logger, resource, report, storage_root)
+        query = datastore_query.key() if from_datastore(resource) else None
+        # when streaming, what's loaded in the database counts as much as what's on disk
+        if streaming and stream_loader.needs_load(package, resource):
+            to_download.append(resource)
+        elif (not streaming or save_csv_files) and sync_state.needs_update(resource, query):
+            to_download.append(resource)
         else:
-            report.skipped += 1
+            report.add_skipped()
+            if needs_columnar(storage_root, resource, output_format):
+                to_convert.append(resource)
+    if sync_state.resources:
+        sync_state.save()
 
-    return report
+    fetch = partial(
+        stream_resource_to_db if streaming else get_resource, 
+        logger, 
+        report=report, 
+        storage_root=storage_root, 
+        limiter=limiter, 
+        session=session, 
+        sync_state=sync_state,
+        output_format=output_format,
+        blob_store=blob_store,
+        compression=compression,
+        )
+    if streaming:
+        fetch = partial(fetch, stream_loader=stream_loader, save_csv_files=save_csv_files)
+    elif datastore_query is not None:
+        download = fetch
+        pull = partial(
+            get_datastore_resource,
+            logger,
+            report=report,
+            storage_root=storage_root,
+            query=datastore_query,
+            limiter=limiter,
+            session=session,
+            sync_state=sync_state,
+            output_format=output_format,
+            blob_store=blob_store,
+            compression=compression,
+            )
+        fetch = lambda resource: pull(resource) if from_datastore(resource) else download(resource)
+
+    def give_up(resource, error):
+        report.add_error()
+        report.add_resources_fail(resource)
+
+    if workers > 1 and len(to_download) > 1:
+        logger.info(f"Downloading {len(to_download)} resources with {workers} workers.")
+    run_with_retries(
+        logger,
+        fetch,
+        to_download,
+        workers=workers,
+        max_attempts=resource_attempts,
+        name=lambda resource: resource['name'],
+        on_retry=lambda resource, error, delay: report.add_retry(),
+        on_give_up=give_up,
+        on_error=give_up,
+        thread_name_prefix=package,
+        metrics=metrics,
+        )
+
+    for resource in to_convert:
+        save_columnar(logger, resource, report, storage_root, output_format)
+
+    return report.finish()
+
+def needs_columnar(storage_root: str, resource: dict, output_format: str = "csv") -> bool:
+    """
+    Checks whether a saved CSV still has to be converted to the columnar output format.
+    """
+    if output_format == "csv" or not find_stored(os.path.join(storage_root, resource['package_name']), resource['name']):
+        return False
+    # columnar is imported here so CSV-only runs never load pyarrow or pandas
+    from columnar import columnar_is_current
+    return not columnar_is_current(storage_root, resource, output_format)
+
+def save_columnar(
+        logger: logging.Logger, 
+        resource: dict, 
+        report: Report, 
+        storage_root: str, 
+        output_format: str = "csv",
+        ):
+    """
+    Converts a saved CSV resource to the columnar output format, if one was chosen. A failed
+    conversion counts as an error, but the CSV stays and the conversion is tried again on the next run.
+    """
+    if output_format == "csv":
+        return
+    from columnar import write_columnar
+    with report.stage("columnar"):
+        written = write_columnar(logger, resource, storage_root, output_format)
+    if not written:
+        report.add_error()
 
 def get_resource(
         logger: logging.Logger, 
         resource: dict, 
         report: Report, 
-        storage_root: str
+        storage_root: str,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        sync_state: Optional[SyncState] = None,
+        resume_attempts: int = 5,
+        output_format: str = "csv",
+        blob_store: Optional[BlobStore] = None,
+        compression: str = "none",
         ):
     """
     A pipeline function that downloads and saves a single CSV resource and updates the report for the package.
 
+    The raw download goes to a .part file next to the final CSV. If the connection drops, the download
+    is resumed with a Range request instead of starting over, and a .part left by an earlier run is
+    picked up where it stopped. The CSV is only written once the .part has been checked against the
+    expected size.
+
     Args:
         logger (logging.Logger): A logging instance for recording events.
         resource (dict): A dictionary with all the information on the resource.
         report (Report): A Report object to be updated as the function works.
         storage_root (str): the root directory where the downloaded CSV files will be saved. Default (from parser) is '.'.
+        limiter (HostLimiter): Optional per-host limiter passed on to persistant_request.
+        session (requests.Session): Optional pooled session passed on to persistant_request.
+        sync_state (SyncState): Optional sync-state manifest for the package. Used for conditional requests and updated after a successful download.
+        resume_attempts (int): Number of times in a row an interrupted download is resumed before it goes back to the retry queue.
+        output_format (str): "parquet" or "feather" to also convert the saved CSV (see save_columnar).
+        blob_store (BlobStore): Optional content-addressed store the CSV is saved through. If CKAN published
+            a hash for the resource and a file with that hash is already stored, it's linked instead of downloaded.
+        compression (str): "gzip" or "zstd" to store the CSV compressed (see storage.compressed_writer).
 
     Returns:
         None, but its actions are recorded in the report object.
+
+    Raises:
+        RetryLater if the server is struggling or the connection keeps dropping, so the resource
+        can wait in the retry queue (a .part file is kept to resume from).
     """
 
     logger.info(f'Sending a request for {resource["name"]}.')
     if token_required(logger, resource) is True:
         logger.error(f"Sorry, a token is required to access {resource['name']}")
-        report.num_errors += 1
+        report.add_error()
+        return
+
+    package_dir = os.path.join(storage_root, resource['package_name'])
+    final_path = os.path.join(package_dir, stored_name(resource['name'], compression))
+    if blob_store and resource.get('hash') and blob_store.link_upstream(stored_name(resource['hash'], compression), final_path):
+        remove_other_versions(package_dir, resource['name'], keep=final_path)
+        logger.info(f"A file with the same hash as {resource['name']} is already stored, linked it instead of downloading.")
+        if report.metrics:
+            report.metrics.increment("downloads_deduplicated")
+        report.add_resources_success(resource)
+        if sync_state:
+            sync_state.record(resource)
+            sync_state.save()
+        save_columnar(logger, resource, report, storage_root, output_format)
         return
     
-    response = persistant_request(
-        logger, 
-        report=report, 
-        resource=resource
-        )
-    
-    if response is None:
-        logger.error(f"Failed to download {resource['name']}. Trying next resource...")
-        report.num_errors += 1
+    part_path = get_part_path(storage_root, resource)
+    response = None
+    complete = part_is_complete(resource, part_path)
+    attempts_remaining = resume_attempts
+
+    while not complete and attempts_remaining > 0:
+        attempts_remaining -= 1
+        headers = resume_headers(logger, resource, part_path)
+        if 'Range' not in headers and sync_state:
+            headers.update(sync_state.conditional_headers(resource))
+
+        # the slot is held until the body has been read, so the host and budget limits cap the transfers themselves
+        with download_slot(limiter, resource):
+            response = persistant_request(
+                logger, 
+                report=report, 
+                resource=resource,
+                max_retries=1,
+                limiter=limiter,
+                session=session,
+                headers=headers,
+                slot_held=True,
+                )
+        
+            if response is None or response.status_code in RETRY_STATUSES:
+                status = response.status_code if response is not None else "no response"
+                raise RetryLater(f"the download failed ({status})", retry_after_seconds(response))
+            elif response.status_code == 304:
+                logger.info(f"{resource['name']} has new metadata but the server says the file hasn't changed.")
+                response.close()
+                report.add_skipped()
+                if sync_state:
+                    sync_state.record(resource, response)
+                    sync_state.save()
+                return
+            elif response.status_code == 416:
+                logger.warning(f"The server couldn't resume {resource['name']}, starting over.")
+                response.close()
+                discard_part(part_path)
+                continue
+            elif response.status_code not in (200, 206):
+                logger.error(f"Couldn't download {resource['name']}.")
+                logger.error(f"Response code: {response.status_code}")
+                response.close()
+                logger.info(f'Seconds to response: {response.elapsed.total_seconds():.2f}')
+                report.add_error()
+                report.process_resource_response(response, resource)
+                return
+
+            logger.info(f'Response code: {response.status_code}')
+            logger.info(f'Seconds to response: {response.elapsed.total_seconds():.2f}')
+            report.add_to_total_duration(response.elapsed.total_seconds())
+            with report.stage("download") as download:
+                received = part_size(part_path) if response.status_code == 206 else 0
+                complete = stream_to_part(logger, resource, response, part_path)
+                download.bytes = part_size(part_path) - received
+
+    if not complete:
+        raise RetryLater(f"the connection kept dropping, the {part_size(part_path)} bytes received are kept to resume from")
+
+    if not verify_part(logger, resource, part_path):
+        discard_part(part_path)
+        report.add_error()
         report.add_resources_fail(resource)
         return
-    elif not response.status_code == 200:
-        logger.error(f"Couldn't download {resource['name']}.")
-        logger.error(f"Response code: {response.status_code}")
-        logger.info(f'Seconds to response: {response.elapsed.total_seconds():.2f}')
-        report.num_errors += 1
-        report.process_resource_response(response, resource)
-        return
+
+    # decoding happens as the CSV is written, so the time spent producing the text is taken out of the save
+    with report.stage("save") as save:
+        text_chunks = TimedIterator(decode_csv_chunks(logger, iter_file_chunks(part_path), resource['name']))
+        saved = write_text_chunks(
+            logger, resource, text_chunks, path=storage_root, blob_store=blob_store, upstream_hash=resource.get('hash'),
+            compression=compression,
+            )
+        save.exclude(text_chunks.seconds)
+        save.rows = text_chunks.rows
+        if saved:
+            save.bytes = os.path.getsize(final_path)
+    report.record_stage("decode", text_chunks.seconds, part_size(part_path), text_chunks.rows)
+
+    if saved:
+        discard_part(part_path)
+        report.add_resources_success(resource)
+        if sync_state:
+            sync_state.record(resource, response)
+            sync_state.save()
+        save_columnar(logger, resource, report, storage_root, output_format)
+        logger.info(f"{len(report.resources_success)} of {report.num_resources} resources collected.")
+        logger.info('■'*len(report.resources_success))
     else:
-        logger.info(f'Response code: {response.status_code}')
-        logger.info(f'Seconds to response: {response.elapsed.total_seconds():.2f}')
-        report.process_resource_response(response, resource)
+        logger.error(f"Could not save {resource['name']} to disk.")
+        report.add_error()
+        report.add_resources_fail(resource)
 
-    
-    csv = convert_to_csv(logger, response)
-    saved = save_csv(logger, resource, csv, path=storage_root) if csv else False
+def get_datastore_resource(
+        logger: logging.Logger, 
+        resource: dict, 
+        report: Report, 
+        storage_root: str,
+        query: DatastoreQuery,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        sync_state: Optional[SyncState] = None,
+        output_format: str = "csv",
+        blob_store: Optional[BlobStore] = None,
+        compression: str = "none",
+        ):
+    """
+    A pipeline function that pulls a resource's rows from CKAN's DataStore instead of downloading
+    the whole file, and saves them as the resource's CSV.
+
+    Only the columns and rows the query selects are sent by the server (see datastore.iter_datastore_csv),
+    so a targeted pull of a big resource transfers a fraction of the file. The pages are validated
+    and written like a downloaded file (see data_functions.decode_csv_chunks), and from there go to
+    the columnar and database stages like any other CSV.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource (dict): A dictionary with all the information on the resource.
+        report (Report): A Report object to be updated as the function works.
+        storage_root (str): the root directory where the CSV files are saved.
+        query (DatastoreQuery): The columns and rows to pull.
+        limiter (HostLimiter): Optional per-host limiter.
+        session (requests.Session): Optional pooled session.
+        sync_state (SyncState): Optional sync-state manifest for the package, updated with the query after a successful pull.
+        output_format (str): "parquet" or "feather" to also convert the saved CSV (see save_columnar).
+        blob_store (BlobStore): Optional content-addressed store the CSV is saved through.
+        compression (str): "gzip" or "zstd" to store the CSV compressed.
+
+    Returns:
+        None, but its actions are recorded in the report object.
+
+    Raises:
+        RetryLater if the server is struggling, so the resource can wait in the retry queue.
+    """
+    logger.info(f'Pulling {resource["name"]} from the DataStore.')
+    if token_required(logger, resource) is True:
+        logger.error(f"Sorry, a token is required to access {resource['name']}")
+        report.add_error()
+        return
+
+    # the pages are fetched while the file is written, so the download and save are timed as one stage
+    with report.stage("download") as download:
+        pages = iter_datastore_csv(logger, resource, query, limiter=limiter, session=session, timer=download)
+        # the pages go through the same checks as a downloaded file, so bad rows are logged with their line number
+        text_chunks = TimedIterator(decode_csv_chunks(logger, (page.encode("utf-8") for page in pages), resource['name']))
+        # CKAN's hash is for the whole file, not this selection of it, so it isn't passed on
+        saved = write_text_chunks(
+            logger, resource, text_chunks, path=storage_root, blob_store=blob_store, compression=compression,
+            )
+        download.rows = max(0, text_chunks.rows - 1)
 
     if saved:
+        report.add_resources_success(resource)
+        if sync_state:
+            sync_state.record(resource, query=query.key())
+            sync_state.save()
+        save_columnar(logger, resource, report, storage_root, output_format)
         logger.info(f"{len(report.resources_success)} of {report.num_resources} resources collected.")
         logger.info('■'*len(report.resources_success))
     else:
         logger.error(f"Could not save {resource['name']} to disk.")
-        report.num_errors += 1
-
-def get_packages(tags: list[str]) -> list[str]:
-    """
-    Returns a list of all packages with the submitted tags.
-    """
-    df = pd.read_csv("catalog_tags.csv")
-    packages = []
-    for tag in tags:
-        result = df.loc[
-            df['tags_list'].apply(
-                lambda x: isinstance(x, str) and tag.lower() in [t.strip().lower() for t in x.split(',')]
-                ),
-                'name'
-        ]
-        packages.extend(result.to_list())
-    packages = list(set(packages))
-    return packages
\ No newline at end of file
+        report.add_error()
+        report.add_resources_fail(resource)
+
+def stream_resource_to_db(
+        logger: logging.Logger, 
+        resource: dict, 
+        report: Report, 
+        storage_root: str,
+        stream_loader: "StreamingLoader",
+        save_csv_files: bool = True,
+        limiter: Optional[HostLimiter] = None,
+        session: Optional[requests.Session] = None,
+        sync_state: Optional[SyncState] = None,
+        attempts: int = 3,
+        output_format: str = "csv",
+        blob_store: Optional[BlobStore] = None,
+        compression: str = "none",
+        ):
+    """
+    A pipeline function that streams a single CSV resource straight into its package's table.
+
+    Decoded chunks go from the HTTP response into a bounded queue that feeds a COPY running over a
+    pooled connection, so the file never has to be written to disk and read back. If save_csv_files
+    is set, the same chunks are also written to the CSV file as they pass through.
+
+    A COPY can't be resumed, so if the connection drops the resource's transaction is rolled back
+    and the download starts over, up to the number of attempts.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        resource (dict): A dictionary with all the information on the resource.
+        report (Report): A Report object to be updated as the function works.
+        storage_root (str): the root directory where the CSV files are saved if save_csv_files is set.
+        stream_loader (StreamingLoader): The loader that runs the COPYs.
+        save_csv_files (bool): Also write the CSV file to disk.
+        limiter (HostLimiter): Optional per-host limiter passed on to persistant_request.
+        session (requests.Session): Optional pooled session passed on to persistant_request.
+        sync_state (SyncState): Optional sync-state manifest for the package, updated after a successful load.
+        attempts (int): Number of times the resource is downloaded before giving up.
+        output_format (str): "parquet" or "feather" to also convert the saved CSV, if save_csv_files is set (see save_columnar).
+        blob_store (BlobStore): Optional content-addressed store the CSV is saved through, if save_csv_files is set.
+        compression (str): "gzip" or "zstd" to store the CSV compressed, if save_csv_files is set.
+
+    Returns:
+        None, but its actions are recorded in the report object.
+
+    Raises:
+        RetryLater if the server is struggling, so the resource can wait in the retry queue.
+    """
+
+    logger.info(f'Sending a request for {resource["name"]} to stream into the database.')
+    if token_required(logger, resource) is True:
+        logger.error(f"Sorry, a token is required to access {resource['name']}")
+        report.add_error()
+        return
+
+    for _ in range(attempts):
+        with download_slot(limiter, resource):
+            response = persistant_request(
+                logger, 
+                report=report, 
+                resource=resource,
+                max_retries=1,
+                limiter=limiter,
+                session=session,
+                slot_held=True,
+                )
+
+            if response is None or response.status_code in RETRY_STATUSES:
+                status = response.status_code if response is not None else "no response"
+                raise RetryLater(f"the download failed ({status})", retry_after_seconds(response))
+            if not response.status_code == 200:
+                logger.error(f"Failed to download {resource['name']}. Trying next resource...")
+                logger.error(f"Response code: {response.status_code}")
+                response.close()
+                report.add_error()
+                report.add_resources_fail(resource)
+                return
+
+            logger.info(f'Response code: {response.status_code}')
+            logger.info(f'Seconds to response: {response.elapsed.total_seconds():.2f}')
+            report.add_to_total_duration(response.elapsed.total_seconds())
+
+            stream = None
+            # the download, decode and COPY all run at once here, so they're timed as one "download"
+            # stage; the database side is timed on its own by the stream loader
+            with report.stage("download") as download:
+                try:
+                    raw_chunks = count_bytes(response.iter_content(chunk_size=CHUNK_SIZE), download)
+                    text_chunks = decode_csv_chunks(logger, raw_chunks, resource['name'])
+                    first_text = next(text_chunks, None)
+                    if first_text is None:
+                        logger.warning(f"{resource['name']} appears to be empty.")
+                        report.add_error()
+                        report.add_resources_fail(resource)
+                        return
+                    stream = stream_loader.open_stream(resource['package_name'], resource, first_text)
+
+                    def feed():
+                        yield first_text
+                        for text in text_chunks:
+                            stream.put(text)
+                            yield text
+
+                    if save_csv_files:
+                        if not write_text_chunks(
+                                logger, resource, feed(), path=storage_root, blob_store=blob_store, upstream_hash=resource.get('hash'),
+                                compression=compression,
+                                ):
+                            raise RuntimeError(f"could not save {resource['name']} to disk")
+                    else:
+                        for _ in feed():
+                            pass
+
+                    loaded = stream.finish()
+                except Exception as e:
+                    logger.error(f"Streaming {resource['name']} into the database failed: {e.__class__.__name__} - {e}")
+                    if stream:
+                        stream.abort(e)
+                    loaded = False
+                finally:
+                    response.close()
+
+        if loaded:
+            report.add_resources_success(resource)
+            if sync_state:
+                sync_state.record(resource, response)
+                sync_state.save()
+            if save_csv_files:
+                save_columnar(logger, resource, report, storage_root, output_format)
+            logger.info(f"{len(report.resources_success)} of {report.num_resources} resources collected.")
+            logger.info('■'*len(report.resources_success))
+            return
+        report.add_error()
+        logger.info(f"Starting {resource['name']} over.")
+
+    logger.error(f"Out of attempts for streaming {resource['name']} into the database.")
+    report.add_resources_fail(resource)
+
+def get_packages(
+        tags: list[str], 
+        match: str = "any",
+        prefix: bool = False,
+        catalog_path: str = "catalog_tags.csv",
+        ) -> list[str]:
+    """
+    Returns a list of all packages with the submitted tags, looked up in the tag index 
+    built from the catalog (see tag_index.TagIndex).
+
+    Args:
+        tags (list[str]): The tags to search for.
+        match (str): "any" returns packages with at least one of the tags, "all" only packages with every tag.
+        prefix (bool): Match tags that start with each of the submitted tags.
+        catalog_path (str): Path to the tag catalog CSV.
+    """
+    return TagIndex.load(catalog_path).search(tags, match=match, prefix=prefix)
@@ -1,4 +1,7 @@
-import time
+import time, threading
+from contextlib import nullcontext
+from typing import Optional
+from metrics import Metrics, StageTimer
 
 def compile_reports(report_list: list):
     final_report = {
@@ -8,12 +11,15 @@ def compile_reports(report_list: list):
         'resources_fail': [],
         'total_duration': 0,
         'num_errors': 0,
+        'retries': 0,
         'skipped': 0,
     }
 
     for report in report_list:
         final_report['num_errors'] += report.num_errors
-        final_report['total_duration'] = report.end_time - report.start_time
+        final_report['retries'] += report.retries
+        if report.end_time:
+            final_report['total_duration'] += report.end_time - report.start_time
         if not report.package_success:
             final_report['packages_fail'].append(report.package_name)
             continue
@@ -27,33 +33,92 @@ def compile_reports(report_list: list):
 
 
 class Report:
+    """
+    Collects the results for a single package. Resources can be downloaded from several
+    worker threads at once, so every update goes through the methods below, which hold a lock.
 
-    def __init__(self, package: str, start_time: time.time):
+    If a Metrics object is given, the counts are also added to it as they happen, and stage()
+    times the pipeline's stages into it.
+    """
+
+    def __init__(self, package: str, start_time: time.time, metrics: Optional[Metrics] = None):
         self.package_name = package
         self.package_success = False
         self.package_response_code = None
+        self.revision = None
         self.num_resources = 0
         self.resources_success = []
         self.resources_fail = []
         self.total_duration = 0
-        self.start_time = 0
+        self.start_time = start_time
         self.end_time = 0
         self.num_errors = 0
+        self.retries = 0
         self.skipped = 0
+        self.metrics = metrics
+        self._lock = threading.Lock()
 
     def process_package_response(self, response):
-        self.total_duration += response.elapsed.total_seconds()
-        self.package_response_code = response.status_code
+        with self._lock:
+            self.total_duration += response.elapsed.total_seconds()
+            self.package_response_code = response.status_code
     
     def process_resource_response(self, response, resource):
-        self.total_duration += response.elapsed.total_seconds()
-        if not response.status_code == 200:
-            self.resources_fail.append(resource)
-        else:
-            self.resources_success.append(resource['name'])
+        with self._lock:
+            self.total_duration += response.elapsed.total_seconds()
+            if not response.status_code == 200:
+                self.resources_fail.append(resource)
+            else:
+                self.resources_success.append(resource['name'])
     
+    def add_resources_success(self, resource):
+        with self._lock:
+            self.resources_success.append(resource['name'])
+        if self.metrics:
+            self.metrics.increment("resources_succeeded")
+
     def add_resources_fail(self, resource):
-        self.resources_fail.append(resource)
+        with self._lock:
+            self.resources_fail.append(resource)
+        if self.metrics:
+            self.metrics.increment("resources_failed")
+
+    def add_error(self):
+        with self._lock:
+            self.num_errors += 1
+        if self.metrics:
+            self.metrics.increment("errors")
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+        if self.metrics:
+            self.metrics.increment("retries")
+
+    def add_skipped(self):
+        with self._lock:
+            self.skipped += 1
+        if self.metrics:
+            self.metrics.increment("resources_skipped")
 
     def add_to_total_duration(self, seconds):
-        self.total_duration += seconds
\ No newline at end of file
+        with self._lock:
+            self.total_duration += seconds
+
+    def record_stage(self, stage: str, seconds: float, bytes: int = 0, rows: int = 0):
+        if self.metrics:
+            self.metrics.record_stage(stage, seconds, bytes, rows)
+
+    def stage(self, stage: str):
+        """
+        Times a block of code as one run of a pipeline stage (see Metrics.stage).
+        Yields a StageTimer either way, so callers don't need to check for metrics.
+        """
+        return self.metrics.stage(stage) if self.metrics else nullcontext(StageTimer())
+
+    def finish(self):
+        """
+        Sets the end time. Returns the report, so a pipeline can end with "return report.finish()".
+        """
+        self.end_time = time.time()
+        return self
@@ -0,0 +1,249 @@
+import heapq, logging, random, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from typing import Callable, Iterable, Optional
+
+# Statuses that mean the server is struggling rather than that the request was wrong.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RetryLater(Exception):
+    """
+    Raised by a task that failed in a way worth trying again later, e.g. a 503 or a dropped
+    connection. delay is how long to wait if the server said (Retry-After), otherwise None.
+    """
+
+    def __init__(self, reason: str, delay: Optional[float] = None):
+        super().__init__(reason)
+        self.delay = delay
+
+
+class CircuitOpen(RetryLater):
+    """
+    Raised instead of sending a request to a host whose circuit breaker is open.
+    """
+
+
+def backoff_delay(attempt: int, base: float = 2.0, cap: float = 120.0) -> float:
+    """
+    Exponential backoff with jitter: somewhere between half and all of base * 2**attempt
+    (capped), so resources that failed together don't all come back at the same moment.
+    """
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    """
+    Reads a Retry-After header, given in seconds or as an HTTP date, if the response has one.
+    """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostHealth:
+    """
+    A circuit breaker and an adaptive request rate for one host.
+
+    The rate works like TCP congestion control: every 429, 5xx or missing response doubles the
+    gap between request starts, and every quick success narrows it a little, so the pipeline
+    settles at whatever rate the server is coping with. Slow responses widen the gap too.
+
+    After failure_threshold failures in a row the breaker opens and requests are refused straight
+    away (CircuitOpen) instead of piling onto a server that is down. Once the cooldown is over one
+    probe request is let through: if it works the breaker closes, if not it opens again for twice as long.
+    """
+
+    INTERVAL_STEP = 0.05
+
+    def __init__(
+            self,
+            failure_threshold: int = 5,
+            cooldown: float = 30.0,
+            max_cooldown: float = 300.0,
+            max_interval: float = 10.0,
+            slow_response: float = 10.0,
+            clock: Callable[[], float] = time.monotonic,
+            sleep: Callable[[float], None] = time.sleep,
+            ):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_interval = max_interval
+        self.slow_response = slow_response
+        self.clock = clock
+        self.sleep = sleep
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe_started = None
+        self.interval = 0.0
+        self.next_start = 0.0
+        self.not_before = 0.0
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """
+        Waits for the host's next request slot, or raises CircuitOpen if the breaker is open.
+        """
+        with self._lock:
+            now = self.clock()
+            if self.state == "open":
+                if now < self.open_until:
+                    raise CircuitOpen("the server looks down", self.open_until - now)
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probe_started is not None and now - self.probe_started < self.cooldown:
+                    raise CircuitOpen("waiting to see if the server is back", self.cooldown)
+                self.probe_started = now
+            start = max(now, self.next_start, self.not_before)
+            self.next_start = start + self.interval
+        if start > now:
+            self.sleep(start - now)
+
+    def record(self, status: Optional[int], elapsed: Optional[float] = None, retry_after: Optional[float] = None):
+        """
+        Updates the breaker and the request rate with the outcome of a request.
+        status is None if there was no response at all.
+        """
+        with self._lock:
+            if status is None or status in RETRY_STATUSES:
+                self.failures += 1
+                self.interval = min(self.max_interval, max(self.INTERVAL_STEP, self.interval * 2))
+                if retry_after:
+                    self.not_before = max(self.not_before, self.clock() + retry_after)
+                if self.state == "half_open" or self.failures >= self.failure_threshold:
+                    self.state = "open"
+                    self.open_until = self.clock() + self.cooldown
+                    self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+                    self.failures = 0
+                    self.probe_started = None
+                return
+
+            self.failures = 0
+            if self.state != "closed":
+                self.state = "closed"
+                self.cooldown = self.base_cooldown
+                self.probe_started = None
+            if elapsed is not None and elapsed > self.slow_response:
+                self.interval = min(self.max_interval, self.interval * 1.5 + self.INTERVAL_STEP)
+            else:
+                self.interval = max(0.0, self.interval - self.INTERVAL_STEP)
+
+
+def run_with_retries(
+        logger: logging.Logger,
+        task: Callable,
+        items: Iterable,
+        workers: int = 1,
+        max_attempts: int = 4,
+        base_delay: float = 2.0,
+        max_delay: float = 120.0,
+        max_refusals: int = 10,
+        name: Callable = str,
+        on_retry: Optional[Callable] = None,
+        on_give_up: Optional[Callable] = None,
+        on_error: Optional[Callable] = None,
+        thread_name_prefix: str = "",
+        metrics=None,
+        ):
+    """
+    Runs task(item) for every item on a pool of worker threads, without ever sleeping on a retry.
+
+    An item whose task raises RetryLater is parked in a delayed queue (with the delay the
+    server asked for, capped at max_delay, or jittered exponential backoff) and the workers carry
+    on with the other items in the meantime. It's run again once its delay is over, up to
+    max_attempts times. An item refused by an open circuit breaker (CircuitOpen) was never sent,
+    so it waits for the breaker's cooldown without using up an attempt, up to max_refusals
+    refusals in a row, so items don't wait forever on a server that stays down.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        task (Callable): Function run with each item.
+        items (Iterable): The items to run.
+        workers (int): Number of items run at the same time.
+        max_attempts (int): Number of times an item is run before giving up on it.
+        base_delay (float): Backoff before the first retry, doubled for every retry after that.
+        max_delay (float): Longest backoff between two tries.
+        max_refusals (int): Number of circuit breaker refusals in a row before giving up on an item.
+        name (Callable): Turns an item into a name for the logs.
+        on_retry (Callable): Called with (item, error, delay) when an item is parked.
+        on_give_up (Callable): Called with (item, error) when an item is out of attempts or refusals.
+        on_error (Callable): Called with (item, error) when a task raises anything else.
+        thread_name_prefix (str): Name for the worker threads.
+        metrics (Metrics): Optional metrics whose resources_running and resources_waiting_retry
+            gauges follow the number of items running and parked.
+    """
+    # (due, tie-breaker, item, attempt, refusals in a row, whether it's waiting on a retry)
+    parked = [(0.0, i, item, 0, 0, False) for i, item in enumerate(items)]
+    heapq.heapify(parked)
+    counter = len(parked)
+    running = {}
+
+    def adjust_gauge(gauge: str, change: int):
+        if metrics:
+            metrics.adjust_gauge(gauge, change)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=thread_name_prefix) as executor:
+        while parked or running:
+            now = time.monotonic()
+            while parked and len(running) < workers and parked[0][0] <= now:
+                _, _, item, attempt, refusals, retried = heapq.heappop(parked)
+                running[executor.submit(task, item)] = (item, attempt, refusals)
+                adjust_gauge("resources_running", 1)
+                if retried:
+                    adjust_gauge("resources_waiting_retry", -1)
+
+            if not running:
+                # only parked items are left, so there's nothing else to do until the first is due
+                time.sleep(max(0.0, parked[0][0] - now))
+                continue
+
+            timeout = max(0.0, parked[0][0] - now) if parked and len(running) < workers else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                item, attempt, refusals = running.pop(future)
+                adjust_gauge("resources_running", -1)
+                try:
+                    future.result()
+                except CircuitOpen as e:
+                    if refusals + 1 >= max_refusals:
+                        logger.error(f"Giving up on {name(item)} after {max_refusals} refusals: {e}")
+                        if on_give_up:
+                            on_give_up(item, e)
+                        continue
+                    # nothing was sent, so it waits out the breaker and keeps its attempts
+                    delay = (e.delay if e.delay is not None else base_delay) + random.uniform(0, 1)
+                    logger.info(f"{name(item)}: {e}. Waiting {delay:.0f} seconds for the server to come back.")
+                    heapq.heappush(parked, (time.monotonic() + delay, counter, item, attempt, refusals + 1, True))
+                    adjust_gauge("resources_waiting_retry", 1)
+                    counter += 1
+                except RetryLater as e:
+                    if attempt + 1 >= max_attempts:
+                        logger.error(f"Giving up on {name(item)} after {max_attempts} attempts: {e}")
+                        if on_give_up:
+                            on_give_up(item, e)
+                        continue
+                    delay = min(e.delay, max_delay) if e.delay is not None else backoff_delay(attempt, base_delay, max_delay)
+                    # a little jitter even when the server set the delay, so the retries don't all land together
+                    delay += random.uniform(0, 1)
+                    logger.warning(f"{name(item)}: {e}. Trying again in {delay:.0f} seconds, the other downloads carry on.")
+                    if on_retry:
+                        on_retry(item, e, delay)
+                    heapq.heappush(parked, (time.monotonic() + delay, counter, item, attempt + 1, 0, True))
+                    adjust_gauge("resources_waiting_retry", 1)
+                    counter += 1
+                except Exception as e:
+                    logger.exception(f"Unexpected error while getting {name(item)}: {e}")
+                    if on_error:
+                        on_error(item, e)
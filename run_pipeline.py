@@ -1,89 +1,282 @@
-import time
+import time, threading, signal, os, json
+from functools import partial
 from datetime import timedelta
 from logging_setup import get_logger
 from parser_setup import get_parser
-from data_functions import (
-    request_resource_library, 
-    process_resource_library, 
-    download_resource, 
-    convert_to_csv, 
-    save_csv, to_df, 
-    token_required,
-    )
-from pipeline_functions import main_pipeline, get_packages
+from pipeline_functions import get_packages
+from scheduler import run_packages
 from reporting import compile_reports
-from db_load import Database
-import os
-from dotenv import load_dotenv
+from concurrency import HostLimiter
+from http_client import get_session
+from metadata_cache import MetadataCache
+from catalog_sync import sync_catalog
+from datastore import DatastoreQuery
+from blob_store import BlobStore, BLOB_DIR
+from storage import zstd_available
+from job_queue import JobQueue, JOB_STATES
+from daemon import run_daemon, poll_packages
+from metrics import Metrics
 
+# Only what every run needs is imported up here. pandas, pyarrow, psycopg2, sqlalchemy and dotenv
+# are imported by the stages that use them (database loads, columnar output, column aliases),
+# so a plain download run starts without paying for them.
 
-### 
+###
 # Terminology note: Barcelona's Open Data repository uses the [INSERT HERE] standard. That means it's structured into
 # "packages" that contain a series of "resources" (basically, annual datasets). When this script is accessing "packages",
 # what it is doing is retrieving a list of the "resources" that belong to each "package".
-# 
+#
 # So, when this code uses the term "package", it is referring to a collection of datasets, and when it uses the term
-# "resource", it is referring to a dictionary containing information about an individual dataset, including the URL 
+# "resource", it is referring to a dictionary containing information about an individual dataset, including the URL
 # for downloading the dataset in the form of a CSV.
 
-# get .env variables and instantiate database class
-load_dotenv()
-db_config = Database(
-    db_name = os.getenv("DB_NAME"),
-    db_host = os.getenv("DB_HOST"),
-    db_user = os.getenv("DB_USER")
-)
 
+def get_db_config():
+    """
+    Reads the database settings from the .env file.
+    """
+    from dotenv import load_dotenv
+    from db_load import Database
+    load_dotenv()
+    return Database(
+        db_name = os.getenv("DB_NAME"),
+        db_host = os.getenv("DB_HOST"),
+        db_user = os.getenv("DB_USER")
+    )
 
-parser = get_parser()
-args = parser.parse_args()
-if args.packages:
-    package_list = args.packages
-else:
-    package_list = get_packages(args.tags)
-storage_root = args.directory
 
+def log_final_report(logger, report_list: list, start_time: float, load_results: dict, loader=None, metrics=None):
+    end_time = time.time()
+
+    total_duration = end_time - start_time
+    final_duration = str(timedelta(seconds=round(total_duration)))
+
+    final_report = compile_reports(report_list)
+
+    total_packages = len(final_report['packages_success']) + len(final_report['packages_fail'])
+    total_resources = len(final_report['resources_success']) + len(final_report['resources_fail'])
+
+    logger.info("***************************************************")
+    logger.info("FINAL REPORT")
+    logger.info(f"This pipeline ran for {final_duration}.")
+    logger.info(f"A total of {len(final_report['packages_success'])} package(s) accessed successfully, out of {total_packages} attempted.")
+    logger.info(f"A total of {len(final_report['resources_success'])} resource(s) downloaded and saved successfully, out of {total_resources} attempted.")
+    logger.info(f"A total of {final_report['skipped']} resources skipped because they were already downloaded.")
+    logger.info(f"There were {final_report['num_errors']} errors.")
+    logger.info(f"There were {final_report['retries']} retried download(s).")
+    if loader:
+        loaded = [package for package, ok in load_results.items() if ok]
+        logger.info(f"A total of {len(loaded)} package(s) loaded into the database, out of {len(load_results)} attempted.")
+    if metrics:
+        logger.info("Time spent in each stage:")
+        for line in metrics.summary():
+            logger.info(line)
+    if final_report['packages_fail']:
+        logger.info(f"The following package(s) could not be accessed:")
+        for package in final_report['packages_fail']:
+            logger.info(f"{package}")
+        logger.info(f"Check the logs for more information.")
+
+    if final_report['resources_fail']:
+        logger.info(f"The following resource(s) could not be accessed:")
+        for resource in final_report['resources_fail']:
+            logger.info(f"{resource['name']}")
+        logger.info(f"Check the logs for more information.")
+
+
+def main(argv: list[str] = None):
+    """
+    The command-line entry point. argv defaults to the script's own arguments.
+    """
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.skip_csv and not args.stream_to_db:
+        parser.error("--skip_csv only makes sense with --stream_to_db")
+    if args.skip_csv and args.output_format != "csv":
+        parser.error("--output_format converts the CSV files, so it can't be used with --skip_csv")
+    if args.skip_csv and args.dataset:
+        parser.error("--dataset is built from the CSV files, so it can't be used with --skip_csv")
+
+    if (args.columns or args.filters) and not args.datastore:
+        parser.error("--columns and --filters are applied by the DataStore, so they need --datastore")
+    if args.datastore and args.stream_to_db:
+        parser.error("--datastore saves CSV files, load them with --to_db instead of --stream_to_db")
+    datastore_query = None
+    if args.datastore:
+        try:
+            filters = json.loads(args.filters) if args.filters else None
+        except ValueError as e:
+            parser.error(f"--filters isn't valid JSON: {e}")
+        if filters is not None and not isinstance(filters, dict):
+            parser.error("--filters has to be a JSON object of column -> value(s)")
+        datastore_query = DatastoreQuery(columns=args.columns, filters=filters, workers=args.datastore_workers)
 
-if __name__ == "__main__":
     logger = get_logger()
-    start_time = time.time()
-    report_list = []
-    if not package_list:
-        logger.info(f"No packages found with those tags, exiting...")
-    else:
-        logger.info(f"Getting the following packages: {package_list}")
-        for package in package_list:
-            report = main_pipeline(logger, package, storage_root=storage_root)
-            report_list.append(report)
-        
-        end_time = time.time()
-
-        total_duration = end_time - start_time
-        final_duration = str(timedelta(seconds=round(total_duration)))
-
-        final_report = compile_reports(report_list)
-
-        total_packages = len(final_report['packages_success']) + len(final_report['packages_fail'])
-        total_resources = len(final_report['resources_success']) + len(final_report['resources_fail'])
-
-        logger.info("***************************************************")
-        logger.info("FINAL REPORT")
-        logger.info(f"This pipeline ran for {final_duration}.")
-        logger.info(f"A total of {len(final_report['packages_success'])} package(s) accessed successfully, out of {total_packages} attempted.")
-        logger.info(f"A total of {len(final_report['resources_success'])} resource(s) downloaded and saved successfully, out of {total_resources} attempted.")
-        logger.info(f"A total of {final_report['skipped']} resources skipped because they were already downloaded.")
-        logger.info(f"There were {final_report['num_errors']} errors.")
-        if final_report['packages_fail']:
-            logger.info(f"The following package(s) could not be accessed:")
-            for package in final_report['packages_fail']:
-                logger.info(f"{package}")
-            logger.info(f"Check the logs for more information.")
-
-        if final_report['resources_fail']:
-            logger.info(f"The following resource(s) could not be accessed:")
-            for resource in final_report['resources_fail']:
-                logger.info(f"{resource['name']}")
-            logger.info(f"Check the logs for more information.")
+    if args.output_format != "csv" or args.dataset:
+        from columnar import columnar_available
+        if not columnar_available(logger):
+            raise SystemExit(1)
+    if args.compress == "zstd" and not zstd_available(logger):
+        raise SystemExit(1)
 
+    metadata_cache = MetadataCache(
+        path=args.metadata_cache,
+        ttl=args.metadata_ttl * 3600,
+        refresh=args.refresh_metadata,
+    )
+    storage_root = args.directory
+    column_aliases = {}
+    if args.column_aliases:
+        from schema_inference import load_column_aliases
+        column_aliases = load_column_aliases(args.column_aliases)
+    blob_store = BlobStore(os.path.join(storage_root, BLOB_DIR)) if args.dedup else None
+    host_limiter = HostLimiter(max_per_host=args.host_limit)
+    metrics = Metrics()
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = metrics.serve(args.metrics_port)
+        logger.info(f"Serving metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+    loader = None
+    stream_loader = None
+    report_list = None
+    try:
+        download_budget = args.download_budget or args.workers * args.max_packages
+        session = get_session(
+            logger,
+            pool_size=args.pool_size or download_budget + args.max_packages,
+            http2=args.http2,
+            )
+
+        if args.stream_to_db:
+            from stream_load import StreamingLoader
+            stream_loader = StreamingLoader(
+                get_db_config(),
+                max_connections=args.db_connections,
+                column_aliases=column_aliases,
+                metrics=metrics,
+                )
+        elif args.to_db:
+            from db_load import ParallelLoader
+            loader = ParallelLoader(
+                get_db_config(),
+                storage_root,
+                max_connections=args.db_connections,
+                column_aliases=column_aliases,
+                metrics=metrics,
+                )
+        run = partial(
+            run_packages,
+            logger,
+            storage_root=storage_root,
+            workers=args.workers,
+            max_packages=args.max_packages,
+            download_budget=download_budget,
+            host_limiter=host_limiter,
+            session=session,
+            metadata_cache=metadata_cache,
+            loader=loader,
+            stream_loader=stream_loader,
+            save_csv_files=not args.skip_csv,
+            output_format=args.output_format,
+            metrics=metrics,
+            datastore_query=datastore_query,
+            blob_store=blob_store,
+            compression=args.compress,
+            dataset_format=args.dataset,
+            column_aliases=column_aliases,
+            )
+
+        def export_metrics():
+            if args.metrics_file:
+                metrics.write(args.metrics_file)
+
+        def prune_blobs():
+            if blob_store:
+                removed, freed = blob_store.prune()
+                if removed:
+                    logger.info(f"Deleted {removed} stored file(s) nothing links to any more, freeing {freed / 1e6:.1f} MB.")
+
+        # what the last catalog sync returned, so the daemon's change checks can use it instead of a
+        # package_show per package. It's emptied when a poll doesn't sync, so it never goes stale.
+        synced_catalog = {}
+
+        def get_package_list():
+            synced_catalog.clear()
+            if args.sync_catalog or (args.tags and not os.path.exists(args.catalog)):
+                catalog = sync_catalog(
+                    logger,
+                    catalog_path=args.catalog,
+                    metadata_cache=metadata_cache,
+                    workers=args.host_limit,
+                    limiter=host_limiter,
+                    session=session,
+                    metrics=metrics,
+                    )
+                synced_catalog.update(catalog or {})
+            if args.packages:
+                return args.packages
+            if not os.path.exists(args.catalog):
+                logger.error(f"There's no tag catalog at {args.catalog} to search.")
+                return []
+            return get_packages(args.tags, match=args.tag_match, prefix=args.tag_prefix, catalog_path=args.catalog)
 
+        if args.daemon:
+            job_queue = JobQueue(args.job_queue)
 
+            def after_cycle():
+                counts = job_queue.counts()
+                for state in JOB_STATES:
+                    metrics.set_gauge(f"jobs_{state}", counts.get(state, 0))
+                prune_blobs()
+                export_metrics()
+
+            stop = threading.Event()
+            # finish the packages that are running, then exit. Anything cut short is picked up on the next start.
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+            signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+            logger.info(f"Running as a daemon, checking for changes every {args.poll_interval:g} minute(s).")
+            run_daemon(
+                logger,
+                job_queue,
+                get_package_list=get_package_list,
+                run=run,
+                poll=partial(
+                    poll_packages,
+                    logger,
+                    job_queue,
+                    metadata_cache=metadata_cache,
+                    limiter=host_limiter,
+                    session=session,
+                    catalog=synced_catalog,
+                    ),
+                poll_interval=args.poll_interval * 60,
+                stop=stop,
+                after_cycle=after_cycle,
+                loader=loader,
+                )
+        else:
+            start_time = time.time()
+            package_list = get_package_list()
+            if not package_list:
+                logger.info(f"No packages found with those tags, exiting...")
+            else:
+                logger.info(f"Getting the following packages: {package_list}")
+                report_list = run(package_list)
+    finally:
+        # even when a stage raises, the queued loads finish, the database connections are closed and
+        # the metrics stop being served, so a caller of main() doesn't keep them
+        load_results = loader.close() if loader else {}
+        if stream_loader:
+            stream_loader.close()
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+    if report_list is not None:
+        prune_blobs()
+        log_final_report(logger, report_list, start_time, load_results, loader, metrics)
+        export_metrics()
+
+
+if __name__ == "__main__":
+    main()
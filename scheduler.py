@@ -0,0 +1,177 @@
+import logging, time, requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional, TYPE_CHECKING
+from collections import deque
+from concurrency import DownloadBudget, HostLimiter, PackageLimiter
+from metadata_cache import MetadataCache
+from pipeline_functions import main_pipeline
+from datastore import DatastoreQuery
+from blob_store import BlobStore
+from reporting import Report
+from metrics import Metrics
+
+if TYPE_CHECKING:
+    from stream_load import StreamingLoader
+
+
+def should_requeue(report: Report) -> bool:
+    """
+    Checks whether a package failed because its package_show call failed in a way worth retrying
+    (no response, rate limiting or a server error), as opposed to the package not existing.
+    """
+    if report.package_success:
+        return False
+    code = report.package_response_code
+    return code is None or code == 429 or code >= 500
+
+
+def run_packages(
+        logger: logging.Logger,
+        package_list: list[str],
+        storage_root: str,
+        workers: int = 1,
+        max_packages: int = 1,
+        download_budget: Optional[int] = None,
+        host_limiter: Optional[HostLimiter] = None,
+        max_requeues: int = 2,
+        requeue_delay: int = 30,
+        session: Optional[requests.Session] = None,
+        metadata_cache: Optional[MetadataCache] = None,
+        loader=None,
+        stream_loader: Optional["StreamingLoader"] = None,
+        save_csv_files: bool = True,
+        output_format: str = "csv",
+        metrics: Optional[Metrics] = None,
+        datastore_query: Optional[DatastoreQuery] = None,
+        blob_store: Optional[BlobStore] = None,
+        compression: str = "none",
+        dataset_format: Optional[str] = None,
+        column_aliases: Optional[dict[str, dict[str, str]]] = None,
+        ) -> list[Report]:
+    """
+    Runs main_pipeline for several packages at the same time.
+
+    All the packages share one download budget, split fairly between the packages that are running.
+    A package whose resource list couldn't be retrieved is put at the back of the queue and tried
+    again later, so one flaky package doesn't hold up the others.
+
+    Args:
+        logger (logging.Logger): A logging instance for recording events.
+        package_list (list[str]): Names of the packages to download.
+        storage_root (str): the root directory where the downloaded CSV files will be saved.
+        workers (int): Number of resources to download at the same time within one package.
+        max_packages (int): Number of packages to run at the same time.
+        download_budget (int): Maximum number of downloads in flight across all packages. Defaults to workers * max_packages.
+        host_limiter (HostLimiter): Optional per-host limiter shared by all the packages.
+        max_requeues (int): Number of times a package can be sent to the back of the queue.
+        requeue_delay (int): Seconds a requeued package waits before it's tried again. Grows with each requeue.
+        session (requests.Session): Optional pooled session shared by all the packages.
+        metadata_cache (MetadataCache): Optional on-disk cache of package_show payloads.
+        loader (db_load.ParallelLoader): Optional database loader. Each package is submitted to it as soon
+            as it has been downloaded, so loading overlaps with the remaining downloads.
+        stream_loader (StreamingLoader): Optional loader that streams downloads straight into the database.
+        save_csv_files (bool): When streaming into the database, also keep the CSV files on disk.
+        output_format (str): "parquet" or "feather" to also convert every saved CSV to a columnar file.
+        metrics (Metrics): Optional metrics for stage timings, counts and queue depths (packages_queued, packages_running).
+        datastore_query (DatastoreQuery): Optionally pull resources that are in CKAN's DataStore with this query
+            instead of downloading their files (see pipeline_functions.get_datastore_resource).
+        blob_store (BlobStore): Optional content-addressed store shared by all the packages, so a file
+            published in several of them is kept once.
+        compression (str): "gzip" or "zstd" to store the CSV files compressed.
+        dataset_format (str): "parquet" or "feather" to consolidate every package that was downloaded into
+            one dataset once its files are saved (see columnar.build_package_dataset).
+        column_aliases (dict): Optional explicit column renames per package, for the datasets.
+
+    Returns:
+        A list with one Report per package, ready for compile_reports.
+    """
+    budget = DownloadBudget(download_budget or workers * max_packages)
+    queue = deque((package, 0, 0.0) for package in package_list)
+    errors_so_far = {}
+    reports = {}
+    running = {}
+
+    def run_one(package: str) -> Report:
+        budget.register(package)
+        try:
+            report = main_pipeline(
+                logger,
+                package,
+                storage_root=storage_root,
+                workers=workers,
+                limiter=PackageLimiter(package, budget, host_limiter),
+                package_retries=1,
+                session=session,
+                metadata_cache=metadata_cache,
+                stream_loader=stream_loader,
+                save_csv_files=save_csv_files,
+                output_format=output_format,
+                metrics=metrics,
+                datastore_query=datastore_query,
+                blob_store=blob_store,
+                compression=compression,
+                )
+        finally:
+            budget.unregister(package)
+        if dataset_format and report.package_success:
+            build_dataset(package, report)
+        return report
+
+    def build_dataset(package: str, report: Report):
+        # columnar is imported here so runs without datasets never load pyarrow
+        from columnar import build_package_dataset
+        with report.stage("dataset"):
+            built = build_package_dataset(
+                logger, storage_root, package, dataset_format, aliases=(column_aliases or {}).get(package),
+                )
+        if not built:
+            report.add_error()
+
+    with ThreadPoolExecutor(max_workers=max_packages, thread_name_prefix="package") as executor:
+        while queue or running:
+            now = time.time()
+            # start every package that is ready, as long as there's a free package slot
+            for _ in range(len(queue)):
+                if len(running) >= max_packages:
+                    break
+                package, attempt, ready_at = queue.popleft()
+                if ready_at > now:
+                    queue.append((package, attempt, ready_at))
+                    continue
+                running[executor.submit(run_one, package)] = (package, attempt)
+
+            if metrics:
+                metrics.set_gauge("packages_queued", len(queue))
+                metrics.set_gauge("packages_running", len(running))
+
+            if not running:
+                # everything left is waiting out its requeue delay
+                time.sleep(max(0, min(ready_at for _, _, ready_at in queue) - time.time()))
+                continue
+
+            done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                package, attempt = running.pop(future)
+                try:
+                    report = future.result()
+                except Exception as e:
+                    logger.exception(f"Unexpected error while running the {package} package: {e}")
+                    report = Report(package, time.time(), metrics)
+                    report.add_error()
+                    report.finish()
+
+                report.num_errors += errors_so_far.pop(package, 0)
+                if should_requeue(report) and attempt < max_requeues:
+                    delay = requeue_delay * (attempt + 1)
+                    logger.warning(f"Couldn't get the resource list for {package}, moving it to the back of the queue (retry in {delay} seconds).")
+                    errors_so_far[package] = report.num_errors
+                    queue.append((package, attempt + 1, time.time() + delay))
+                else:
+                    reports[package] = report
+                    if loader and report.package_success:
+                        # blocks here if the database is falling behind
+                        loader.submit(package)
+
+    if metrics:
+        metrics.set_gauge("packages_running", 0)
+    return [reports[package] for package in package_list if package in reports]
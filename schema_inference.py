@@ -0,0 +1,377 @@
+import copy, csv, json, re
+from dataclasses import dataclass
+from itertools import islice
+from typing import Callable, Iterator, Optional
+import pandas as pd
+from tag_index import normalize_tag
+from storage import open_stored
+
+SAMPLE_ROWS = 1000
+# Rows inferred at a time when a whole file is scanned because its sample didn't cover every value.
+SCAN_CHUNK_ROWS = 50_000
+READ_BLOCK_SIZE = 64 * 1024
+
+# Values that mean "no data" in Open Data BCN files. They're loaded as NULL, except into TEXT columns.
+NULL_TOKENS = {"", "-", "na", "n/a", "nan", "null", "none", "nd", "n.d.", "s/d"}
+BOOL_TRUE = {"true", "yes", "si", "sí", "cert", "verdadero"}
+BOOL_FALSE = {"false", "no", "fals", "falso"}
+
+INT_PATTERN = r"[+-]?\d+"
+FLOAT_PATTERN = r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?"
+# Catalan/Spanish numbers: "1.234,5", "12,75", "1.234.567".
+DECIMAL_COMMA_PATTERN = r"[+-]?(?:\d{1,3}(?:\.\d{3})+|\d+)(?:,\d+)?"
+TIME_PATTERN = r"(?:[01]?\d|2[0-3]):[0-5]\d(?::[0-5]\d(?:\.\d+)?)?"
+ISO_DATE_PATTERN = r"\d{4}-\d{2}-\d{2}"
+ISO_TIMESTAMP_PATTERN = rf"\d{{4}}-\d{{2}}-\d{{2}}[T ]{TIME_PATTERN}"
+DMY_PATTERN = rf"(?P<day>\d{{1,2}})[/-](?P<month>\d{{1,2}})[/-](?P<year>\d{{4}})(?: (?P<time>{TIME_PATTERN}))?"
+DMY_REGEX = re.compile(DMY_PATTERN)
+
+TYPES = ("BIGINT", "DOUBLE PRECISION", "DATE", "TIMESTAMP", "BOOLEAN", "TEXT")
+# Type pairs that widen to something narrower than TEXT.
+WIDENINGS = {
+    frozenset(("BIGINT", "DOUBLE PRECISION")): "DOUBLE PRECISION",
+    frozenset(("DATE", "TIMESTAMP")): "TIMESTAMP",
+}
+
+
+@dataclass
+class ColumnInfo:
+    """
+    What a sample says about one column of one file.
+
+    pg_type is None when the sample had no values at all. fmt names the rewrite the values need
+    before PostgreSQL can parse them ("decimal_comma", "dmy" or "bool"), and nulls is True if the
+    sample had NULL_TOKENS other than empty strings.
+    """
+    name: str
+    pg_type: Optional[str]
+    fmt: Optional[str] = None
+    nulls: bool = False
+
+
+def _valid_dates(years: pd.Series, months: pd.Series, days: pd.Series) -> bool:
+    dates = pd.to_datetime(years + "-" + months.str.zfill(2) + "-" + days.str.zfill(2), format="%Y-%m-%d", errors="coerce")
+    return bool(dates.notna().all())
+
+
+def infer_column(name: str, values) -> ColumnInfo:
+    """
+    Picks the narrowest PostgreSQL type that fits every value in a sample, checking each
+    candidate against the whole sample at once.
+    """
+    stripped = pd.Series(list(values), dtype="object").fillna("").astype(str).str.strip()
+    lowered = stripped.str.lower()
+    is_null = lowered.isin(NULL_TOKENS)
+    nulls = bool((is_null & stripped.ne("")).any())
+    sample = stripped[~is_null]
+    if sample.empty:
+        return ColumnInfo(name, None, nulls=nulls)
+
+    def all_match(pattern: str) -> bool:
+        return bool(sample.str.fullmatch(pattern).all())
+
+    if all_match(INT_PATTERN):
+        return ColumnInfo(name, "BIGINT", nulls=nulls)
+    if all_match(FLOAT_PATTERN):
+        return ColumnInfo(name, "DOUBLE PRECISION", nulls=nulls)
+    if all_match(DECIMAL_COMMA_PATTERN):
+        has_decimals = bool(sample.str.contains(",", regex=False).any())
+        return ColumnInfo(name, "DOUBLE PRECISION" if has_decimals else "BIGINT", "decimal_comma", nulls)
+    if all_match(ISO_DATE_PATTERN) or all_match(ISO_TIMESTAMP_PATTERN):
+        if _valid_dates(sample.str[0:4], sample.str[5:7], sample.str[8:10]):
+            return ColumnInfo(name, "DATE" if all_match(ISO_DATE_PATTERN) else "TIMESTAMP", nulls=nulls)
+    if all_match(DMY_PATTERN):
+        parts = sample.str.extract(DMY_PATTERN)
+        if _valid_dates(parts["year"], parts["month"], parts["day"]):
+            return ColumnInfo(name, "TIMESTAMP" if parts["time"].notna().any() else "DATE", "dmy", nulls)
+    if bool(lowered[~is_null].isin(BOOL_TRUE | BOOL_FALSE).all()):
+        return ColumnInfo(name, "BOOLEAN", "bool", nulls)
+    return ColumnInfo(name, "TEXT", nulls=nulls)
+
+
+def infer_rows(header: list[str], rows: list[list[str]]) -> list[ColumnInfo]:
+    """
+    Infers a ColumnInfo for every column of a header from a sample of rows that have already been read.
+    """
+    return [
+        infer_column(name, [row[i] for row in rows if i < len(row)])
+        for i, name in enumerate(header)
+    ]
+
+
+def sample_file(file_path: str, sample_rows: int = SAMPLE_ROWS) -> tuple[list[str], list[list[str]]]:
+    """
+    Reads the header and the first sample_rows rows of a CSV, without reading the rest of the file.
+    """
+    with open_stored(file_path) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        return header, list(islice(reader, sample_rows))
+
+
+def infer_file(file_path: str, sample_rows: int = SAMPLE_ROWS) -> list[ColumnInfo]:
+    return infer_rows(*sample_file(file_path, sample_rows))
+
+
+def infer_whole_file(file_path: str, chunk_rows: int = SCAN_CHUNK_ROWS) -> list[ColumnInfo]:
+    """
+    Infers the columns from every row of a CSV instead of a sample, a chunk of rows at a time so
+    the file is never held in memory.
+
+    The loaders and the columnar conversion infer types from the first SAMPLE_ROWS rows, which is
+    enough for nearly every file. When a later value doesn't fit (a "2,5" in a column of whole
+    numbers, a note in a column of years), COPY or Arrow rejects it, and the caller reads the whole
+    file with this instead. The chunks are combined with merge_columns, so the types only widen.
+    """
+    with open_stored(file_path) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        columns = infer_rows(header, [])
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                return columns
+            columns = [merge_columns(a, b) for a, b in zip(columns, infer_rows(header, rows))]
+
+
+def merge_columns(current: ColumnInfo, new: ColumnInfo) -> ColumnInfo:
+    """
+    Combines what two samples of the same column say about it. Rewrites that would read one
+    sample's values wrongly (e.g. "1.5" as a Catalan thousands separator) fall back to TEXT.
+    """
+    nulls = current.nulls or new.nulls
+    if current.pg_type is None or new.pg_type is None:
+        column = new if current.pg_type is None else current
+        return ColumnInfo(current.name, column.pg_type, column.fmt, nulls)
+    fmt = current.fmt if current.fmt == new.fmt else None
+    if current.fmt != new.fmt:
+        # plain whole numbers read the same with the Catalan decimal rewrite
+        plain = new if current.fmt == "decimal_comma" else current
+        if {current.fmt, new.fmt} == {"decimal_comma", None} and plain.pg_type == "BIGINT":
+            fmt = "decimal_comma"
+        else:
+            return ColumnInfo(current.name, "TEXT", nulls=nulls)
+    return ColumnInfo(current.name, widen(current.pg_type, new.pg_type), fmt, nulls)
+
+
+def widen(current: Optional[str], new: Optional[str]) -> Optional[str]:
+    """
+    Returns the narrowest type that holds the values of both types. None means no values were seen.
+    """
+    if current is None:
+        return new
+    if new is None or new == current:
+        return current
+    return WIDENINGS.get(frozenset((current, new)), "TEXT")
+
+
+def column_key(name: str) -> str:
+    """
+    Normalizes a column name so headers that drifted between years ("Nom_Barri", "nom barri",
+    "Nom_barri" after a byte order mark) map onto the same column.
+    """
+    return re.sub(r"[^a-z0-9]+", "_", normalize_tag(name.lstrip("\ufeff"))).strip("_")
+
+
+def load_column_aliases(path: str) -> dict[str, dict[str, str]]:
+    """
+    Reads explicit column renames from a JSON file of package name -> {old column name: new column name}.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        aliases = json.load(f)
+    if not isinstance(aliases, dict) or not all(isinstance(v, dict) for v in aliases.values()):
+        raise ValueError(f"{path} should map package names to {{old column name: new column name}} objects")
+    return aliases
+
+
+class TableSchema:
+    """
+    The columns of a package table, keyed by their normalized names so that files whose headers
+    were renamed or reordered still land in the right columns.
+
+    Merging the columns inferred for each file widens the schema until every file fits:
+    BIGINT and DOUBLE PRECISION widen to DOUBLE PRECISION, DATE and TIMESTAMP to TIMESTAMP,
+    and anything else that disagrees to TEXT.
+    """
+
+    def __init__(self, columns: list[tuple[str, str]] = (), aliases: Optional[dict[str, str]] = None):
+        self.aliases = {column_key(old): column_key(new) for old, new in (aliases or {}).items()}
+        self.columns = {}
+        for name, pg_type in columns:
+            self.columns[self.key(name)] = [name, pg_type]
+
+    def key(self, name: str) -> str:
+        key = column_key(name)
+        return self.aliases.get(key, key)
+
+    def keys_for(self, header: list[str]) -> list[str]:
+        keys = []
+        for name in header:
+            key = self.key(name) or "column"
+            # a file with two columns that normalize the same keeps both
+            suffix = 2
+            while key in keys:
+                key, suffix = f"{self.key(name) or 'column'}_{suffix}", suffix + 1
+            keys.append(key)
+        return keys
+
+    def merge(self, columns: list[ColumnInfo]) -> tuple[list[str], list[str]]:
+        """
+        Widens the schema to fit a file's columns.
+
+        Returns:
+            The names of the columns that were added and of the ones whose type was widened.
+        """
+        added, widened = [], []
+        for key, column in zip(self.keys_for([c.name for c in columns]), columns):
+            if key not in self.columns:
+                self.columns[key] = [column.name, column.pg_type]
+                added.append(column.name)
+                continue
+            name, current = self.columns[key]
+            if current is not None and current not in TYPES:
+                # a type set up by hand, which is left alone
+                continue
+            new = widen(current, column.pg_type)
+            if new != current:
+                self.columns[key][1] = new
+                if current is not None:
+                    widened.append(name)
+        return added, widened
+
+    def copy(self) -> "TableSchema":
+        return copy.deepcopy(self)
+
+    def type_of(self, name: str) -> str:
+        return self.columns[self.key(name)][1] or "TEXT"
+
+    def ddl(self) -> list[tuple[str, str]]:
+        return [(name, pg_type or "TEXT") for name, pg_type in self.columns.values()]
+
+    def targets(self, header: list[str]) -> list[str]:
+        """
+        Maps a file's header onto the table's column names, in the file's order.
+        """
+        return [self.columns[key][0] for key in self.keys_for(header)]
+
+    def target_types(self, header: list[str]) -> list[str]:
+        return [self.columns[key][1] or "TEXT" for key in self.keys_for(header)]
+
+
+def dmy_to_iso(value: str) -> str:
+    match = DMY_REGEX.fullmatch(value)
+    if not match:
+        return value
+    date = f"{match['year']}-{int(match['month']):02d}-{int(match['day']):02d}"
+    return f"{date} {match['time']}" if match["time"] else date
+
+
+def _value_coercer(column: ColumnInfo) -> Callable[[str], str]:
+    def coerce(value: str) -> str:
+        stripped = value.strip()
+        lowered = stripped.lower()
+        if lowered in NULL_TOKENS:
+            return ""
+        if column.fmt == "decimal_comma":
+            return stripped.replace(".", "").replace(",", ".")
+        if column.fmt == "dmy":
+            return dmy_to_iso(stripped)
+        if column.fmt == "bool":
+            return "true" if lowered in BOOL_TRUE else "false" if lowered in BOOL_FALSE else value
+        return value
+    return coerce
+
+
+def row_coercer(columns: list[ColumnInfo], target_types: list[str]) -> Optional[Callable[[list[str]], list[str]]]:
+    """
+    Builds a function that rewrites a file's rows into values PostgreSQL can parse for the target
+    columns: Catalan/Spanish decimals, dd/mm/yyyy dates, Catalan/Spanish booleans and NULL tokens.
+    TEXT columns keep their values as they are.
+
+    Returns:
+        None if no column needs rewriting, so the file can be COPYed untouched.
+    """
+    coercers = {
+        i: _value_coercer(column)
+        for i, (column, target) in enumerate(zip(columns, target_types))
+        if target != "TEXT" and (column.fmt or column.nulls)
+    }
+    if not coercers:
+        return None
+
+    def coerce_row(row: list[str]) -> list[str]:
+        return [coercers[i](value) if i in coercers else value for i, value in enumerate(row)]
+    return coerce_row
+
+
+def iter_lines(source, size: int = READ_BLOCK_SIZE) -> Iterator[str]:
+    """
+    Splits a file-like object that only has read() into lines, keeping the line endings.
+    """
+    rest = ""
+    while True:
+        block = source.read(size)
+        if not block:
+            break
+        lines = (rest + block).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if rest:
+        yield rest
+
+
+class CoercingReader:
+    """
+    A read-only file-like object that rewrites the rows of a CSV with row_coercer as COPY reads
+    them. The header row passes through untouched.
+    """
+
+    def __init__(self, source, coerce_row: Callable[[list[str]], list[str]]):
+        self._rows = csv.reader(iter_lines(source))
+        self._coerce_row = coerce_row
+        self._header_done = False
+        self._pending = ""
+        self._out = StringBuffer()
+        self._writer = csv.writer(self._out, lineterminator="\n")
+
+    def _next_line(self) -> str:
+        row = next(self._rows)
+        if self._header_done:
+            row = self._coerce_row(row)
+        self._header_done = True
+        self._writer.writerow(row)
+        return self._out.take()
+
+    def read(self, size: int = -1) -> str:
+        parts, length = [self._pending], len(self._pending)
+        while size < 0 or length < size:
+            try:
+                line = self._next_line()
+            except StopIteration:
+                break
+            parts.append(line)
+            length += len(line)
+        data = "".join(parts)
+        if size < 0:
+            self._pending = ""
+            return data
+        data, self._pending = data[:size], data[size:]
+        return data
+
+
+class StringBuffer:
+    """
+    The smallest writable file-like object csv.writer needs, emptied by take().
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, text: str):
+        self._parts.append(text)
+
+    def take(self) -> str:
+        text = "".join(self._parts)
+        self._parts = []
+        return text
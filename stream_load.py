@@ -0,0 +1,317 @@
+import csv, queue, re, threading, time
+from io import StringIO
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from db_load import (
+    Database, 
+    cursor_table_exists, 
+    create_table, 
+    alter_table,
+    table_columns,
+    ensure_loads_table,
+    has_resource_column,
+    loaded_resources,
+    resource_signature,
+    replace_resource_rows,
+    RESOURCE_COLUMN,
+    )
+from schema_inference import SAMPLE_ROWS, CoercingReader, TableSchema, infer_column, infer_rows, merge_columns, row_coercer
+
+_END = object()
+# Where PostgreSQL says a COPY hit a value it couldn't parse, e.g. 'COPY pkg, line 1234, column valor: "1,5"'.
+COPY_ERROR_CONTEXT = re.compile(r'line \d+, column (.+?): "(.*)"', re.S)
+# How long DDL waits for another process's hold on a table before giving up (the resource is then tried again).
+DDL_LOCK_TIMEOUT = "30s"
+
+
+class QueueReader:
+    """
+    A read-only file-like object over a bounded queue of text chunks, so that
+    cursor.copy_expert can COPY data while it's still being downloaded.
+    """
+
+    def __init__(self, chunks: queue.Queue):
+        self.chunks = chunks
+        self._buffer = ""
+        self._done = False
+
+    def read(self, size: int = -1) -> str:
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is _END:
+                self._done = True
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class ResourceStream:
+    """
+    The download side of one resource being streamed into the database.
+    put() blocks when the queue is full, so the download never runs more than
+    a few chunks ahead of COPY.
+    """
+
+    def __init__(self, chunks: queue.Queue, future: Future):
+        self.chunks = chunks
+        self.future = future
+
+    def put(self, text):
+        """
+        Queues a chunk for COPY. Raises RuntimeError if COPY has already stopped, rather than
+        waiting forever on a queue nobody reads.
+        """
+        while True:
+            if self.future.done():
+                raise RuntimeError("COPY stopped before the end of the data")
+            try:
+                self.chunks.put(text, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self) -> bool:
+        """
+        Marks the end of the data and waits for COPY to commit. Returns True if it did.
+        """
+        try:
+            self.put(_END)
+        except RuntimeError:
+            pass
+        return self.future.result()
+
+    def abort(self, error: BaseException):
+        """
+        Makes COPY fail so its transaction is rolled back, then waits for it to finish.
+        """
+        try:
+            self.put(error)
+        except RuntimeError:
+            pass
+        self.future.result()
+
+
+class StreamingLoader:
+    """
+    Streams downloads straight into PostgreSQL with COPY, skipping the CSV-on-disk hop.
+
+    Each resource is COPYed over its own connection from a pool, in its own transaction, fed by a
+    bounded queue that the download thread fills as chunks arrive. A package's table is created
+    from a sample of the first chunk of the first resource to arrive. The pool has one connection
+    more than the COPYs can use, kept for creating and widening tables one at a time, as psycopg2's
+    pool raises instead of waiting when it runs out. ALTER TABLE has to wait for every COPY into the
+    table to commit, so a table is only widened once the streams into it have drained, and no new
+    ones start until it's done.
+
+    Only the first chunk is there to infer types from, so when COPY hits a later value that doesn't
+    fit its column, the value is remembered and the column is widened to fit it when the resource
+    is tried again.
+
+    Like copy_package_to_db, loads are incremental: a resource whose revision is already recorded
+    in _bcn_etl_loads doesn't need loading, and a changed one replaces its old rows.
+    """
+
+    def __init__(
+            self,
+            db_config: Database,
+            max_connections: int = 4,
+            queue_chunks: int = 8,
+            column_aliases: dict = None,
+            metrics=None,
+            ):
+        self.db_config = db_config
+        self.queue_chunks = queue_chunks
+        self.column_aliases = column_aliases or {}
+        self.metrics = metrics
+        self.pool = ThreadedConnectionPool(
+            1,
+            max_connections + 1,
+            f"dbname={db_config.db_name} user={db_config.db_user} host={db_config.db_host}",
+            )
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="db_stream")
+        self._lock = threading.Lock()
+        self._ddl_lock = threading.Lock()
+        self._tables = {}
+
+    @contextmanager
+    def _ddl_connection(self):
+        """
+        Lends the connection kept for table checks and DDL. The COPYs never take more than
+        max_connections, so one is always left for whoever holds the lock.
+        """
+        with self._ddl_lock:
+            conn = self.pool.getconn()
+            try:
+                yield conn
+            finally:
+                self.pool.putconn(conn)
+
+    def prepare_package(self, table_name: str) -> bool:
+        """
+        Checks once per run whether a package can be streamed into its table, and reads what's
+        already loaded there. Tables loaded before incremental loading existed can't be.
+        """
+        with self._lock:
+            if table_name not in self._tables:
+                with self._ddl_connection() as conn:
+                    with conn:
+                        cur = conn.cursor()
+                        ensure_loads_table(cur)
+                        exists = cursor_table_exists(cur, table_name)
+                        writable = not exists or has_resource_column(cur, table_name)
+                        table_lock = threading.Lock()
+                        self._tables[table_name] = {
+                            "writable": writable,
+                            "schema": TableSchema(
+                                table_columns(cur, table_name),
+                                self.column_aliases.get(table_name),
+                                ) if exists and writable else None,
+                            "loaded": loaded_resources(cur, table_name) if writable else {},
+                            "bad_values": {},
+                            "lock": table_lock,
+                            # signalled when a stream into the table ends or its DDL is done
+                            "changed": threading.Condition(table_lock),
+                            "streams": 0,
+                            "altering": False,
+                        }
+                if not self._tables[table_name]["writable"]:
+                    print(f"Table {table_name} was loaded before incremental loading existed and has no {RESOURCE_COLUMN} column. Drop it to reload it.")
+            return self._tables[table_name]["writable"]
+
+    def needs_load(self, table_name: str, resource: dict) -> bool:
+        """
+        Checks whether a resource is missing from its table or loaded at an older revision.
+        """
+        loaded = self._tables[table_name]["loaded"]
+        return loaded.get(resource["id"]) != resource_signature(resource)
+
+    def _fit_table(self, table_name: str, columns: list) -> TableSchema:
+        """
+        Creates the package's table, or widens it if a resource's columns don't fit, and returns
+        its schema. The caller is counted as a stream into the table until _end_stream.
+        """
+        state = self._tables[table_name]
+        with state["changed"]:
+            state["changed"].wait_for(lambda: not state["altering"])
+            current = state["schema"]
+            schema = current.copy() if current else TableSchema((), self.column_aliases.get(table_name))
+            added, widened = schema.merge(columns)
+            if current and not added and not widened:
+                state["streams"] += 1
+                return current
+            state["altering"] = True
+            state["changed"].wait_for(lambda: state["streams"] == 0)
+
+        try:
+            with self._ddl_connection() as conn:
+                with conn:
+                    cur = conn.cursor()
+                    cur.execute("SET LOCAL lock_timeout = %s", (DDL_LOCK_TIMEOUT,))
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table_name,))
+                    if current is None and not cursor_table_exists(cur, table_name):
+                        create_table(cur, table_name, schema.ddl())
+                    elif current is None:
+                        # another process created it in the meantime
+                        schema = TableSchema(table_columns(cur, table_name), self.column_aliases.get(table_name))
+                        added, widened = schema.merge(columns)
+                        alter_table(cur, table_name, schema, added, widened)
+                    else:
+                        alter_table(cur, table_name, schema, added, widened)
+        except BaseException:
+            with state["changed"]:
+                state["altering"] = False
+                state["changed"].notify_all()
+            raise
+
+        with state["changed"]:
+            # columns with no values yet were created as TEXT
+            state["schema"] = TableSchema(schema.ddl(), self.column_aliases.get(table_name))
+            state["altering"] = False
+            state["streams"] += 1
+            state["changed"].notify_all()
+            return state["schema"]
+
+    def _end_stream(self, table_name: str):
+        state = self._tables[table_name]
+        with state["changed"]:
+            state["streams"] -= 1
+            state["changed"].notify_all()
+
+    def _copy(self, table_name: str, resource: dict, targets: list[str], coerce_row, chunks: queue.Queue) -> bool:
+        conn = self.pool.getconn()
+        try:
+            source = QueueReader(chunks)
+            if coerce_row:
+                source = CoercingReader(source, coerce_row)
+            started = time.perf_counter()
+            with conn:
+                rows = replace_resource_rows(conn.cursor(), table_name, resource, targets, source)
+            if self.metrics:
+                # this includes waiting for the download, which runs at the same time
+                self.metrics.record_stage("db_load", time.perf_counter() - started, rows=rows)
+            with self._lock:
+                self._tables[table_name]["loaded"][resource["id"]] = resource_signature(resource)
+            return True
+        except Exception as e:
+            print(f"Could not stream {resource['name']} into {table_name}: {e}")
+            if isinstance(e, psycopg2.DataError):
+                self._remember_bad_value(table_name, e)
+            return False
+        finally:
+            self.pool.putconn(conn)
+            self._end_stream(table_name)
+
+    def _remember_bad_value(self, table_name: str, error: psycopg2.DataError):
+        match = COPY_ERROR_CONTEXT.search(error.diag.context or "")
+        if match:
+            key = TableSchema((), self.column_aliases.get(table_name)).key(match.group(1))
+            with self._lock:
+                self._tables[table_name]["bad_values"].setdefault(key, []).append(match.group(2))
+
+    def open_stream(self, table_name: str, resource: dict, first_text: str) -> ResourceStream:
+        """
+        Starts a COPY for one resource and returns the stream to feed it.
+
+        Args:
+            table_name (str): The package's table.
+            resource (dict): The resource being streamed, for its id and revision.
+            first_text (str): The first decoded chunk of the resource, used for the header and
+                to infer the resource's column types.
+        """
+        reader = csv.reader(StringIO(first_text))
+        header = next(reader)
+        sample = list(islice(reader, SAMPLE_ROWS))
+        if sample and not first_text.endswith("\n"):
+            # the last line of the chunk is cut off, so it's left out of the sample
+            sample.pop()
+        columns = infer_rows(header, sample)
+        bad_values = self._tables[table_name]["bad_values"]
+        if bad_values:
+            keys = TableSchema((), self.column_aliases.get(table_name)).keys_for(header)
+            columns = [
+                merge_columns(column, infer_column(column.name, bad_values[key])) if key in bad_values else column
+                for key, column in zip(keys, columns)
+                ]
+        schema = self._fit_table(table_name, columns)
+        try:
+            coerce_row = row_coercer(columns, schema.target_types(header))
+            chunks = queue.Queue(maxsize=self.queue_chunks)
+            chunks.put(first_text)
+            future = self.executor.submit(self._copy, table_name, resource, schema.targets(header), coerce_row, chunks)
+        except BaseException:
+            # _copy never ran, so it won't end the stream
+            self._end_stream(table_name)
+            raise
+        return ResourceStream(chunks, future)
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.closeall()
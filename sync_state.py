@@ -0,0 +1,110 @@
+import json, os, tempfile, threading
+from typing import Optional
+import requests
+from storage import find_stored
+
+MANIFEST_NAME = ".sync_state.json"
+
+# The fields from a package_show resource that change when the resource is revised upstream.
+SYNC_FIELDS = ("id", "revision_id", "last_modified", "size", "hash")
+
+
+class SyncState:
+    """
+    The sync-state manifest for one package: what was known about each resource the last time it
+    was downloaded, stored as JSON in the package directory and keyed by resource id.
+
+    A resource is downloaded again only when its CKAN metadata has changed, and the ETag and
+    Last-Modified headers from the last download are kept so the re-download can be a
+    conditional request.
+    """
+
+    def __init__(self, package_dir: str):
+        self.package_dir = package_dir
+        self.path = os.path.join(package_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.resources = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self):
+        """
+        Writes the manifest to disk, through a temp file so a crash never leaves it half-written.
+        """
+        with self._lock:
+            os.makedirs(self.package_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=self.package_dir, prefix=f"{MANIFEST_NAME}.", delete=False
+                ) as f:
+                json.dump(self.resources, f, indent=1, sort_keys=True)
+            os.replace(f.name, self.path)
+
+    def entry(self, resource: dict) -> Optional[dict]:
+        with self._lock:
+            return self.resources.get(resource["id"])
+
+    def needs_update(self, resource: dict, query: Optional[str] = None) -> bool:
+        """
+        Checks whether a resource has to be downloaded.
+
+        Files downloaded before the manifest existed are adopted: if the file is on disk but has no
+        entry, its current metadata is recorded and it's treated as up to date.
+
+        Args:
+            resource (dict): A dictionary with information about the resource.
+            query (str): For a file pulled from the DataStore, the query that selected it (see
+                datastore.DatastoreQuery.key). A file saved with another query, or in full, is out of date.
+
+        Returns:
+            True if the resource is new, has changed upstream or is missing from disk.
+        """
+        on_disk = find_stored(self.package_dir, resource["name"]) is not None
+        entry = self.entry(resource)
+        if entry is None:
+            # a file from before the manifest is a full download, so it doesn't answer a query
+            if on_disk and query is None:
+                self.record(resource)
+                return False
+            return True
+        if not on_disk or entry.get("name") != resource["name"] or entry.get("query") != query:
+            return True
+        return any(entry.get(field) != resource.get(field) for field in SYNC_FIELDS)
+
+    def conditional_headers(self, resource: dict) -> dict:
+        """
+        Returns If-None-Match / If-Modified-Since headers for re-downloading a resource,
+        based on the headers the server sent with the last download.
+        """
+        entry = self.entry(resource) or {}
+        headers = {}
+        if find_stored(self.package_dir, resource["name"]) is None:
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("http_last_modified"):
+            headers["If-Modified-Since"] = entry["http_last_modified"]
+        return headers
+
+    def record(self, resource: dict, response: Optional[requests.Response] = None, query: Optional[str] = None):
+        """
+        Stores the resource's current metadata, plus the validators from the response if there was one
+        and the DataStore query if the file was pulled with one.
+        """
+        entry = {field: resource.get(field) for field in SYNC_FIELDS}
+        entry["name"] = resource["name"]
+        if query:
+            entry["query"] = query
+        with self._lock:
+            previous = self.resources.get(resource["id"], {})
+            if response is not None:
+                entry["etag"] = response.headers.get("ETag") or previous.get("etag")
+                entry["http_last_modified"] = response.headers.get("Last-Modified") or previous.get("http_last_modified")
+            else:
+                entry["etag"] = previous.get("etag")
+                entry["http_last_modified"] = previous.get("http_last_modified")
+            self.resources[resource["id"]] = entry
@@ -0,0 +1,116 @@
+import bisect, csv, json, os, tempfile, unicodedata
+from functools import lru_cache
+
+INDEX_SUFFIX = ".index.json"
+
+
+def normalize_tag(tag: str) -> str:
+    """
+    Lowercases a tag and strips its accents, so Catalan and Spanish spellings
+    ("Població", "Población", "poblacio") land close together in the index.
+    """
+    decomposed = unicodedata.normalize("NFKD", tag.strip().lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def read_catalog(catalog_path: str) -> dict[str, list[str]]:
+    """
+    Reads the tag catalog CSV into a dictionary of package name -> tags.
+    """
+    with open(catalog_path, "r", encoding="utf-8", newline="") as f:
+        return {
+            row["name"]: [t for t in (row.get("tags_list") or "").split(",") if t.strip()]
+            for row in csv.DictReader(f)
+        }
+
+
+class TagIndex:
+    """
+    An inverted index from normalized tag to the names of the packages carrying it.
+
+    The index is built once from catalog_tags.csv and saved next to it as
+    catalog_tags.index.json. It's rebuilt automatically when the catalog changes.
+    """
+
+    def __init__(self, index: dict[str, list[str]]):
+        self.index = index
+        self._sorted_tags = sorted(index)
+
+    @classmethod
+    def build(cls, catalog: dict[str, list[str]]) -> "TagIndex":
+        index = {}
+        for name, tags in catalog.items():
+            for tag in tags:
+                index.setdefault(normalize_tag(tag), set()).add(name)
+        return cls({tag: sorted(names) for tag, names in index.items()})
+
+    @classmethod
+    def load(cls, catalog_path: str = "catalog_tags.csv") -> "TagIndex":
+        """
+        Loads the index saved next to the catalog, building (and saving) it first if it's
+        missing or older than the catalog. Repeated loads in the same process are free.
+        """
+        stat = os.stat(catalog_path)
+        return _load_index(os.path.abspath(catalog_path), stat.st_mtime, stat.st_size)
+
+    def save(self, index_path: str, catalog_mtime: float, catalog_size: int):
+        directory = os.path.dirname(index_path) or "."
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, suffix=".tmp", delete=False) as f:
+            json.dump({"catalog_mtime": catalog_mtime, "catalog_size": catalog_size, "index": self.index}, f)
+        os.replace(f.name, index_path)
+
+    def lookup(self, tag: str, prefix: bool = False) -> set[str]:
+        """
+        Returns the packages with a tag, or with any tag starting with it if prefix is True.
+        """
+        tag = normalize_tag(tag)
+        if not prefix:
+            return set(self.index.get(tag, ()))
+        packages = set()
+        start = bisect.bisect_left(self._sorted_tags, tag)
+        for indexed_tag in self._sorted_tags[start:]:
+            if not indexed_tag.startswith(tag):
+                break
+            packages.update(self.index[indexed_tag])
+        return packages
+
+    def search(self, tags: list[str], match: str = "any", prefix: bool = False) -> list[str]:
+        """
+        Returns the packages matching the tags.
+
+        Args:
+            tags (list[str]): The tags to look up.
+            match (str): "any" for packages with at least one of the tags, "all" for packages with every tag.
+            prefix (bool): Treat each tag as a prefix (e.g. "transport" matches "transporte" and "transport public").
+
+        Returns:
+            A sorted list of package names.
+        """
+        results = [self.lookup(tag, prefix=prefix) for tag in tags]
+        if not results:
+            return []
+        if match == "all":
+            packages = set.intersection(*results)
+        else:
+            packages = set.union(*results)
+        return sorted(packages)
+
+
+@lru_cache(maxsize=8)
+def _load_index(catalog_path: str, catalog_mtime: float, catalog_size: int) -> TagIndex:
+    index_path = os.path.splitext(catalog_path)[0] + INDEX_SUFFIX
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved["catalog_mtime"] == catalog_mtime and saved["catalog_size"] == catalog_size:
+            return TagIndex(saved["index"])
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    tag_index = TagIndex.build(read_catalog(catalog_path))
+    try:
+        tag_index.save(index_path, catalog_mtime, catalog_size)
+    except OSError:
+        # a read-only catalog directory just means the index gets rebuilt next time
+        pass
+    return tag_index
@@ -0,0 +1,54 @@
+import logging, os
+from unittest.mock import patch
+import data_functions
+from benchmarks.fake_ckan import FakeCKAN
+from blob_store import BlobStore
+from pipeline_functions import main_pipeline
+
+logger = logging.getLogger("test")
+
+
+def write(store, tmp_path, package, name, text, upstream_hash=None):
+    resource = {"name": name, "package_name": package}
+    assert data_functions.write_text_chunks(
+        logger, resource, iter([text]), path=str(tmp_path), blob_store=store, upstream_hash=upstream_hash
+        )
+    return os.path.join(tmp_path, package, name)
+
+
+def blobs(store):
+    return [name for directory in os.listdir(store.root) if os.path.isdir(os.path.join(store.root, directory))
+            for name in os.listdir(os.path.join(store.root, directory))]
+
+
+def test_identical_content_is_stored_once_and_replaced_files_are_pruned(tmp_path):
+    store = BlobStore(str(tmp_path / ".blobs"))
+    first = write(store, tmp_path, "a", "2024_a.csv", "x,y\n1,2\n")
+    second = write(store, tmp_path, "b", "2024_renamed.csv", "x,y\n1,2\n")
+    other = write(store, tmp_path, "a", "2025_a.csv", "x,y\n3,4\n")
+
+    assert os.path.samefile(first, second)
+    assert not os.path.samefile(first, other)
+    assert len(blobs(store)) == 2
+    with open(second, encoding="utf-8") as f:
+        assert f.read() == "x,y\n1,2\n"
+    assert [name for name in os.listdir(tmp_path / "a") if name.endswith(".tmp")] == []
+
+    # the new version of 2025_a.csv leaves its old content unreferenced
+    write(store, tmp_path, "a", "2025_a.csv", "x,y\n5,6\n")
+    assert store.prune() == (1, len("x,y\n3,4\n"))
+    assert len(blobs(store)) == 2
+
+
+def test_known_upstream_hashes_are_linked_without_a_download(tmp_path):
+    with FakeCKAN(packages={"first": 2, "second": 2}, rows=50, hashes=True) as fake, \
+            patch.object(data_functions, "PACKAGE_SHOW_URL", f"{fake.api_url}/package_show"):
+        store = BlobStore(str(tmp_path / ".blobs"))
+        first = main_pipeline(logger, "first", str(tmp_path), blob_store=store)
+        second = main_pipeline(logger, "second", str(tmp_path), blob_store=BlobStore(store.root))
+        downloads = [entry[0].split("/download/")[1] for entry in fake.requests if "/download/" in entry[0]]
+
+    assert len(first.resources_success) == len(second.resources_success) == 2
+    assert sorted(downloads) == ["first/2024", "first/2025"]
+    assert os.path.samefile(tmp_path / "first" / "2025_first.csv", tmp_path / "second" / "2025_second.csv")
+    assert len(blobs(store)) == 2
@@ -0,0 +1,54 @@
+import logging
+from unittest.mock import patch
+import data_functions
+from benchmarks.fake_ckan import FakeCKAN
+from catalog_sync import sync_catalog
+from metadata_cache import MetadataCache
+from pipeline_functions import get_packages, fetch_package_metadata
+from reporting import Report
+
+logger = logging.getLogger("test")
+
+packages = {f"package-{i:02d}": 2 for i in range(25)}
+tags = {"package-03": ["Població", "Seccions censals"], "package-17": ["Transport", "Població"]}
+
+
+def test_sync_pages_the_whole_catalog_and_regenerates_the_tag_catalog(tmp_path):
+    catalog_path = str(tmp_path / "catalog_tags.csv")
+    cache = MetadataCache(path=str(tmp_path / "cache.sqlite"))
+    with FakeCKAN(packages=packages, tags=tags, rows=10) as fake, \
+            patch.object(data_functions, "PACKAGE_SEARCH_URL", f"{fake.api_url}/package_search"):
+        catalog = sync_catalog(logger, catalog_path=catalog_path, metadata_cache=cache, page_size=10)
+        requests_made = list(fake.requests)
+
+    assert sorted(catalog) == sorted(packages)
+    assert len(requests_made) == 3
+    assert get_packages(["poblacio"], catalog_path=catalog_path) == ["package-03", "package-17"]
+    assert get_packages(["transport", "població"], match="all", catalog_path=catalog_path) == ["package-17"]
+
+    # the resource lists come from the cache, without a package_show
+    with patch.object(data_functions, "request_resource_library") as request:
+        data = fetch_package_metadata(logger, "package-17", Report("package-17", 0), metadata_cache=cache)
+    request.assert_not_called()
+    assert len(data_functions.process_resource_library(logger, data, "package-17")) == 2
+
+
+def test_a_failed_sync_leaves_the_catalog_and_cache_alone(tmp_path):
+    catalog_path = tmp_path / "catalog_tags.csv"
+    catalog_path.write_text("name,tags_list\nold-package,Transport\n", encoding="utf-8")
+    cache = MetadataCache(path=str(tmp_path / "cache.sqlite"))
+    with FakeCKAN(packages=packages, rows=10, failure_rate=1.0) as fake, \
+            patch.object(data_functions, "PACKAGE_SEARCH_URL", f"{fake.api_url}/package_search"):
+        catalog = sync_catalog(logger, catalog_path=str(catalog_path), metadata_cache=cache, page_size=10, workers=1)
+
+    assert catalog is None
+    assert catalog_path.read_text(encoding="utf-8") == "name,tags_list\nold-package,Transport\n"
+    assert cache.get("package_show:package-00") is None
+
+
+def test_retried_pages_still_make_a_complete_catalog(tmp_path):
+    with FakeCKAN(packages=packages, rows=10, failure_rate=0.5) as fake, \
+            patch.object(data_functions, "PACKAGE_SEARCH_URL", f"{fake.api_url}/package_search"):
+        catalog = sync_catalog(logger, catalog_path=str(tmp_path / "catalog_tags.csv"), page_size=10, workers=1)
+
+    assert sorted(catalog) == sorted(packages)
@@ -0,0 +1,127 @@
+import logging
+from unittest.mock import patch
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import data_functions
+from benchmarks.fake_ckan import FakeCKAN
+from columnar import (
+    build_package_dataset,
+    columnar_is_current,
+    columnar_path,
+    read_dataset,
+    read_package,
+    resource_year,
+    write_columnar,
+)
+from scheduler import run_packages
+
+logger = logging.getLogger(__name__)
+
+
+def save(tmp_path, name, text):
+    package_dir = tmp_path / "pkg"
+    package_dir.mkdir(exist_ok=True)
+    (package_dir / name).write_text(text, encoding="utf-8")
+    return {"name": name, "package_name": "pkg"}
+
+
+def test_columnar_path_is_partitioned_by_package_and_year(tmp_path):
+    assert resource_year("2025_pad_mdbas.csv") == "2025"
+    assert resource_year("pad_mdbas.csv") is None
+    path = columnar_path(str(tmp_path), {"name": "2025_pad_mdbas.csv", "package_name": "pkg"}, "parquet")
+    assert path == str(tmp_path / "parquet" / "package=pkg" / "year=2025" / "2025_pad_mdbas.parquet")
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_years_read_back_as_one_typed_table(tmp_path, output_format):
+    resources = [
+        save(tmp_path, "2019_test.csv", "Any,Valor,Data,Actiu\n2019,1,31/12/2019,Sí\n2019,-,1/2/2019,no\n"),
+        save(tmp_path, "2024_test.csv", "valor,any,data,actiu\n\"2,5\",2024,2024-01-01,\n"),
+    ]
+    for resource in resources:
+        assert write_columnar(logger, resource, str(tmp_path), output_format)
+        assert columnar_is_current(str(tmp_path), resource, output_format)
+
+    table = read_package(str(tmp_path), "pkg", output_format).sort_by("_year")
+
+    assert [str(field.type) for field in table.schema] == ["int64", "double", "date32[day]", "bool", "int32"]
+    assert table.column("valor").to_pylist() == [1.0, None, 2.5]
+    assert table.column("actiu").to_pylist() == [True, False, None]
+    assert read_package(str(tmp_path), "pkg", output_format, years=[2024]).num_rows == 1
+    assert read_package(str(tmp_path), "pkg", output_format, columns=["valor", "_year"]).column_names == ["valor", "_year"]
+
+
+def test_values_past_the_sample_widen_the_column_types(tmp_path):
+    resource = save(tmp_path, "2024_test.csv", "any,valor\n" + "2024,1\n" * 1000 + "not a year,\"1,5\"\n")
+
+    assert write_columnar(logger, resource, str(tmp_path))
+    table = read_package(str(tmp_path), "pkg")
+    assert [str(field.type) for field in table.schema][:2] == ["string", "double"]
+    assert table.column("valor").to_pylist()[-2:] == [1.0, 1.5]
+    assert [path.name for path in (tmp_path / "parquet").rglob("*") if path.is_file()] == ["2024_test.parquet"]
+
+
+def test_a_year_with_values_past_the_sample_rewrites_the_dataset(tmp_path):
+    save(tmp_path, "2023_test.csv", "any,valor\n2023,1\n")
+    save(tmp_path, "2024_test.csv", "any,valor\n" + "2024,1\n" * 1000 + "2024,\"1,5\"\n")
+
+    assert build_package_dataset(logger, str(tmp_path), "pkg")
+    table = read_dataset(str(tmp_path), "pkg").sort_by("_year")
+    assert str(table.schema.field("valor").type) == "double"
+    assert table.column("valor").to_pylist()[-1] == 1.5
+    assert table.num_rows == 1002
+
+
+def test_package_dataset_lines_up_the_years_and_rebuilds_only_what_changed(tmp_path):
+    save(tmp_path, "2019_test.csv", "Any,Valor,Nom Barri\n2019,1,el Raval\n2019,-,Gràcia\n")
+    save(tmp_path, "2024_test.csv", "valor,any,nom_barri\n\"2,5\",2024,Sants\n")
+    assert build_package_dataset(logger, str(tmp_path), "pkg")
+    directory = tmp_path / "datasets" / "parquet" / "pkg"
+    assert sorted(path.name for path in directory.iterdir()) == ["2019.parquet", "2024.parquet", "_metadata", "_sources.json"]
+
+    table = read_dataset(str(tmp_path), "pkg").sort_by("_year")
+    assert table.column_names == ["any", "valor", "nom_barri", "_year", "_resource"]
+    assert table.column("valor").to_pylist() == [1.0, None, 2.5]
+    assert table.column("_resource").to_pylist() == ["2019_test.csv", "2019_test.csv", "2024_test.csv"]
+    assert read_dataset(str(tmp_path), "pkg", years=[2024], columns=["nom_barri"]).to_pylist() == [{"nom_barri": "Sants"}]
+
+    # a new year that fits the schema leaves the other years alone
+    untouched = (directory / "2019.parquet").stat().st_mtime_ns
+    save(tmp_path, "2025_test.csv", "Valor,Any,Nom_Barri\n3,2025,les Corts\n")
+    assert build_package_dataset(logger, str(tmp_path), "pkg")
+    assert (directory / "2019.parquet").stat().st_mtime_ns == untouched
+    assert read_dataset(str(tmp_path), "pkg").num_rows == 4
+
+    # a year whose file is gone is dropped, and a column that no longer fits rewrites every year
+    (tmp_path / "pkg" / "2025_test.csv").unlink()
+    save(tmp_path, "2024_test.csv", "valor,any,nom_barri\n\"2,5\",dos mil,Sants\n")
+    assert build_package_dataset(logger, str(tmp_path), "pkg")
+    assert (directory / "2019.parquet").stat().st_mtime_ns != untouched
+    assert not (directory / "2025.parquet").exists()
+    table = read_dataset(str(tmp_path), "pkg").sort_by("_year")
+    assert table.column("any").to_pylist() == ["2019", "2019", "dos mil"]
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_renamed_columns_line_up_with_aliases(tmp_path, output_format):
+    save(tmp_path, "2023_test.csv", "Barri,Valor\nSants,1\n")
+    save(tmp_path, "2024_test.csv", "Nom_Barri,Valor\nGràcia,2\n")
+    assert build_package_dataset(logger, str(tmp_path), "pkg", output_format, aliases={"Barri": "Nom_Barri"})
+
+    table = read_dataset(str(tmp_path), "pkg", output_format).sort_by("_year")
+    assert table.column_names == ["nom_barri", "valor", "_year", "_resource"]
+    assert table.column("nom_barri").to_pylist() == ["Sants", "Gràcia"]
+    assert table.column("_year").to_pylist() == [2023, 2024]
+
+
+def test_downloaded_packages_are_consolidated(tmp_path):
+    with FakeCKAN(packages={"fake-package": 3}, rows=20) as fake, \
+            patch.object(data_functions, "PACKAGE_SHOW_URL", f"{fake.api_url}/package_show"):
+        reports = run_packages(logger, ["fake-package"], str(tmp_path), dataset_format="parquet")
+
+    assert reports[0].num_errors == 0
+    table = read_dataset(str(tmp_path), "fake-package")
+    assert table.num_rows == 60
+    assert sorted(set(table.column("_year").to_pylist())) == [2023, 2024, 2025]
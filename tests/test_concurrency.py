@@ -0,0 +1,95 @@
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+from concurrency import HostLimiter, DownloadBudget
+from reporting import Report
+
+
+def test_host_limiter_caps_requests_per_host():
+    limiter = HostLimiter(max_per_host=2)
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def fake_request(url):
+        nonlocal in_flight, peak
+        with limiter.slot(url):
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight -= 1
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(fake_request, ["https://example.com/a.csv"] * 10))
+
+    assert peak == 2
+
+
+def test_host_limiter_hosts_are_independent():
+    limiter = HostLimiter(max_per_host=1)
+    with limiter.slot("https://one.example.com/a.csv"):
+        with limiter.slot("https://two.example.com/b.csv"):
+            pass
+
+
+def test_report_counters_are_thread_safe():
+    report = Report("test-package", time.time())
+
+    def bump(_):
+        for _ in range(1000):
+            report.add_error()
+            report.add_skipped()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(bump, range(8)))
+
+    assert report.num_errors == 8000
+    assert report.skipped == 8000
+
+
+def test_download_budget_caps_total_in_flight():
+    budget = DownloadBudget(total=3)
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def fake_download(owner):
+        nonlocal in_flight, peak
+        with budget.slot(owner):
+            with lock:
+                in_flight += 1
+                peak = max(peak, in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight -= 1
+
+    for owner in ("a", "b"):
+        budget.register(owner)
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        list(executor.map(fake_download, ["a", "b"] * 10))
+
+    assert peak == 3
+
+
+def test_download_budget_shares_slots_between_packages():
+    budget = DownloadBudget(total=2)
+    budget.register("greedy")
+    budget.register("late")
+    release = threading.Event()
+    got_slot = threading.Event()
+
+    def hold(owner, event=None):
+        with budget.slot(owner):
+            if event:
+                event.set()
+            release.wait(2)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        executor.submit(hold, "greedy")
+        time.sleep(0.05)
+        # "late" is waiting, so "greedy" can't take a second slot ahead of it
+        late = executor.submit(hold, "late", got_slot)
+        assert got_slot.wait(1)
+        release.set()
+        late.result()
@@ -0,0 +1,154 @@
+import logging, threading, time
+from unittest.mock import patch
+import daemon
+from job_queue import JobQueue, DONE, FAILED, PENDING
+from reporting import Report
+
+logger = logging.getLogger("test")
+
+
+def fake_report(package, failed=()):
+    report = Report(package, time.time())
+    report.package_success = True
+    report.revision = "r1"
+    report.resources_success = [f"{package}.csv"]
+    report.resources_fail = [{"name": name} for name in failed]
+    return report
+
+
+def test_failed_packages_are_retried_and_done_ones_are_not_rerun(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    queue.add("steady")
+    queue.add("flaky")
+    runs = []
+
+    def run(packages):
+        runs.append(packages)
+        return [fake_report(p, failed=["flaky.csv"] if p == "flaky" and len(runs) == 1 else ()) for p in packages]
+
+    daemon.run_queued(logger, queue, run, retry_delay=0, max_retry_delay=0)
+    assert queue.job("steady")["state"] == DONE
+    assert queue.job("flaky")["state"] == FAILED
+
+    daemon.run_queued(logger, queue, run, retry_delay=0, max_retry_delay=0)
+    assert runs == [["steady", "flaky"], ["flaky"]]
+    assert queue.job("flaky")["state"] == DONE
+    assert queue.job("flaky")["revision"] == "r1"
+    assert daemon.run_queued(logger, queue, run) == []
+
+
+def test_packages_whose_database_load_failed_are_retried(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    queue.add("loaded")
+    queue.add("not_loaded")
+
+    class FakeLoader:
+        def collect(self, packages):
+            return {package: package == "loaded" for package in packages}
+
+    daemon.run_queued(logger, queue, lambda packages: [fake_report(p) for p in packages], retry_delay=0, loader=FakeLoader())
+
+    assert queue.job("loaded")["state"] == DONE
+    assert queue.job("not_loaded")["state"] == FAILED
+    assert queue.job("not_loaded")["last_error"] == "the database load failed"
+
+
+def test_poll_only_requeues_packages_that_changed_upstream(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    for package in ("same", "changed"):
+        queue.add(package)
+        queue.claim()
+        queue.finish(package, "r1")
+    payloads = {
+        "same": {"result": {"metadata_modified": "r1"}},
+        "changed": {"result": {"metadata_modified": "r2"}},
+    }
+
+    with patch.object(daemon, "fetch_package_metadata", lambda logger, package, report, **kwargs: payloads[package]):
+        changed = daemon.poll_packages(logger, queue, ["same", "changed", "new"])
+
+    assert changed == 2
+    assert queue.job("same")["state"] == DONE
+    assert queue.job("changed")["state"] == PENDING
+    assert queue.job("new")["state"] == PENDING
+
+
+def test_poll_uses_the_synced_catalog_instead_of_asking_per_package(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    for package in ("same", "changed"):
+        queue.add(package)
+        queue.claim()
+        queue.finish(package, "r1")
+    catalog = {"same": {"metadata_modified": "r1"}, "changed": {"metadata_modified": "r2"}}
+
+    with patch.object(daemon, "fetch_package_metadata") as fetch:
+        changed = daemon.poll_packages(logger, queue, ["same", "changed"], catalog=catalog)
+
+    fetch.assert_not_called()
+    assert changed == 1
+    assert queue.job("changed")["state"] == PENDING
+
+
+def test_daemon_polls_runs_and_stops(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    stop = threading.Event()
+
+    def run(packages):
+        stop.set()
+        return [fake_report(p) for p in packages]
+
+    daemon.run_daemon(
+        logger,
+        queue,
+        get_package_list=lambda: ["punts-wifi"],
+        run=run,
+        poll=lambda packages: sum(queue.add(p) for p in packages),
+        stop=stop,
+        )
+
+    assert queue.job("punts-wifi")["state"] == DONE
+
+
+def test_a_run_that_raises_puts_its_jobs_back(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    queue.add("punts-wifi")
+
+    def run(packages):
+        raise OSError("No space left on device")
+
+    assert daemon.run_queued(logger, queue, run, retry_delay=0) == []
+    assert queue.job("punts-wifi")["state"] == FAILED
+    assert queue.job("punts-wifi")["last_error"] == "unexpected error: No space left on device"
+    assert queue.claim() == ["punts-wifi"]
+
+
+def test_daemon_keeps_going_after_a_failed_cycle(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    stop = threading.Event()
+    polls = []
+
+    def poll(packages):
+        polls.append(packages)
+        if len(polls) == 1:
+            queue.add("punts-wifi")
+            queue.claim()
+            raise OSError("the database went away")
+        return 0
+
+    def run(packages):
+        stop.set()
+        return [fake_report(p) for p in packages]
+
+    daemon.run_daemon(
+        logger,
+        queue,
+        get_package_list=lambda: ["punts-wifi"],
+        run=run,
+        poll=poll,
+        poll_interval=0,
+        retry_delay=0,
+        stop=stop,
+        )
+
+    assert len(polls) == 2
+    assert queue.job("punts-wifi")["state"] == DONE
@@ -1,2 +1,96 @@
 import pytest
-from data_functions import *
\ No newline at end of file
+from data_functions import *
+import logging, os
+from unittest.mock import MagicMock
+
+logger = logging.getLogger("test")
+
+
+def fake_streaming_response(body: bytes, chunk: int = 4):
+    response = MagicMock()
+    response.iter_content.side_effect = lambda chunk_size: (body[i:i + chunk] for i in range(0, len(body), chunk))
+    return response
+
+
+def test_detect_encoding_from_first_chunk():
+    assert detect_encoding(logger, "a,b\n1,2\n".encode("utf-8")) == "utf-8"
+    assert detect_encoding(logger, "a,b\n".encode("utf-8-sig")) == "utf-8-sig"
+    assert detect_encoding(logger, "a,b\n".encode("utf-16")) == "utf-16"
+
+
+def test_detect_encoding_ignores_character_cut_at_chunk_end():
+    assert detect_encoding(logger, "any,població".encode("utf-8")[:-1]) == "utf-8"
+
+
+def test_detect_encoding_without_bom():
+    assert detect_encoding(logger, "barri,valor\nSant Martí,1\n".encode("cp1252")) == "cp1252"
+    assert detect_encoding(logger, "barri,valor\n".encode("utf-16-le")) == "utf-16-le"
+    assert detect_encoding(logger, "barri,valor\n".encode("utf-16-be")) == "utf-16-be"
+
+
+def test_decoder_switches_to_cp1252_after_an_ascii_start():
+    chunks = [b"barri,valor\n", "Sant Martí,1\n".encode("cp1252")]
+    assert "".join(decode_text_chunks(logger, iter(chunks))) == "barri,valor\nSant Martí,1\n"
+
+
+def test_semicolon_files_are_rewritten_with_commas():
+    chunks = iter(["barri;valor\nSant Martí;1,5\n", "Gràcia;2\n"])
+    assert "".join(validate_csv_text(logger, chunks)) == 'barri,valor\nSant Martí,"1,5"\nGràcia,2\n'
+
+
+def test_bad_rows_are_left_out_and_reported_with_line_numbers(caplog):
+    text = 'barri,valor\nSants,1\nGràcia,2,3\n"Les\nCorts",4\nHorta\nSant Andreu,5,\n'
+
+    with caplog.at_level(logging.WARNING):
+        result = "".join(validate_csv_text(logger, iter([text]), name="2025_test.csv"))
+
+    assert result == 'barri,valor\nSants,1\n"Les\nCorts",4\nSant Andreu,5\n'
+    assert "2025_test.csv, line 3: left out, it has 3 fields instead of 2" in caplog.text
+    assert "2025_test.csv, line 6: left out, it has 1 fields instead of 2" in caplog.text
+    assert "2 bad row(s) left out" in caplog.text
+
+
+def test_validated_text_comes_out_in_bounded_chunks():
+    text = "any,valor\n" + "".join(f"2025,{i}\n" for i in range(1000))
+    chunks = list(validate_csv_text(logger, iter([text]), chunk_size=100))
+    assert len(chunks) > 10 and "".join(chunks) == text
+
+
+def save_stream(resource, response, path):
+    chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+    return write_text_chunks(logger, resource, decode_csv_chunks(logger, chunks, resource['name']), path=path)
+
+
+def test_streamed_csv_is_written_as_utf8(tmp_path):
+    body = "nom,valor\nSant Martí,1\nGràcia,2\n".encode("utf-16")
+    resource = {"package_name": "pkg", "name": "2025_test.csv"}
+
+    assert save_stream(resource, fake_streaming_response(body), path=tmp_path)
+
+    saved = tmp_path / "pkg" / "2025_test.csv"
+    assert saved.read_text(encoding="utf-8") == "nom,valor\nSant Martí,1\nGràcia,2\n"
+    assert os.listdir(tmp_path / "pkg") == ["2025_test.csv"]
+
+
+def test_streamed_csv_leaves_nothing_behind_on_failure(tmp_path):
+    resource = {"package_name": "pkg", "name": "2025_test.csv"}
+    response = MagicMock()
+
+    def broken_stream(chunk_size):
+        yield b"a,b\n1,2\n"
+        raise requests.exceptions.ChunkedEncodingError("connection dropped")
+
+    response.iter_content.side_effect = broken_stream
+
+    assert not save_stream(resource, response, path=tmp_path)
+    assert os.listdir(tmp_path / "pkg") == []
+
+
+def test_undecodable_bytes_are_reported_but_the_row_is_kept(caplog):
+    chunks = ["barri,valor\nSant Martí,1\n".encode("utf-8"), b"Gr\xe0cia,2\n"]
+
+    with caplog.at_level(logging.WARNING):
+        result = "".join(decode_csv_chunks(logger, iter(chunks), "2025_test.csv"))
+
+    assert result == "barri,valor\nSant Martí,1\nGr�cia,2\n"
+    assert "2025_test.csv, line 3: has bytes that couldn't be decoded" in caplog.text
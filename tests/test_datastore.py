@@ -0,0 +1,94 @@
+import csv, logging, os
+from contextlib import contextmanager
+from unittest.mock import patch
+import pytest
+import data_functions
+from benchmarks.fake_ckan import FakeCKAN
+from datastore import DatastoreQuery, fetch_datastore_page
+from pipeline_functions import get_datastore_resource, main_pipeline
+from reporting import Report
+from retry_scheduler import RetryLater
+
+logger = logging.getLogger("test")
+
+
+@contextmanager
+def fake_datastore(**kwargs):
+    with FakeCKAN(**kwargs) as fake, \
+            patch.object(data_functions, "PACKAGE_SHOW_URL", f"{fake.api_url}/package_show"), \
+            patch.object(data_functions, "DATASTORE_SEARCH_URL", f"{fake.api_url}/datastore_search"):
+        yield fake
+
+
+def read_rows(tmp_path, name="2025_fake-package.csv"):
+    with open(os.path.join(tmp_path, "fake-package", name), encoding="utf-8", newline="") as f:
+        return list(csv.reader(f))
+
+
+def test_pulls_only_the_selected_columns_and_rows_in_order(tmp_path):
+    query = DatastoreQuery(
+        columns=["Seccio_Censal", "Nom_Districte"],
+        filters={"Nom_Districte": ["Gràcia", "Sant Martí"]},
+        page_size=7,
+        workers=3,
+        )
+    with fake_datastore(packages={"fake-package": 2}, rows=200, datastore=True) as fake:
+        report = main_pipeline(logger, "fake-package", str(tmp_path), workers=2, datastore_query=query)
+        paths = [entry[0] for entry in fake.requests]
+
+    assert sorted(report.resources_success) == ["2024_fake-package.csv", "2025_fake-package.csv"]
+    rows = read_rows(tmp_path)
+    assert rows[0] == ["Seccio_Censal", "Nom_Districte"]
+    assert len(rows) == 41
+    assert {row[1] for row in rows[1:]} == {"Gràcia", "Sant Martí"}
+    assert [int(row[0]) for row in rows[1:]] == [i % 250 + 1 for i in range(200) if i % 10 in (5, 9)]
+    assert not any("/download/" in path for path in paths)
+
+
+def test_files_are_pulled_again_only_when_the_query_changes(tmp_path):
+    with fake_datastore(packages={"fake-package": 1}, rows=50, datastore=True, failure_rate=0.1) as fake:
+        main_pipeline(logger, "fake-package", str(tmp_path), datastore_query=DatastoreQuery(columns=["Valor"], page_size=20))
+        again = main_pipeline(logger, "fake-package", str(tmp_path), datastore_query=DatastoreQuery(columns=["Valor"], page_size=20))
+        changed = main_pipeline(logger, "fake-package", str(tmp_path), datastore_query=DatastoreQuery(columns=["Nom_Barri", "Valor"]))
+
+    assert again.skipped == 1 and again.resources_success == []
+    assert changed.resources_success == ["2025_fake-package.csv"]
+    rows = read_rows(tmp_path)
+    assert rows[0] == ["Nom_Barri", "Valor"] and len(rows) == 51
+
+
+def test_resources_outside_the_datastore_are_downloaded_in_full(tmp_path):
+    with fake_datastore(packages={"fake-package": 1}, rows=30) as fake:
+        report = main_pipeline(logger, "fake-package", str(tmp_path), datastore_query=DatastoreQuery(columns=["Valor"]))
+        paths = [entry[0] for entry in fake.requests]
+
+    assert report.resources_success == ["2025_fake-package.csv"]
+    assert len(read_rows(tmp_path)[0]) == 7
+    assert not any(path.endswith("/datastore_search") for path in paths)
+
+
+def test_a_refused_query_fails_the_resource(tmp_path):
+    with fake_datastore(packages={"fake-package": 1}, rows=30, datastore=True):
+        report = main_pipeline(logger, "fake-package", str(tmp_path), datastore_query=DatastoreQuery(columns=["Missing"]))
+
+    assert [resource['name'] for resource in report.resources_fail] == ["2025_fake-package.csv"]
+    assert not os.path.exists(os.path.join(tmp_path, "fake-package", "2025_fake-package.csv"))
+
+
+def test_a_struggling_page_goes_back_to_the_retry_queue_without_waiting():
+    resource = {"id": "r", "name": "2025_fake-package.csv"}
+    with fake_datastore(datastore=True, failure_rate=1.0) as fake, pytest.raises(RetryLater) as retry:
+        fetch_datastore_page(logger, resource, 0, 20, DatastoreQuery())
+
+    assert len(fake.requests) == 1
+    assert retry.value.delay == 0
+
+
+def test_bad_rows_from_the_datastore_are_left_out_and_logged(tmp_path, caplog):
+    resource = {"id": "r", "name": "2025_test.csv", "package_name": "fake-package", "token_required": "no"}
+    pages = iter(["Nom_Barri,Valor\n", "el Raval,1\r\nSants\n", "Gràcia,3\n"])
+    with patch("pipeline_functions.iter_datastore_csv", return_value=pages):
+        get_datastore_resource(logger, resource, Report("fake-package", 0), str(tmp_path), DatastoreQuery())
+
+    assert read_rows(tmp_path, "2025_test.csv") == [["Nom_Barri", "Valor"], ["el Raval", "1"], ["Gràcia", "3"]]
+    assert "2025_test.csv, line 3: left out, it has 1 fields instead of 2" in caplog.text
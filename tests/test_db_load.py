@@ -1,8 +1,139 @@
 import pytest
-from db_load import insert_df
+import db_load
+from db_load import copy_package_to_db, insert_df
 from unittest.mock import MagicMock, patch
 
 def test_insert_df_database_connection_string():
     db_config = MagicMock(db_user="user", db_host="host", db_name="db")
     
 
+
+
+def test_copy_package_uses_one_connection_and_copy_for_every_file(tmp_path):
+    package_dir = tmp_path / "pkg"
+    package_dir.mkdir()
+    for year in (2024, 2025):
+        (package_dir / f"{year}_test.csv").write_text(f"any,valor\n{year},1\n", encoding="utf-8")
+
+    conn = MagicMock()
+    cur = conn.cursor.return_value
+    cur.fetchone.return_value = [None]
+    with patch.object(db_load, "connect", return_value=conn) as connect, \
+            patch.object(db_load.sql.Identifier, "as_string", return_value="\"pkg\""):
+        copy_package_to_db(str(tmp_path), "pkg", MagicMock())
+
+    connect.assert_called_once()
+    assert cur.copy_expert.call_count == 2
+    conn.close.assert_called_once()
+
+
+def test_parallel_loader_runs_packages_on_pooled_connections():
+    loaded = []
+    with patch.object(db_load, "ThreadedConnectionPool") as pool_class, \
+            patch.object(db_load, "copy_package_to_db", side_effect=lambda path, name, cfg, conn, aliases, metrics: loaded.append(name) or True):
+        loader = db_load.ParallelLoader(MagicMock(), "csv_files", max_connections=2)
+        for package in ("bus", "metro", "padro"):
+            loader.submit(package)
+        results = loader.close()
+
+    pool = pool_class.return_value
+    assert sorted(loaded) == ["bus", "metro", "padro"]
+    assert results == {"bus": True, "metro": True, "padro": True}
+    assert pool.getconn.call_count == pool.putconn.call_count == 3
+    pool.closeall.assert_called_once()
+
+
+def test_collected_loads_are_forgotten():
+    with patch.object(db_load, "ThreadedConnectionPool"), \
+            patch.object(db_load, "copy_package_to_db", side_effect=lambda path, name, cfg, conn, aliases, metrics: name != "metro"):
+        loader = db_load.ParallelLoader(MagicMock(), "csv_files", max_connections=2)
+        for package in ("bus", "metro", "padro"):
+            loader.submit(package)
+        collected = loader.collect(["bus", "metro", "tram"])
+        results = loader.close()
+
+    assert collected == {"bus": True, "metro": False}
+    assert results == {"padro": True}
+
+
+def test_copy_package_skips_resources_already_loaded_at_the_same_revision(tmp_path):
+    package_dir = tmp_path / "pkg"
+    package_dir.mkdir()
+    for year in (2024, 2025):
+        (package_dir / f"{year}_test.csv").write_text(f"any,valor\n{year},1\n", encoding="utf-8")
+    state = db_load.SyncState(str(package_dir))
+    for year in (2024, 2025):
+        state.record({"id": f"id-{year}", "name": f"{year}_test.csv", "revision_id": "r1", "size": "16"})
+    state.save()
+    unchanged = db_load.resource_signature(state.entry({"id": "id-2024"}))
+
+    conn = MagicMock()
+    with patch.object(db_load, "connect", return_value=conn), \
+            patch.object(db_load, "cursor_table_exists", return_value=True), \
+            patch.object(db_load, "has_resource_column", return_value=True), \
+            patch.object(db_load, "table_columns", return_value=[("any", "BIGINT"), ("valor", "BIGINT")]), \
+            patch.object(db_load, "loaded_resources", return_value={"id-2024": unchanged}), \
+            patch.object(db_load, "replace_resource_rows", return_value=1) as replace:
+        assert copy_package_to_db(str(tmp_path), "pkg", MagicMock())
+
+    assert [call.args[2]["id"] for call in replace.call_args_list] == ["id-2025"]
+
+
+def test_copy_package_refuses_tables_without_the_resource_column(tmp_path):
+    package_dir = tmp_path / "pkg"
+    package_dir.mkdir()
+    (package_dir / "2024_test.csv").write_text("any,valor\n2024,1\n", encoding="utf-8")
+
+    with patch.object(db_load, "connect", return_value=MagicMock()), \
+            patch.object(db_load, "cursor_table_exists", return_value=True), \
+            patch.object(db_load, "has_resource_column", return_value=False), \
+            patch.object(db_load, "replace_resource_rows") as replace:
+        assert not copy_package_to_db(str(tmp_path), "pkg", MagicMock())
+
+    replace.assert_not_called()
+
+
+def test_copy_package_reconciles_the_schema_of_every_file(tmp_path):
+    package_dir = tmp_path / "pkg"
+    package_dir.mkdir()
+    (package_dir / "2019_test.csv").write_text("Any,Valor\n2019,1\n", encoding="utf-8")
+    (package_dir / "2024_test.csv").write_text("valor,any\n\"2,5\",2024\n", encoding="utf-8")
+
+    copied = {}
+    def replace(cur, table, resource, targets, source):
+        copied[resource["name"]] = (targets, source.read())
+
+    with patch.object(db_load, "connect", return_value=MagicMock()), \
+            patch.object(db_load, "cursor_table_exists", return_value=False), \
+            patch.object(db_load, "create_table") as create_table, \
+            patch.object(db_load, "replace_resource_rows", side_effect=replace):
+        assert copy_package_to_db(str(tmp_path), "pkg", MagicMock())
+
+    assert create_table.call_args.args[2] == [("Any", "BIGINT"), ("Valor", "DOUBLE PRECISION")]
+    assert copied["2019_test.csv"] == (["Any", "Valor"], "Any,Valor\n2019,1\n")
+    assert copied["2024_test.csv"] == (["Valor", "Any"], "valor,any\n2.5,2024\n")
+
+
+def test_copy_package_reads_the_whole_file_when_a_later_value_doesnt_fit(tmp_path):
+    package_dir = tmp_path / "pkg"
+    package_dir.mkdir()
+    (package_dir / "2024_test.csv").write_text("any,valor\n" + "2024,1\n" * 1000 + "2024,\"1,5\"\n", encoding="utf-8")
+
+    copied = []
+    def replace(cur, table, resource, targets, source):
+        text = source.read()
+        if "\"1,5\"" in text:
+            raise db_load.psycopg2.DataError("invalid input syntax for type bigint")
+        copied.append(text.splitlines()[-1])
+
+    with patch.object(db_load, "connect", return_value=MagicMock()), \
+            patch.object(db_load, "cursor_table_exists", return_value=False), \
+            patch.object(db_load, "create_table"), \
+            patch.object(db_load, "alter_table") as alter_table, \
+            patch.object(db_load, "replace_resource_rows", side_effect=replace):
+        assert copy_package_to_db(str(tmp_path), "pkg", MagicMock())
+
+    schema, added, widened = alter_table.call_args.args[2:]
+    assert (added, widened) == ([], ["valor"])
+    assert schema.type_of("valor") == "DOUBLE PRECISION"
+    assert copied == ["2024,1.5"]
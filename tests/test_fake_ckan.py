@@ -0,0 +1,35 @@
+import logging, os, requests
+from unittest.mock import patch
+import data_functions
+from benchmarks.fake_ckan import FakeCKAN
+from concurrency import HostLimiter
+from pipeline_functions import main_pipeline
+
+logger = logging.getLogger("test")
+
+
+def test_main_pipeline_downloads_every_resource_from_the_fake_server(tmp_path):
+    with FakeCKAN(packages={"fake-package": 3}, rows=200, encoding="cp1252", delimiter=";") as fake, \
+            patch.object(data_functions, "PACKAGE_SHOW_URL", f"{fake.api_url}/package_show"):
+        report = main_pipeline(logger, "fake-package", str(tmp_path), workers=2, limiter=HostLimiter())
+
+    assert report.package_success
+    assert sorted(report.resources_success) == ["2023_fake-package.csv", "2024_fake-package.csv", "2025_fake-package.csv"]
+    with open(os.path.join(tmp_path, "fake-package", "2025_fake-package.csv"), encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 201
+    assert "Sants-Montjuïc" in "".join(lines)
+
+
+def test_fake_server_answers_ranges_and_fails_the_share_it_was_asked_to():
+    with FakeCKAN(packages={"fake-package": 1}, rows=50, failure_rate=0.5) as fake:
+        url = fake.package_show("fake-package")["result"]["resources"][0]["url"]
+        body = fake.body("fake-package", 2025)
+        answers = [requests.get(url, headers={"Range": "bytes=10-"}, timeout=5) for _ in range(4)]
+        beyond = requests.get(url, headers={"Range": f"bytes={len(body)}-"}, timeout=5)
+
+    assert [answer.status_code for answer in answers] == [206, 503, 206, 503]
+    assert answers[0].content == body[10:]
+    assert answers[1].headers["Retry-After"] == "0"
+    assert beyond.status_code == 416
+    assert [entry[1] for entry in fake.requests] == [206, 503, 206, 503, 416]
@@ -0,0 +1,14 @@
+import logging
+from http_client import get_session
+
+
+def test_session_pools_connections_and_retries_only_connection_errors():
+    session = get_session(logging.getLogger("test"), pool_size=7, max_retries=2)
+    adapter = session.get_adapter("https://opendata-ajuntament.barcelona.cat/data/api/action/package_show")
+
+    assert adapter._pool_maxsize == 7
+    assert adapter.max_retries.total == 2
+    # 429/5xx are left to the retry scheduler
+    assert adapter.max_retries.status == 0
+    assert not adapter.max_retries.status_forcelist
+    assert adapter.max_retries.raise_on_status is False
@@ -0,0 +1,48 @@
+import time
+from job_queue import JobQueue, PENDING, IN_FLIGHT, DONE, FAILED
+
+
+def test_jobs_left_in_flight_are_recovered_after_a_restart(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    queue = JobQueue(path)
+    queue.add("punts-wifi")
+    queue.add("pad_mdbas")
+    assert queue.claim() == ["punts-wifi", "pad_mdbas"]
+    queue.finish("punts-wifi", revision="2025-01-01T00:00:00")
+
+    # the process dies with pad_mdbas in flight
+    restarted = JobQueue(path)
+    assert restarted.recover() == 1
+    assert restarted.claim() == ["pad_mdbas"]
+    assert restarted.job("punts-wifi")["state"] == DONE
+    assert restarted.job("punts-wifi")["revision"] == "2025-01-01T00:00:00"
+
+
+def test_failed_jobs_wait_for_their_retry_time(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    queue.add("a")
+    queue.add("b")
+    queue.claim()
+    queue.fail("a", "503", retry_in=0)
+    queue.fail("b", "503", retry_in=3600)
+
+    assert queue.claim() == ["a"]
+    assert queue.job("b")["state"] == FAILED
+    assert queue.job("b")["attempts"] == 1
+    assert queue.next_due() > time.time() + 3000
+
+
+def test_only_done_jobs_are_sent_back_when_they_change(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.sqlite"))
+    queue.add("a")
+    queue.add("b")
+    queue.claim()
+    queue.finish("a")
+    assert not queue.add("a")
+
+    queue.mark_changed("a")
+    queue.mark_changed("b")
+
+    assert queue.job("a")["state"] == PENDING
+    assert queue.job("b")["state"] == IN_FLIGHT
+    assert queue.counts() == {PENDING: 1, IN_FLIGHT: 1}
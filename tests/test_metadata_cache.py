@@ -0,0 +1,47 @@
+import time
+from metadata_cache import MetadataCache
+
+
+def test_cache_round_trip_and_ttl(tmp_path):
+    cache = MetadataCache(path=str(tmp_path / "cache.sqlite"), ttl=60)
+    cache.put("package_show:punts-wifi", {"result": {"resources": []}})
+
+    assert cache.get("package_show:punts-wifi") == {"result": {"resources": []}}
+    assert cache.get("package_show:missing") is None
+
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get("package_show:punts-wifi") is None
+
+
+def test_refresh_ignores_cached_entries(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    MetadataCache(path=path).put("package_show:punts-wifi", {"result": {}})
+
+    assert MetadataCache(path=path, refresh=True).get("package_show:punts-wifi") is None
+
+
+def test_refresh_only_skips_what_was_cached_before(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    MetadataCache(path=path).put("package_show:punts-wifi", {"result": {"old": True}})
+    cache = MetadataCache(path=path, refresh=True)
+
+    assert cache.get("package_show:punts-wifi") is None
+    cache.put("package_show:punts-wifi", {"result": {}})
+    cache.put_many({"package_show:pad_mdbas": {"result": {}}})
+    assert cache.get("package_show:punts-wifi") == {"result": {}}
+    assert cache.get("package_show:pad_mdbas") == {"result": {}}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = MetadataCache(path=str(tmp_path / "cache.sqlite"), max_entries=2)
+    cache.put("a", {})
+    cache.put("b", {})
+    time.sleep(0.01)
+    cache.get("a")
+    cache.put("c", {})
+
+    assert cache.get("a") == {}
+    assert cache.get("b") is None
+    assert cache.get("c") == {}
+
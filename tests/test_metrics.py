@@ -0,0 +1,97 @@
+import json, time, urllib.request
+from metrics import Metrics, TimedIterator
+from reporting import Report, compile_reports
+
+
+def test_stages_record_time_bytes_and_rows():
+    metrics = Metrics()
+    with metrics.stage("download") as download:
+        download.bytes = 2000
+        time.sleep(0.01)
+    metrics.record_stage("download", 0.5, bytes=1000)
+
+    stats = metrics.snapshot()["stages"]["download"]
+    assert stats["calls"] == 2
+    assert stats["bytes"] == 3000
+    assert stats["max_seconds"] == 0.5
+    assert stats["bytes_per_second"] == 3000 / stats["seconds"]
+
+
+def test_time_spent_producing_chunks_is_taken_out_of_the_outer_stage():
+    def slow_chunks():
+        for text in ("a,b\n", "1,2\n3,4\n"):
+            time.sleep(0.02)
+            yield text
+
+    metrics = Metrics()
+    with metrics.stage("save") as save:
+        chunks = TimedIterator(slow_chunks())
+        assert "".join(chunks) == "a,b\n1,2\n3,4\n"
+        save.exclude(chunks.seconds)
+
+    assert chunks.rows == 3
+    assert chunks.seconds >= 0.04
+    assert metrics.snapshot()["stages"]["save"]["seconds"] < 0.02
+
+
+def test_report_counts_go_to_the_shared_metrics():
+    metrics = Metrics()
+    report = Report("pkg", time.time(), metrics)
+    report.add_retry()
+    report.add_error()
+    report.add_resources_success({"name": "2025_x.csv"})
+    with report.stage("decode") as decode:
+        decode.rows = 10
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"errors": 1, "resources_succeeded": 1, "retries": 1}
+    assert snapshot["stages"]["decode"]["rows"] == 10
+
+    # without metrics, stages are still safe to use
+    with Report("pkg", time.time()).stage("decode") as decode:
+        decode.rows = 1
+
+
+def test_compile_reports_adds_up_durations():
+    reports = [Report("a", 100.0), Report("b", 200.0)]
+    reports[0].end_time = 110.0
+    reports[1].end_time = 230.0
+
+    assert compile_reports(reports)["total_duration"] == 40.0
+
+
+def test_prometheus_and_json_exports(tmp_path):
+    metrics = Metrics()
+    metrics.record_stage("db_load", 2.0, bytes=10, rows=1_000_000)
+    metrics.increment("retries", 3)
+    metrics.set_gauge("packages_queued", 5)
+
+    text = metrics.to_prometheus()
+    assert 'bcn_etl_stage_rows_total{stage="db_load"} 1000000' in text
+    assert 'bcn_etl_stage_rows_per_second{stage="db_load"} 500000' in text
+    assert "# TYPE bcn_etl_retries_total counter" in text
+    assert "bcn_etl_packages_queued 5" in text
+
+    path = tmp_path / "metrics.jsonl"
+    metrics.write(str(path))
+    metrics.write(str(path))
+    lines = path.read_text().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[0])["counters"] == {"retries": 3}
+
+    metrics.write(str(tmp_path / "bcn_etl.prom"))
+    assert (tmp_path / "bcn_etl.prom").read_text().startswith("# HELP")
+
+
+def test_metrics_are_served_over_http():
+    metrics = Metrics()
+    metrics.increment("errors")
+    server = metrics.serve(0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert "bcn_etl_errors_total 1" in response.read().decode()
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics.json") as response:
+            assert json.load(response)["counters"] == {"errors": 1}
+    finally:
+        server.shutdown()
@@ -0,0 +1,74 @@
+import logging
+from unittest.mock import MagicMock
+import requests
+from partial_download import (
+    get_part_path, resume_headers, stream_to_part, verify_part, part_is_complete, read_checkpoint
+    )
+
+logger = logging.getLogger("test")
+
+
+def make_resource(tmp_path, **changes):
+    resource = {"package_name": "pkg", "name": "2025_test.csv", "revision_id": "r1", "size": "10"}
+    resource.update(changes)
+    return resource, get_part_path(str(tmp_path), resource)
+
+
+def fake_response(status, headers, chunks, fail=False):
+    response = MagicMock(status_code=status, headers=headers)
+
+    def iter_content(chunk_size):
+        yield from chunks
+        if fail:
+            raise requests.exceptions.ChunkedEncodingError("connection dropped")
+
+    response.iter_content.side_effect = iter_content
+    return response
+
+
+def test_interrupted_download_resumes_with_range(tmp_path):
+    resource, part_path = make_resource(tmp_path)
+    first = fake_response(200, {"Content-Length": "10", "ETag": '"v1"'}, [b"a,b\n1,"], fail=True)
+
+    assert not stream_to_part(logger, resource, first, part_path)
+    assert resume_headers(logger, resource, part_path) == {
+        "Accept-Encoding": "identity", "Range": "bytes=6-", "If-Range": '"v1"'
+        }
+
+    second = fake_response(206, {"Content-Range": "bytes 6-9/10"}, [b"2\n3\n"])
+    assert stream_to_part(logger, resource, second, part_path)
+    assert open(part_path, "rb").read() == b"a,b\n1,2\n3\n"
+    assert part_is_complete(resource, part_path)
+    assert verify_part(logger, resource, part_path)
+
+
+def test_partial_download_of_old_revision_is_discarded(tmp_path):
+    resource, part_path = make_resource(tmp_path)
+    stream_to_part(logger, resource, fake_response(200, {}, [b"a,b\n"], fail=True), part_path)
+
+    headers = resume_headers(logger, dict(resource, revision_id="r2"), part_path)
+
+    assert "Range" not in headers
+    assert read_checkpoint(part_path) == {}
+
+
+def test_verify_part_rejects_short_file(tmp_path):
+    resource, part_path = make_resource(tmp_path)
+    stream_to_part(logger, resource, fake_response(200, {"Content-Length": "10"}, [b"a,b\n"]), part_path)
+
+    assert not verify_part(logger, resource, part_path)
+
+
+def test_a_size_mismatch_with_ckan_alone_isnt_a_failure(tmp_path):
+    resource, part_path = make_resource(tmp_path, size="12")
+    stream_to_part(logger, resource, fake_response(200, {}, [b"a,b\n1,2\n"]), part_path)
+
+    assert verify_part(logger, resource, part_path)
+
+
+def test_a_finished_part_of_an_old_revision_isnt_reused(tmp_path):
+    resource, part_path = make_resource(tmp_path)
+    stream_to_part(logger, resource, fake_response(200, {"Content-Length": "10"}, [b"a,b\n1,2\n3\n"]), part_path)
+
+    assert part_is_complete(resource, part_path)
+    assert not part_is_complete(dict(resource, revision_id="r2"), part_path)
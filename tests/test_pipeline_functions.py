@@ -0,0 +1,75 @@
+import logging, threading, time
+from unittest.mock import MagicMock, patch
+import data_functions
+import pipeline_functions
+from benchmarks.fake_ckan import FakeCKAN
+from pipeline_functions import persistant_request
+from concurrency import HostLimiter
+from reporting import Report
+
+logger = logging.getLogger("test")
+resource = {"name": "2025_test.csv", "url": "https://example.org/2025_test.csv"}
+
+
+def response(status):
+    r = MagicMock(status_code=status, headers={})
+    r.elapsed.total_seconds.return_value = 0.1
+    return r
+
+
+def test_persistant_request_retries_server_errors_then_returns():
+    answers = [response(503), None, response(200)]
+    with patch.object(pipeline_functions, "download_resource", side_effect=answers) as download, \
+            patch.object(pipeline_functions.time, "sleep") as sleep:
+        result = persistant_request(logger, Report("pkg", 0), resource=resource, max_retries=3)
+
+    assert result.status_code == 200
+    assert download.call_count == 3
+    assert sleep.call_count == 2
+
+
+def test_persistant_request_doesnt_retry_client_errors_or_count_attempts_as_errors():
+    report = Report("pkg", 0)
+    with patch.object(pipeline_functions, "download_resource", return_value=response(404)) as download:
+        result = persistant_request(logger, report, resource=resource, max_retries=3)
+
+    assert result.status_code == 404
+    assert download.call_count == 1
+    assert report.num_errors == 0
+
+
+def test_persistant_request_reports_to_the_host_limiter():
+    limiter = HostLimiter(failure_threshold=2)
+    with patch.object(pipeline_functions, "download_resource", return_value=response(503)):
+        persistant_request(logger, Report("pkg", 0), resource=resource, max_retries=1, limiter=limiter)
+        persistant_request(logger, Report("pkg", 0), resource=resource, max_retries=1, limiter=limiter)
+
+    assert limiter.health(resource["url"]).state == "open"
+
+
+def test_the_host_limit_caps_body_transfers_not_just_requests(tmp_path):
+    in_flight, peak = 0, 0
+    lock = threading.Lock()
+    real_stream_to_part = pipeline_functions.stream_to_part
+
+    def counting_stream_to_part(*args, **kwargs):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        time.sleep(0.05)
+        try:
+            return real_stream_to_part(*args, **kwargs)
+        finally:
+            with lock:
+                in_flight -= 1
+
+    with FakeCKAN(packages={"fake-package": 4}, rows=20) as fake, \
+            patch.object(data_functions, "PACKAGE_SHOW_URL", f"{fake.api_url}/package_show"), \
+            patch.object(pipeline_functions, "stream_to_part", counting_stream_to_part):
+        report = pipeline_functions.main_pipeline(
+            logger, "fake-package", str(tmp_path), workers=4, limiter=HostLimiter(max_per_host=1),
+            )
+
+    assert len(report.resources_success) == 4
+    assert peak == 1
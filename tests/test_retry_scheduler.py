@@ -0,0 +1,172 @@
+import logging, threading
+from unittest.mock import MagicMock, patch
+import pytest
+from retry_scheduler import (
+    CircuitOpen,
+    HostHealth,
+    RetryLater,
+    backoff_delay,
+    retry_after_seconds,
+    run_with_retries,
+)
+
+logger = logging.getLogger("test")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    for attempt in range(10):
+        delay = backoff_delay(attempt, base=2, cap=60)
+        assert min(60, 2 * 2 ** attempt) / 2 <= delay <= min(60, 2 * 2 ** attempt)
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds(MagicMock(headers={"Retry-After": "12"})) == 12
+    assert retry_after_seconds(MagicMock(headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0
+    assert retry_after_seconds(MagicMock(headers={})) is None
+    assert retry_after_seconds(None) is None
+
+
+def test_parked_items_dont_hold_up_the_others():
+    finished = []
+    tries = {}
+    lock = threading.Lock()
+
+    def task(item):
+        with lock:
+            tries[item] = tries.get(item, 0) + 1
+        if item == "flaky" and tries[item] < 3:
+            raise RetryLater("503", delay=0.05)
+        finished.append(item)
+
+    retries = []
+    run_with_retries(logger, task, ["flaky", "a", "b", "c"], workers=1, on_retry=lambda *args: retries.append(args[0]))
+
+    assert finished == ["a", "b", "c", "flaky"]
+    assert retries == ["flaky", "flaky"]
+
+
+def test_items_out_of_attempts_are_given_up():
+    given_up, errors = [], []
+
+    def task(item):
+        if item == "down":
+            raise RetryLater("no response", delay=0)
+        raise ValueError("bug")
+
+    run_with_retries(
+        logger, task, ["down", "broken"], workers=2, max_attempts=3,
+        on_give_up=lambda item, e: given_up.append(item),
+        on_error=lambda item, e: errors.append(item),
+    )
+
+    assert given_up == ["down"]
+    assert errors == ["broken"]
+
+
+def test_refusals_by_an_open_circuit_dont_use_up_attempts():
+    tries = {"refused": 0}
+
+    def task(item):
+        tries["refused"] += 1
+        if tries["refused"] <= 5:
+            raise CircuitOpen("the server looks down", delay=0)
+
+    given_up = []
+    with patch("retry_scheduler.random.uniform", return_value=0):
+        run_with_retries(logger, task, ["refused"], max_attempts=2, on_give_up=lambda item, e: given_up.append(item))
+
+    assert tries["refused"] == 6
+    assert given_up == []
+
+
+def test_items_refused_by_a_circuit_that_never_closes_are_given_up():
+    tries = []
+
+    def task(item):
+        tries.append(item)
+        raise CircuitOpen("the server looks down", delay=0)
+
+    given_up = []
+    with patch("retry_scheduler.random.uniform", return_value=0):
+        run_with_retries(
+            logger, task, ["refused"], max_refusals=3, on_give_up=lambda item, e: given_up.append(item),
+        )
+
+    assert tries == ["refused"] * 3
+    assert given_up == ["refused"]
+
+
+def test_server_delays_are_capped():
+    def task(item):
+        raise RetryLater("429", delay=3600)
+
+    delays = []
+    with patch("retry_scheduler.random.uniform", return_value=0):
+        run_with_retries(
+            logger, task, ["slow"],
+            max_attempts=2, max_delay=0.01, on_retry=lambda item, e, delay: delays.append(delay),
+        )
+
+    assert delays == [0.01]
+
+
+def test_circuit_opens_during_an_outage_and_closes_after_a_good_probe():
+    clock = FakeClock()
+    health = HostHealth(failure_threshold=3, cooldown=30, clock=clock, sleep=clock.sleep)
+
+    for _ in range(3):
+        health.before_request()
+        health.record(503)
+    with pytest.raises(CircuitOpen) as opened:
+        health.before_request()
+    assert opened.value.delay == pytest.approx(30)
+
+    clock.now += 30
+    health.before_request()
+    # only one probe goes out while the breaker is half open
+    with pytest.raises(CircuitOpen):
+        health.before_request()
+    health.record(200, elapsed=0.1)
+    assert health.state == "closed"
+
+
+def test_failed_probe_opens_the_circuit_for_longer():
+    clock = FakeClock()
+    health = HostHealth(failure_threshold=1, cooldown=10, clock=clock, sleep=clock.sleep)
+    health.record(None)
+    clock.now += 10
+    health.before_request()
+    health.record(502)
+
+    with pytest.raises(CircuitOpen) as opened:
+        health.before_request()
+    assert opened.value.delay == pytest.approx(20)
+
+
+def test_request_rate_backs_off_on_429_and_recovers():
+    clock = FakeClock()
+    health = HostHealth(failure_threshold=100, clock=clock, sleep=clock.sleep)
+
+    health.record(429)
+    health.record(429)
+    assert health.interval == pytest.approx(0.1)
+    health.record(429, retry_after=5)
+    health.before_request()
+    assert clock.slept == [pytest.approx(5)]
+
+    for _ in range(10):
+        health.record(200, elapsed=0.2)
+    assert health.interval == 0
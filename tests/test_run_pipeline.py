@@ -0,0 +1,75 @@
+import logging, socket, subprocess, sys, os
+from unittest.mock import patch
+import pytest
+import run_pipeline
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_the_cli_doesnt_load_heavy_dependencies():
+    check = "import sys, run_pipeline; print([m for m in ('pandas', 'pyarrow', 'psycopg2', 'sqlalchemy', 'dotenv') if m in sys.modules])"
+    output = subprocess.run([sys.executable, "-c", check], cwd=REPO_ROOT, check=True, capture_output=True, text=True)
+
+    assert output.stdout.strip() == "[]"
+
+
+def test_main_checks_flag_combinations(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit) as exited:
+        run_pipeline.main(["-p", "punts-wifi", "--skip_csv"])
+    assert exited.value.code == 2
+
+
+def test_calling_main_again_doesnt_repeat_log_lines(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    logger = logging.getLogger("logging_setup")
+    # start without the handlers an earlier test added, so the log is written under tmp_path
+    monkeypatch.setattr(logger, "handlers", [])
+    argv = ["-p", "punts-wifi", "-d", str(tmp_path)]
+    try:
+        with patch.object(run_pipeline, "run_packages", return_value=[]):
+            run_pipeline.main(argv)
+            handlers = list(logger.handlers)
+            run_pipeline.main(argv)
+
+        assert logger.handlers == handlers
+        log = (tmp_path / "etl.log").read_text(encoding="utf-8")
+        assert log.count("Getting the following packages: ['punts-wifi']") == 2
+    finally:
+        for handler in logger.handlers:
+            handler.close()
+
+
+def test_main_stops_serving_metrics_when_a_stage_fails(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    for _ in range(2):
+        with patch.object(run_pipeline, "run_packages", side_effect=RuntimeError("boom")), \
+                pytest.raises(RuntimeError):
+            run_pipeline.main(["-p", "punts-wifi", "-d", str(tmp_path), "--metrics_port", str(port)])
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", port))
+
+
+def test_main_closes_the_database_loader_when_a_stage_fails(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with patch("db_load.ParallelLoader") as loader, \
+            patch.object(run_pipeline, "get_db_config", return_value={}), \
+            patch.object(run_pipeline, "run_packages", side_effect=RuntimeError("boom")), \
+            pytest.raises(RuntimeError):
+        run_pipeline.main(["-p", "punts-wifi", "-d", str(tmp_path), "--to_db"])
+
+    loader.return_value.close.assert_called_once()
+
+
+def test_metadata_cache_path_comes_from_the_command_line(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with patch.object(run_pipeline, "run_packages", return_value=[]):
+        run_pipeline.main(["-p", "punts-wifi", "-d", str(tmp_path), "--metadata_cache", str(tmp_path / "meta.sqlite")])
+
+    assert (tmp_path / "meta.sqlite").exists()
+    assert not (tmp_path / "metadata_cache.sqlite").exists()
@@ -0,0 +1,45 @@
+import logging, time
+from unittest.mock import patch
+import scheduler
+from reporting import Report
+
+
+def fake_report(package, success=True, code=200):
+    report = Report(package, time.time())
+    report.package_success = success
+    report.package_response_code = code
+    return report
+
+
+def test_should_requeue_only_retryable_failures():
+    assert scheduler.should_requeue(fake_report("a", success=False, code=None))
+    assert scheduler.should_requeue(fake_report("a", success=False, code=503))
+    assert not scheduler.should_requeue(fake_report("a", success=False, code=404))
+    assert not scheduler.should_requeue(fake_report("a"))
+
+
+def test_failed_package_is_requeued_behind_the_others():
+    calls = []
+    flaky_attempts = {"flaky": 0}
+
+    def fake_main_pipeline(logger, package, **kwargs):
+        calls.append(package)
+        if package == "flaky" and flaky_attempts["flaky"] == 0:
+            flaky_attempts["flaky"] += 1
+            report = fake_report(package, success=False, code=None)
+            report.num_errors = 1
+            return report
+        return fake_report(package)
+
+    with patch.object(scheduler, "main_pipeline", fake_main_pipeline):
+        reports = scheduler.run_packages(
+            logging.getLogger("test"),
+            ["flaky", "steady"],
+            storage_root=".",
+            requeue_delay=0,
+            )
+
+    assert calls == ["flaky", "steady", "flaky"]
+    assert [r.package_name for r in reports] == ["flaky", "steady"]
+    assert all(r.package_success for r in reports)
+    assert reports[0].num_errors == 1
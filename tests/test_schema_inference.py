@@ -0,0 +1,87 @@
+from io import StringIO
+from schema_inference import (
+    CoercingReader,
+    TableSchema,
+    infer_column,
+    infer_file,
+    infer_rows,
+    row_coercer,
+    widen,
+)
+
+
+def test_infer_column_recognises_local_formats():
+    assert infer_column("valor", ["1.234,5", "12,75", ""]).pg_type == "DOUBLE PRECISION"
+    assert infer_column("valor", ["1.234,5", "12,75"]).fmt == "decimal_comma"
+    assert infer_column("habitants", ["1.234.567", "12"]).pg_type == "BIGINT"
+    assert infer_column("data", ["31/12/2024", "1/2/2025"]).pg_type == "DATE"
+    assert infer_column("data", ["2024-12-31", "2025-02-01"]).fmt is None
+    assert infer_column("hora", ["2024-12-31T10:00:00", "2025-02-01 08:30"]).pg_type == "TIMESTAMP"
+    assert infer_column("actiu", ["Sí", "No", "no"]).pg_type == "BOOLEAN"
+    assert infer_column("data", ["31/02/2024"]).pg_type == "TEXT"
+    assert infer_column("valor", ["1,5", "2.5"]).pg_type == "TEXT"
+
+
+def test_infer_column_picks_the_narrowest_type():
+    assert infer_column("valor", ["1", "-20", ""]).pg_type == "BIGINT"
+    assert infer_column("valor", ["1", "2.5", "1e3"]).pg_type == "DOUBLE PRECISION"
+    assert infer_column("valor", ["1", "Gràcia"]).pg_type == "TEXT"
+    assert infer_column("valor", ["", " "]).pg_type is None
+
+
+def test_infer_file_reads_only_a_sample(tmp_path):
+    csv_file = tmp_path / "2025_test.csv"
+    csv_file.write_text("any,barri,valor\n2025,Gràcia,1\n2025,Sants,2\n2025,Horta,not a number\n", encoding="utf-8")
+
+    columns = infer_file(str(csv_file), sample_rows=2)
+    assert [(column.name, column.pg_type) for column in columns] == [
+        ("any", "BIGINT"), ("barri", "TEXT"), ("valor", "BIGINT")
+        ]
+    assert TableSchema().merge(columns) == (["any", "barri", "valor"], [])
+
+
+def test_null_tokens_are_ignored_and_flagged():
+    column = infer_column("valor", ["1", "-", "n/a", ""])
+    assert (column.pg_type, column.nulls) == ("BIGINT", True)
+    assert infer_column("valor", ["", "-"]).pg_type is None
+
+
+def test_widen():
+    assert widen("BIGINT", "DOUBLE PRECISION") == "DOUBLE PRECISION"
+    assert widen("DATE", "TIMESTAMP") == "TIMESTAMP"
+    assert widen("BIGINT", "DATE") == "TEXT"
+    assert widen(None, "BOOLEAN") == "BOOLEAN"
+    assert widen("BIGINT", None) == "BIGINT"
+
+
+def test_table_schema_reconciles_drifting_headers_and_types():
+    schema = TableSchema(aliases={"Nom_Barri_Antic": "Nom_Barri"})
+    schema.merge(infer_rows(["Any", "Nom_Barri", "Valor"], [["2019", "Sants", "3"]]))
+    added, widened = schema.merge(
+        infer_rows(["valor", "nom barri antic", "ANY", "Districte"], [["3,5", "Sants", "2024", "Sants-Montjuïc"]])
+    )
+
+    assert added == ["Districte"]
+    assert widened == ["Valor"]
+    assert schema.ddl() == [
+        ("Any", "BIGINT"), ("Nom_Barri", "TEXT"), ("Valor", "DOUBLE PRECISION"), ("Districte", "TEXT")
+    ]
+    assert schema.targets(["valor", "nom barri antic", "ANY", "Districte"]) == ["Valor", "Nom_Barri", "Any", "Districte"]
+
+
+def test_coercing_reader_rewrites_only_typed_columns():
+    header = ["data", "valor", "barri", "actiu"]
+    rows = [["31/12/2024", "1.234,5", "-", "Sí"], ["1/2/2025", "-", "Gràcia", "no"]]
+    columns = infer_rows(header, rows)
+    coerce_row = row_coercer(columns, ["DATE", "DOUBLE PRECISION", "TEXT", "BOOLEAN"])
+    source = StringIO("data,valor,barri,actiu\n31/12/2024,\"1.234,5\",-,Sí\n1/2/2025,-,Gràcia,no\n")
+
+    reader = CoercingReader(source, coerce_row)
+    text = reader.read(10) + reader.read(-1)
+
+    assert text == "data,valor,barri,actiu\n2024-12-31,1234.5,-,true\n2025-02-01,,Gràcia,false\n"
+
+
+def test_row_coercer_is_skipped_for_clean_files():
+    columns = infer_rows(["any", "valor"], [["2024", "1.5"]])
+    assert row_coercer(columns, ["BIGINT", "DOUBLE PRECISION"]) is None
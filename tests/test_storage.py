@@ -0,0 +1,71 @@
+import gzip, logging, os
+from unittest.mock import patch
+import pytest
+import data_functions
+from benchmarks.fake_ckan import FakeCKAN
+from blob_store import BlobStore
+from db_load import file_resources, get_file_names
+from pipeline_functions import main_pipeline
+from schema_inference import sample_file
+from storage import find_stored, logical_name, open_stored, stored_name
+
+logger = logging.getLogger("test")
+
+
+def write(tmp_path, name, text, compression, **kwargs):
+    resource = {"name": name, "package_name": "a"}
+    assert data_functions.write_text_chunks(logger, resource, iter(text), path=str(tmp_path), compression=compression, **kwargs)
+    return find_stored(os.path.join(tmp_path, "a"), name)
+
+
+def test_compressed_files_read_back_and_replace_other_versions(tmp_path):
+    plain = write(tmp_path, "2025_a.csv", ["x,y\n", "1,2\n"], "none")
+    compressed = write(tmp_path, "2025_a.csv", ["x,y\n", "3,4\n"], "gzip")
+
+    assert compressed == os.path.join(tmp_path, "a", "2025_a.csv.gz")
+    assert not os.path.exists(plain)
+    with gzip.open(compressed, "rt", encoding="utf-8") as f:
+        assert f.read() == "x,y\n3,4\n"
+    with open_stored(compressed) as f:
+        assert f.read() == "x,y\n3,4\n"
+    assert sample_file(compressed) == (["x", "y"], [["3", "4"]])
+    assert stored_name("2025_a.csv", "zstd") == "2025_a.csv.zst"
+    assert logical_name("2025_a.csv.zst") == logical_name("2025_a.csv") == "2025_a.csv"
+
+
+def test_identical_content_compressed_the_same_way_is_one_blob(tmp_path):
+    store = BlobStore(str(tmp_path / ".blobs"))
+    first = write(tmp_path, "2024_a.csv", ["x,y\n1,2\n"], "gzip", blob_store=store)
+    second = write(tmp_path, "2025_a.csv", ["x,y\n1,2\n"], "gzip", blob_store=store)
+    plain = write(tmp_path, "2023_a.csv", ["x,y\n1,2\n"], "none", blob_store=store)
+
+    assert os.path.samefile(first, second)
+    assert not os.path.samefile(first, plain)
+
+
+def test_compressed_downloads_are_skipped_and_loaded_like_plain_ones(tmp_path):
+    with FakeCKAN(packages={"fake-package": 2}, rows=40) as fake, \
+            patch.object(data_functions, "PACKAGE_SHOW_URL", f"{fake.api_url}/package_show"):
+        first = main_pipeline(logger, "fake-package", str(tmp_path), compression="gzip")
+        # a file saved compressed is still up to date when the setting changes
+        again = main_pipeline(logger, "fake-package", str(tmp_path))
+
+    data_dir = os.path.join(tmp_path, "fake-package")
+    assert sorted(first.resources_success) == ["2024_fake-package.csv", "2025_fake-package.csv"]
+    assert again.skipped == 2 and again.resources_success == []
+    assert sorted(get_file_names(data_dir)) == ["2024_fake-package.csv.gz", "2025_fake-package.csv.gz"]
+    resources = file_resources(data_dir, sorted(get_file_names(data_dir)))
+    assert [resource["name"] for resource in resources] == ["2024_fake-package.csv", "2025_fake-package.csv"]
+    assert all(not resource["id"].startswith("file:") for resource in resources)
+    assert len(sample_file(find_stored(data_dir, "2025_fake-package.csv"))[0]) == 7
+
+
+def test_compressed_csvs_convert_to_columnar(tmp_path):
+    pytest.importorskip("pyarrow")
+    from columnar import columnar_path, write_columnar
+    write(tmp_path, "2025_a.csv", ["x,y\n", "1,2.5\n", "3,4\n"], "gzip")
+    resource = {"name": "2025_a.csv", "package_name": "a"}
+
+    assert write_columnar(logger, resource, str(tmp_path), "parquet")
+    import pyarrow.parquet as pq
+    assert pq.read_table(columnar_path(str(tmp_path), resource, "parquet")).to_pydict() == {"x": [1, 3], "y": [2.5, 4.0]}
@@ -0,0 +1,199 @@
+import queue, threading
+from unittest.mock import patch, MagicMock
+import pytest
+import psycopg2
+from psycopg2.pool import PoolError
+import stream_load
+from stream_load import QueueReader, StreamingLoader
+
+
+def test_queue_reader_reads_across_chunks():
+    chunks = queue.Queue()
+    for chunk in ("any,valor\n2024,", "1\n2025,2\n", stream_load._END):
+        chunks.put(chunk)
+    reader = QueueReader(chunks)
+
+    assert reader.read(4) == "any,"
+    assert reader.read(-1) == "valor\n2024,1\n2025,2\n"
+    assert reader.read(10) == ""
+
+
+def test_queue_reader_raises_on_abort():
+    chunks = queue.Queue()
+    chunks.put(ValueError("download failed"))
+
+    with pytest.raises(ValueError):
+        QueueReader(chunks).read(10)
+
+
+
+def fake_database(copy=None, loaded=None):
+    """
+    Patches out the connection pool and the SQL helpers, so StreamingLoader can run without Postgres.
+    """
+    return [
+        patch.object(stream_load, "ThreadedConnectionPool"),
+        patch.object(stream_load, "cursor_table_exists", return_value=False),
+        patch.object(stream_load, "ensure_loads_table"),
+        patch.object(stream_load, "loaded_resources", return_value=loaded or {}),
+        patch.object(stream_load, "create_table"),
+        patch.object(stream_load, "replace_resource_rows", side_effect=copy),
+    ]
+
+
+def resource(year, revision="r1"):
+    return {"id": f"id-{year}", "name": f"{year}_test.csv", "revision_id": revision,
+            "last_modified": None, "size": "10", "hash": ""}
+
+
+def test_streaming_loader_creates_table_once_and_copies_each_stream():
+    copied = {}
+
+    def copy(cur, table, res, header, source):
+        copied[res["id"]] = source.read()
+
+    patches = fake_database(copy)
+    with patches[0], patches[1], patches[2], patches[3], patches[4] as create_table, patches[5]:
+        loader = StreamingLoader(MagicMock(), max_connections=2, queue_chunks=1)
+
+        assert loader.prepare_package("pkg")
+        for year in (2024, 2025):
+            stream = loader.open_stream("pkg", resource(year), f"any,valor\n{year},1\n")
+            stream.put(f"{year},2\n")
+            assert stream.finish()
+        loader.close()
+
+    create_table.assert_called_once()
+    assert create_table.call_args.args[2] == [("any", "BIGINT"), ("valor", "BIGINT")]
+    assert copied == {"id-2024": "any,valor\n2024,1\n2024,2\n", "id-2025": "any,valor\n2025,1\n2025,2\n"}
+    assert not loader.needs_load("pkg", resource(2024))
+
+
+def test_only_new_or_changed_resources_need_loading():
+    loaded = {"id-2024": stream_load.resource_signature(resource(2024))}
+    patches = fake_database(loaded=loaded)
+    with patches[0], patches[1], patches[2], patches[3], patches[4], patches[5]:
+        loader = StreamingLoader(MagicMock())
+        loader.prepare_package("pkg")
+
+        assert not loader.needs_load("pkg", resource(2024))
+        assert loader.needs_load("pkg", resource(2024, revision="r2"))
+        assert loader.needs_load("pkg", resource(2025))
+        loader.close()
+
+
+def test_put_fails_fast_when_copy_has_stopped():
+    def copy(cur, table, res, header, source):
+        raise RuntimeError("bad data")
+
+    patches = fake_database(copy)
+    with patches[0], patches[1], patches[2], patches[3], patches[4], patches[5]:
+        loader = StreamingLoader(MagicMock(), queue_chunks=1)
+        loader.prepare_package("pkg")
+        stream = loader.open_stream("pkg", resource(2024), "any,valor\n2024,1\n")
+        stream.future.result()
+
+        with pytest.raises(RuntimeError):
+            stream.put("2024,2\n")
+        assert not stream.finish()
+        loader.close()
+
+
+def test_later_resources_widen_the_table():
+    patches = fake_database(lambda cur, table, res, targets, source: source.read())
+    with patches[0], patches[1], patches[2], patches[3], patches[4], patches[5], \
+            patch.object(stream_load, "alter_table") as alter_table:
+        loader = StreamingLoader(MagicMock())
+        loader.prepare_package("pkg")
+        assert loader.open_stream("pkg", resource(2024), "any,valor\n2024,1\n").finish()
+        assert loader.open_stream("pkg", resource(2025), "Valor,Any,Barri\n\"1,5\",2025,Sants\n").finish()
+        loader.close()
+
+    schema, added, widened = alter_table.call_args.args[2:]
+    assert (added, widened) == (["Barri"], ["valor"])
+    assert schema.type_of("valor") == "DOUBLE PRECISION"
+
+
+class BoundedPool:
+    """
+    Hands out connections like psycopg2's ThreadedConnectionPool, raising when it runs out.
+    """
+
+    def __init__(self, minconn, maxconn, dsn):
+        self.maxconn = maxconn
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.in_use == self.maxconn:
+                raise PoolError("connection pool exhausted")
+            self.in_use += 1
+        return MagicMock()
+
+    def putconn(self, conn):
+        with self.lock:
+            self.in_use -= 1
+
+    def closeall(self):
+        pass
+
+
+def test_a_connection_is_kept_for_ddl_while_every_copy_is_running():
+    patches = fake_database(lambda cur, table, res, targets, source: source.read())
+    with patch.object(stream_load, "ThreadedConnectionPool", BoundedPool), patches[1], patches[2], patches[3], \
+            patches[4] as create_table, patches[5]:
+        loader = StreamingLoader(MagicMock(), max_connections=1)
+        assert loader.prepare_package("pkg") and loader.prepare_package("other")
+        first = loader.open_stream("pkg", resource(2024), "any,valor\n2024,1\n")
+        # the only COPY connection is busy, and this resource's table has to be created
+        second = loader.open_stream("other", resource(2025), "any,valor\n2025,1\n")
+        assert first.finish() and second.finish()
+        loader.close()
+
+    assert create_table.call_count == 2
+
+
+def test_a_table_is_widened_once_the_streams_into_it_have_finished():
+    events = []
+    patches = fake_database(lambda cur, table, res, targets, source: events.append(("copied", source.read())))
+    with patches[0], patches[1], patches[2], patches[3], patches[4], patches[5], \
+            patch.object(stream_load, "alter_table", side_effect=lambda *args: events.append("altered")):
+        loader = StreamingLoader(MagicMock())
+        loader.prepare_package("pkg")
+        first = loader.open_stream("pkg", resource(2024), "any,valor\n2024,1\n")
+        # another download finishes the first resource while this one waits to widen the table
+        finisher = threading.Timer(0.2, first.finish)
+        finisher.start()
+        second = loader.open_stream("pkg", resource(2025), "any,valor\n2025,\"1,5\"\n")
+        assert second.finish()
+        finisher.join()
+        loader.close()
+
+    assert events[:2] == [("copied", "any,valor\n2024,1\n"), "altered"]
+
+
+class BadValue(psycopg2.DataError):
+    diag = MagicMock(context='COPY pkg, line 3, column valor: "1,5"')
+
+
+def test_a_value_past_the_sample_widens_its_column_on_the_next_try():
+    def copy(cur, table, res, targets, source):
+        if "1,5" in source.read():
+            raise BadValue("invalid input syntax for type bigint")
+
+    patches = fake_database(copy)
+    with patches[0], patches[1], patches[2], patches[3], patches[4], patches[5], \
+            patch.object(stream_load, "alter_table") as alter_table:
+        loader = StreamingLoader(MagicMock())
+        loader.prepare_package("pkg")
+        for _ in range(2):
+            stream = loader.open_stream("pkg", resource(2024), "any,valor\n2024,1\n")
+            stream.put("2024,\"1,5\"\n")
+            loaded = stream.finish()
+        loader.close()
+
+    # the retry rewrites "1,5" as 1.5 for a DOUBLE PRECISION column, which COPY takes
+    assert loaded
+    schema, added, widened = alter_table.call_args.args[2:]
+    assert widened == ["valor"] and schema.type_of("valor") == "DOUBLE PRECISION"
@@ -0,0 +1,55 @@
+from unittest.mock import MagicMock
+from sync_state import SyncState
+
+
+def make_resource(**changes):
+    resource = {
+        "id": "a7bc7bd9",
+        "name": "2025_pad_dom_mdbas_tipus-domicili_edat.csv",
+        "revision_id": "06d1939d",
+        "last_modified": None,
+        "size": "658619",
+        "hash": "",
+    }
+    resource.update(changes)
+    return resource
+
+
+def test_new_resource_needs_update(tmp_path):
+    assert SyncState(str(tmp_path)).needs_update(make_resource())
+
+
+def test_existing_file_without_entry_is_adopted(tmp_path):
+    resource = make_resource()
+    (tmp_path / resource["name"]).write_text("a,b\n")
+    state = SyncState(str(tmp_path))
+
+    assert not state.needs_update(resource)
+    assert state.entry(resource)["revision_id"] == "06d1939d"
+
+
+def test_changed_metadata_needs_update_and_survives_reload(tmp_path):
+    resource = make_resource()
+    (tmp_path / resource["name"]).write_text("a,b\n")
+    response = MagicMock(headers={"ETag": '"abc"', "Last-Modified": "Wed, 01 Oct 2025 02:10:42 GMT"})
+    state = SyncState(str(tmp_path))
+    state.record(resource, response)
+    state.save()
+
+    reloaded = SyncState(str(tmp_path))
+    assert not reloaded.needs_update(resource)
+    changed = make_resource(revision_id="new-revision", size="700000")
+    assert reloaded.needs_update(changed)
+    assert reloaded.conditional_headers(changed) == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Wed, 01 Oct 2025 02:10:42 GMT",
+    }
+
+
+def test_deleted_file_needs_update(tmp_path):
+    resource = make_resource()
+    state = SyncState(str(tmp_path))
+    state.record(resource)
+
+    assert state.needs_update(resource)
+    assert state.conditional_headers(resource) == {}
@@ -0,0 +1,35 @@
+import os
+from tag_index import TagIndex, normalize_tag, INDEX_SUFFIX
+from pipeline_functions import get_packages
+
+CATALOG = 'name,tags_list\nbus,"Transporte, Mobilitat"\nmetro,"Transport públic, Mobilitat"\npadro,"Padró, Població"\nbuit,\n'
+
+
+def write_catalog(tmp_path, text=CATALOG):
+    catalog = tmp_path / "catalog_tags.csv"
+    catalog.write_text(text, encoding="utf-8")
+    return str(catalog)
+
+
+def test_normalize_tag_folds_case_and_accents():
+    assert normalize_tag("  Població ") == "poblacio"
+    assert normalize_tag("Transport públic") == "transport public"
+
+
+def test_any_all_and_prefix_matching(tmp_path):
+    index = TagIndex.load(write_catalog(tmp_path))
+
+    assert index.search(["transporte"]) == ["bus"]
+    assert index.search(["poblacio", "TRANSPORTE"]) == ["bus", "padro"]
+    assert index.search(["mobilitat", "transporte"], match="all") == ["bus"]
+    assert index.search(["transport"], prefix=True) == ["bus", "metro"]
+    assert index.search(["nothing"]) == []
+
+
+def test_index_is_saved_and_rebuilt_when_catalog_changes(tmp_path):
+    catalog_path = write_catalog(tmp_path)
+    assert get_packages(["padró"], catalog_path=catalog_path) == ["padro"]
+    assert os.path.exists(str(tmp_path / "catalog_tags") + INDEX_SUFFIX)
+
+    write_catalog(tmp_path, CATALOG + 'padro-2,"Padró"\n')
+    assert get_packages(["padró"], catalog_path=catalog_path) == ["padro", "padro-2"]